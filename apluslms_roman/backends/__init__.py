@@ -1,19 +1,38 @@
+import asyncio
+import logging
 from collections import namedtuple
 from collections.abc import Mapping
+from os.path import join
 
+from ..build_path import BUILD_DIR
+from ..log_pipeline import BLOCK, LOG_POLICIES, MAX_LINE_LENGTH, MAX_LINES, LogPipeline
 from ..observer import BuildObserver
+from ..resources import parse_size
 from ..utils.env import EnvDict
 
 
+logger = logging.getLogger(__name__)
+
+
 BACKENDS = {
     'docker': 'apluslms_roman.backends.docker.DockerBackend',
+    'fake': 'apluslms_roman.backends.fake.FakeBackend',
+    'local': 'apluslms_roman.backends.local.LocalBackend',
 }
 
 
-BuildTask = namedtuple('BuildTask', [
-    'path',
-    'steps',
-])
+class BuildTask(namedtuple('BuildTask', ['path', 'steps', 'build_path'])):
+    """
+    path: the project directory
+    steps: BuildSteps to build
+    build_path: the directory mounted as the build output, _build by default
+    """
+    __slots__ = ()
+
+    def __new__(cls, path, steps, build_path=None):
+        if build_path is None:
+            build_path = join(path, BUILD_DIR)
+        return super().__new__(cls, path, steps, build_path)
 
 
 def clean_image_name(image):
@@ -29,8 +48,13 @@ class BuildStep:
     mnt: If not None, course data is mounted to this path in RW mode
     env: If not None, dict that is given as environment for the image
     ref: Name/index of the step
+    depends_on: If not None, refs of the steps this step waits for
+    inputs: If not None, glob patterns of the project files the step reads
+    cpus: If not None, number of CPUs the step may use
+    memory: If not None, bytes of memory the step may use
     """
-    __slots__ = ('img', 'cmd', 'mnt', 'env', 'name', 'ref')
+    __slots__ = ('img', 'cmd', 'mnt', 'env', 'name', 'ref', 'depends_on', 'inputs',
+        'cpus', 'memory')
 
     @classmethod
     def from_config(cls, index, data, environment=None):
@@ -46,17 +70,26 @@ class BuildStep:
                 environment,
                 data.get('env'),
                 data.get('name'),
+                data.get('depends_on'),
+                data.get('inputs'),
+                data.get('cpus'),
+                data.get('memory'),
             )
         return cls(index, clean_image_name(data))
 
     def __init__(
             self, ref, img, cmd=None, mnt=None,
-            project_env=None, step_env=None, name=None):
+            project_env=None, step_env=None, name=None, depends_on=None, inputs=None,
+            cpus=None, memory=None):
         self.ref = ref
         self.img = clean_image_name(img)
         self.cmd = cmd if (cmd is None or isinstance(cmd, str)) else tuple(cmd)
         self.mnt = mnt
         self.name = name
+        self.depends_on = None if depends_on is None else tuple(depends_on)
+        self.inputs = None if inputs is None else tuple(inputs)
+        self.cpus = cpus
+        self.memory = parse_size(memory)
         self.env = EnvDict(
             (project_env, "project configuration"),
             (step_env, "step {}".format(str(self)))
@@ -120,11 +153,68 @@ class Backend:
     def prepare(self, task: BuildTask, observer: BuildObserver):
         raise NotImplementedError
 
+    def prepare_step(self, task: BuildTask, step: BuildStep, observer: BuildObserver):
+        """
+            Prepares a single step. Can be called from multiple threads.
+            Returns BuildResult
+        """
+        return self.prepare(task._replace(steps=[step]), observer)
+
+    @property
+    def prepare_jobs(self):
+        """Number of steps, which can be prepared in parallel."""
+        return 1
+
     def build(self, task: BuildTask, observer: BuildObserver):
         """
             Returns BuildResult
         """
-        raise NotImplementedError
+        for step in task.steps:
+            result = self.build_step(task, step, observer)
+            if not result.ok:
+                return result
+        return BuildResult()
+
+    def build_step(self, task: BuildTask, step: BuildStep, observer: BuildObserver):
+        """
+            Builds a single step. Can be called from multiple threads.
+            Defaults to build() of the step for backends implementing only it.
+            Returns BuildResult
+        """
+        if type(self).build is Backend.build:
+            raise NotImplementedError
+        return self.build(task._replace(steps=[step]), observer)
+
+    def cancel_step(self, step: BuildStep):
+        """
+            Requests a running build_step to stop. The cancelled build_step
+            should mark the step cancelled and return a cancelled result.
+        """
+        pass
+
+    def image_id(self, step: BuildStep):
+        """
+            Returns an id, which changes when the image of the step changes,
+            or None if unknown. Steps are cached only when the id is known.
+        """
+        return None
+
+    def open_log(self, step: BuildStep, observer: BuildObserver):
+        """
+            Returns a LogPipeline, which passes the output of the step to
+            the observer. It is configured with the options LOG_POLICY,
+            LOG_BUFFER_LINES and LOG_MAX_LINE_LENGTH of the backend.
+        """
+        name = getattr(self, 'name', None) or self.__class__.__name__.lower()
+        prefix = name.upper() + '_'
+        env = self.context.environ
+        policy = env.get(prefix + 'LOG_POLICY', BLOCK)
+        if policy not in LOG_POLICIES:
+            logger.warning("Unknown log policy %r, using %r", policy, BLOCK)
+            policy = BLOCK
+        return LogPipeline(observer, step, policy,
+            max_lines=env.get(prefix + 'LOG_BUFFER_LINES', MAX_LINES),
+            max_line_length=env.get(prefix + 'LOG_MAX_LINE_LENGTH', MAX_LINE_LENGTH))
 
     def verify(self):
         """Verify that connections to backend is working
@@ -142,3 +232,94 @@ class Backend:
 
     def version_info(self):
         pass
+
+
+class AsyncBackend:
+    """
+    A backend with coroutine methods, which are run on an asyncio event loop.
+    Builder.build_async() can drive many builds with a single thread.
+    Synchronous backends are used via SyncBackendAdapter.
+    """
+    WORK_SIZE = Backend.WORK_SIZE
+    WORK_PATH = Backend.WORK_PATH
+    LABEL_PREFIX = Backend.LABEL_PREFIX
+
+    def __init__(self, context: BackendContext):
+        self.context = context
+
+    async def prepare(self, task: BuildTask, observer: BuildObserver):
+        raise NotImplementedError
+
+    async def build(self, task: BuildTask, observer: BuildObserver):
+        """
+            Returns BuildResult
+        """
+        for step in task.steps:
+            result = await self.build_step(task, step, observer)
+            if not result.ok:
+                return result
+        return BuildResult()
+
+    async def build_step(self, task: BuildTask, step: BuildStep, observer: BuildObserver):
+        """
+            Builds a single step. Can be awaited concurrently for many steps.
+            Returns BuildResult
+        """
+        raise NotImplementedError
+
+    async def cancel_step(self, step: BuildStep):
+        """
+            Requests a running build_step to stop. See Backend.cancel_step.
+        """
+        pass
+
+    def image_id(self, step: BuildStep):
+        return None
+
+    async def verify(self):
+        raise NotImplementedError
+
+    async def cleanup(self, force=False):
+        pass
+
+    async def version_info(self):
+        pass
+
+
+class SyncBackendAdapter(AsyncBackend):
+    """
+    Runs the methods of a synchronous Backend in `executor`, which defaults
+    to the default executor of the event loop.
+    """
+
+    def __init__(self, backend: Backend, executor=None):
+        super().__init__(backend.context)
+        self.backend = backend
+        self.executor = executor
+
+    def _run(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def prepare(self, task, observer):
+        return await self._run(self.backend.prepare, task, observer)
+
+    async def build(self, task, observer):
+        return await self._run(self.backend.build, task, observer)
+
+    async def build_step(self, task, step, observer):
+        return await self._run(self.backend.build_step, task, step, observer)
+
+    async def cancel_step(self, step):
+        return await self._run(self.backend.cancel_step, step)
+
+    def image_id(self, step):
+        return self.backend.image_id(step)
+
+    async def verify(self):
+        return await self._run(self.backend.verify)
+
+    async def cleanup(self, force=False):
+        return await self._run(self.backend.cleanup, force)
+
+    async def version_info(self):
+        return await self._run(self.backend.version_info)
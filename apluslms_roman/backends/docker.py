@@ -1,12 +1,26 @@
+import atexit
 import logging
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timedelta
+from json import dumps
 from os.path import join
+from shlex import split as shlex_split
+from threading import Lock, Timer
+from time import perf_counter, time
 
 import docker
+from apluslms_yamlidator.utils import convert_to_boolean as to_bool
 from apluslms_yamlidator.utils.decorator import cached_property
 
 from ..cache_file import CacheFile
+from ..metrics import (
+    CONTAINER_START_LATENCY,
+    IMAGE_PULL_BYTES,
+    IMAGE_PULL_DURATION,
+)
+from ..tracing import span
 from ..utils.translation import _
 from . import (
     Backend,
@@ -33,23 +47,154 @@ class DockerCache(CacheFile):
 
 @contextmanager
 def create_container(client, **opts):
-    container = client.containers.create(**opts)
+    start = perf_counter()
+    with span('container.create', image=opts['image']):
+        container = client.containers.create(**opts)
     try:
-        container.start()
+        with span('container.start'):
+            container.start()
+        CONTAINER_START_LATENCY.observe(perf_counter() - start)
         yield container
     finally:
         try:
-            container.remove(force=True)
+            with span('container.remove'):
+                container.remove(force=True)
         except docker.errors.APIError as err:
             logger.warning("Failed to stop container %s: %s", container, err)
 
 
+class WorkerPool:
+    """
+    Long running containers, which are reused to run steps with exec.
+
+    A worker is created per image and mount layout, and it runs one step at
+    a time. Every step is executed with only its own environment and the
+    scratch space under WORK_PATH is emptied between steps. Anything written
+    elsewhere, e.g. /tmp, $HOME or installed packages, is seen by the later
+    steps. Idle workers are removed after `idle_timeout` seconds and the rest
+    on close() or exit.
+    """
+    IDLE_TIMEOUT = 60
+    ENTRYPOINT = ['/bin/sh', '-c', 'trap "exit 0" TERM; while :; do sleep 3600 & wait $!; done']
+
+    Worker = namedtuple('Worker', ['key', 'container'])
+
+    def __init__(self, client, label_prefix, idle_timeout=IDLE_TIMEOUT):
+        self._client = client
+        self._label = label_prefix + '.worker'
+        self._idle_timeout = idle_timeout
+        self._lock = Lock()
+        self._idle = {} # key -> list of (worker, timer)
+        self._all = set()
+        self._commands = {}
+        atexit.register(self.close)
+
+    @staticmethod
+    def get_key(opts):
+        return dumps([opts['image'], opts['user'], opts['mounts'],
+            opts.get('nano_cpus'), opts.get('mem_limit')], sort_keys=True)
+
+    def acquire(self, opts):
+        """Returns a tuple (worker, reused), where reused is False for a new worker."""
+        key = self.get_key(opts)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                worker, timer = idle.pop()
+                timer.cancel()
+                return worker, True
+        opts = dict(opts, command=None, environment=None,
+            entrypoint=self.ENTRYPOINT, working_dir=None)
+        opts['labels'] = dict(opts['labels'], **{self._label: 'true'})
+        container = self._client.containers.create(**opts)
+        worker = self.Worker(key, container)
+        with self._lock:
+            self._all.add(worker)
+        try:
+            container.start()
+        except docker.errors.APIError:
+            self.discard(worker)
+            raise
+        return worker, False
+
+    def release(self, worker):
+        timer = Timer(self._idle_timeout, self._expire, (worker,))
+        timer.daemon = True
+        with self._lock:
+            if worker not in self._all:
+                return
+            self._idle.setdefault(worker.key, []).append((worker, timer))
+        timer.start()
+
+    def _expire(self, worker):
+        with self._lock:
+            idle = self._idle.get(worker.key, [])
+            if not any(w is worker for w, _ in idle):
+                return
+            idle[:] = [(w, t) for w, t in idle if w is not worker]
+        self.discard(worker)
+
+    def discard(self, worker):
+        with self._lock:
+            self._all.discard(worker)
+        try:
+            worker.container.remove(force=True)
+        except docker.errors.APIError as err:
+            logger.warning("Failed to remove container %s: %s", worker.container, err)
+
+    def close(self):
+        with self._lock:
+            workers = list(self._all)
+            for idle in self._idle.values():
+                for _worker, timer in idle:
+                    timer.cancel()
+            self._idle.clear()
+        for worker in workers:
+            self.discard(worker)
+
+    def get_command(self, step):
+        """Returns the command, which `docker run` would execute for the step."""
+        if step.img not in self._commands:
+            config = self._client.images.get(step.img).attrs['Config']
+            self._commands[step.img] = (config.get('Entrypoint') or [], config.get('Cmd') or [])
+        entrypoint, cmd = self._commands[step.img]
+        if step.cmd is not None:
+            cmd = shlex_split(step.cmd) if isinstance(step.cmd, str) else list(step.cmd)
+        return list(entrypoint) + list(cmd)
+
+    def reset_work_dir(self, worker):
+        """Removes the files of the previous step. Returns False, if that failed."""
+        path = Backend.WORK_PATH
+        try:
+            result = worker.container.exec_run(['find', path, '-mindepth', '1', '-maxdepth', '1',
+                '!', '-name', 'src', '!', '-name', 'build', '-exec', 'rm', '-rf', '{}', '+'])
+        except docker.errors.APIError as err:
+            logger.warning("Failed to reset the work directory of %s: %s", worker.container, err)
+            return False
+        if result.exit_code:
+            logger.warning("Failed to reset the work directory of %s: exit code %s",
+                worker.container, result.exit_code)
+            return False
+        return True
+
+
 class DockerBackend(Backend):
     name = 'docker'
+    PULL_JOBS = 4
+    PULL_PROGRESS_INTERVAL = 2
     debug_hint = _("""Do you have docker-ce installed and running?
 Are you in local 'docker' group? Have you logged out and back in after joining?
 You might be able to add yourself to that group with 'sudo adduser docker'.""")
 
+    def __init__(self, context):
+        super().__init__(context)
+        # step -> running container, None when the step has been cancelled
+        self._running = {}
+        self._running_lock = Lock()
+        self._worker_pool = None
+        # image -> lock, so steps sharing an image pull it only once
+        self._image_locks = {}
+
     @cached_property
     def _client(self):
         env = self.context.environ
@@ -86,6 +231,12 @@ You might be able to add yourself to that group with 'sudo adduser docker'.""")
             labels=labels
         )
 
+        # resource limits
+        if step.cpus:
+            opts['nano_cpus'] = int(step.cpus * 10**9)
+        if step.memory:
+            opts['mem_limit'] = step.memory
+
         # mounts and workdir
         if step.mnt:
             opts['mounts'] = [Mount(step.mnt, task.path, type='bind', read_only=False)]
@@ -95,86 +246,239 @@ You might be able to add yourself to that group with 'sudo adduser docker'.""")
             opts['mounts'] = [
                 Mount(wpath, None, type='tmpfs', read_only=False, tmpfs_size=self.WORK_SIZE),
                 Mount(join(wpath, 'src'), task.path, type='bind', read_only=True),
-                Mount(join(wpath, 'build'), join(task.path, '_build'),
+                Mount(join(wpath, 'build'), task.build_path,
                     type='bind', read_only=False),
             ]
             opts['working_dir'] = wpath
 
         return opts
 
-    def prepare(self, task, observer):
+    def _pull_image(self, step, observer):
+        image, tag = step.img.split(':', 1)
+        layers = {}
+        last_report = time()
+        for event in self._client.api.pull(image, tag, stream=True, decode=True):
+            if 'error' in event:
+                raise docker.errors.APIError(event['error'])
+            detail = event.get('progressDetail') or {}
+            if event.get('status') == 'Downloading' and detail.get('total'):
+                layers[event['id']] = (detail.get('current', 0), detail['total'])
+            if layers and time() - last_report >= self.PULL_PROGRESS_INTERVAL:
+                last_report = time()
+                current = sum(layer[0] for layer in layers.values())
+                total = sum(layer[1] for layer in layers.values())
+                observer.manager_msg(step, "Downloading {}: {:.1f} / {:.1f} MB".format(
+                    step.img, current / 2**20, total / 2**20))
+        IMAGE_PULL_BYTES.inc(sum(layer[1] for layer in layers.values()), image=step.img)
+
+    def _prepare_image(self, steps, observer):
+        """
+        Checks and pulls the image of `steps`, which all use the same image.
+        Returns a tuple (BuildResult, datetime of a successful pull or None).
+        """
         client = self._client
-        images = self._cache.images
-        day = timedelta(days=1)
-        for step in task.steps:
-            try:
-                observer.step_preflight(step)
-                image, tag = step.img.split(':', 1)
-
-                last_update = images.get(step.img, None)
-                should_update = (not last_update or
-                    datetime.now() - last_update >= day)
-
-                try:
-                    client.images.get(step.img)
-                    img_found = True
-                except docker.errors.ImageNotFound:
-                    img_found = False
-
-                if not img_found or should_update:
-                    observer.step_running(step)
-                    if img_found:
-                        observer.manager_msg(step,
-                            ("Checking for updates for {} and "
-                            "downloading if any").format(step.img))
-                    else:
-                        observer.manager_msg(step,
-                            "Downloading image {}".format(step.img))
-                    try:
-                        client.images.pull(image, tag)
-                        images[step.img] = datetime.now()
-                    except docker.errors.APIError as err:
-                        if not img_found:
-                            observer.step_failed(step)
-                            error = "%s %s" % (err.__class__.__name__, err)
-                            return BuildResult(error=error, step=step)
-                        observer.manager_msg(step, "Couldn't download image. "
-                            "Using previously downloaded image")
-
-                observer.step_succeeded(step)
-            except KeyboardInterrupt:
-                observer.step_cancelled(step)
-                return BuildResult(False, step=step)
-        return BuildResult()
+        step = steps[0]
+        last_update = self._cache.images.get(step.img, None)
+        should_update = (not last_update or
+            datetime.now() - last_update >= timedelta(days=1))
 
-    def build(self, task, observer):
-        client = self._client
-        for step in task.steps:
-            observer.step_pending(step)
-            opts = self._run_opts(task, step)
-            observer.manager_msg(step, "Starting container {}".format(opts['image']))
+        try:
+            with span('image.check', image=step.img):
+                client.images.get(step.img)
+            img_found = True
+        except docker.errors.ImageNotFound:
+            img_found = False
+
+        pulled = None
+        if not img_found or should_update:
+            for step_ in steps:
+                observer.step_running(step_)
+            if img_found:
+                observer.manager_msg(step,
+                    ("Checking for updates for {} and "
+                    "downloading if any").format(step.img))
+            else:
+                observer.manager_msg(step,
+                    "Downloading image {}".format(step.img))
             try:
-                with create_container(client, **opts) as container:
-                    observer.step_running(step)
-                    for line in container.logs(stderr=True, stream=True):
-                        observer.container_msg(step, line.decode('utf-8'))
-                    ret = container.wait(timeout=10)
+                start = perf_counter()
+                with span('image.pull', image=step.img):
+                    self._pull_image(step, observer)
+                IMAGE_PULL_DURATION.observe(perf_counter() - start, image=step.img)
+                pulled = datetime.now()
             except docker.errors.APIError as err:
-                observer.step_failed(step)
-                error = "%s %s" % (err.__class__.__name__, err)
-                return BuildResult(error=error, step=step)
-            except KeyboardInterrupt:
-                observer.step_cancelled(step)
-                return BuildResult(False, step=step)
+                if not img_found:
+                    for step_ in steps:
+                        observer.step_failed(step_)
+                    error = "%s %s" % (err.__class__.__name__, err)
+                    return BuildResult(error=error, step=step), None
+                observer.manager_msg(step, "Couldn't download image. "
+                    "Using previously downloaded image")
+
+        for step_ in steps:
+            observer.step_succeeded(step_)
+        return BuildResult(), pulled
+
+    def prepare(self, task, observer):
+        images = OrderedDict()
+        for step in task.steps:
+            observer.step_preflight(step)
+            images.setdefault(step.img, []).append(step)
+
+        executor = ThreadPoolExecutor(max_workers=self.prepare_jobs)
+        futures = OrderedDict(
+            (executor.submit(self._prepare_image, steps, observer), steps)
+            for steps in images.values())
+        result = BuildResult()
+        try:
+            for future, steps in futures.items():
+                if future.cancelled():
+                    continue
+                step_result, pulled = future.result()
+                if pulled:
+                    self._cache.images[steps[0].img] = pulled
+                if not step_result.ok and result.ok:
+                    result = step_result
+                    for other, other_steps in futures.items():
+                        if other.cancel():
+                            for step in other_steps:
+                                observer.step_cancelled(step)
+        except KeyboardInterrupt:
+            for future_, steps_ in futures.items():
+                if not future_.done():
+                    future_.cancel()
+                    for step in steps_:
+                        observer.step_cancelled(step)
+            executor.shutdown(wait=False)
+            return BuildResult(False, step=steps[0])
+        executor.shutdown()
+        return result
+
+    @property
+    def prepare_jobs(self):
+        return max(1, int(self.context.environ.get('DOCKER_PULL_JOBS', self.PULL_JOBS)))
+
+    def prepare_step(self, task, step, observer):
+        observer.step_preflight(step)
+        with self._running_lock:
+            lock = self._image_locks.setdefault(step.img, Lock())
+            # load the cache once, before threads update it
+            self._cache
+        with lock:
+            result, pulled = self._prepare_image([step], observer)
+            if pulled:
+                self._cache.images[step.img] = pulled
+        return result
+
+    @cached_property
+    def _reuse_containers(self):
+        return to_bool(self.context.environ.get('DOCKER_REUSE_CONTAINERS', False))
+
+    def _start_running(self, step, container):
+        """Registers the container for cancel_step. Returns False if cancelled."""
+        with self._running_lock:
+            cancelled = step in self._running
+            self._running[step] = container
+        return not cancelled
+
+    def _run_container(self, step, opts, observer):
+        observer.manager_msg(step, "Starting container {}".format(opts['image']))
+        with create_container(self._client, **opts) as container:
+            if not self._start_running(step, container):
+                raise KeyboardInterrupt
+            observer.step_running(step)
+            with span('container.logs') as args:
+                with self.open_log(step, observer) as log:
+                    for chunk in container.logs(stderr=True, stream=True):
+                        log.feed(chunk)
+                args['lines'] = log.lines
+            with span('container.wait'):
+                return container.wait(timeout=10)
+
+    def _exec_in_worker(self, step, opts, observer):
+        api = self._client.api
+        workers = self._workers
+        try:
+            worker, reused = workers.acquire(opts)
+        except docker.errors.APIError as err:
+            # e.g. the image doesn't have /bin/sh for the worker entrypoint
+            logger.info("Unable to start a reusable container for %s: %s", opts['image'], err)
+            return self._run_container(step, opts, observer)
+        if reused and not step.mnt and not workers.reset_work_dir(worker):
+            # the step would see files of the previous step
+            workers.discard(worker)
+            return self._run_container(step, opts, observer)
+        if not self._start_running(step, worker.container):
+            workers.release(worker)
+            raise KeyboardInterrupt
+        try:
+            observer.manager_msg(step, "Running in container {}".format(
+                worker.container.short_id))
+            with span('container.exec_create'):
+                exec_id = api.exec_create(worker.container.id, workers.get_command(step),
+                    environment=step.env, user=opts['user'], workdir=opts['working_dir'])
+            observer.step_running(step)
+            with span('container.logs'), self.open_log(step, observer) as log:
+                for chunk in api.exec_start(exec_id, stream=True):
+                    log.feed(chunk)
+            with span('container.wait'):
+                ret = {'StatusCode': api.exec_inspect(exec_id)['ExitCode']}
+        except BaseException:
+            workers.discard(worker)
+            raise
+        with self._running_lock:
+            cancelled = self._running.get(step) is None
+        if cancelled:
+            workers.discard(worker)
+        else:
+            workers.release(worker)
+        return ret
+
+    def build_step(self, task, step, observer):
+        observer.step_pending(step)
+        opts = self._run_opts(task, step)
+        try:
+            if self._reuse_containers:
+                ret = self._exec_in_worker(step, opts, observer)
             else:
-                code = ret.get('StatusCode', None)
-                error = ret.get('Error', None)
-                if code or error:
-                    observer.step_failed(step)
-                    return BuildResult(code=code, error=error, step=step)
-                observer.step_succeeded(step)
+                ret = self._run_container(step, opts, observer)
+        except docker.errors.APIError as err:
+            observer.step_failed(step)
+            error = "%s %s" % (err.__class__.__name__, err)
+            return BuildResult(error=error, step=step)
+        except KeyboardInterrupt:
+            observer.step_cancelled(step)
+            return BuildResult(False, step=step)
+        finally:
+            with self._running_lock:
+                cancelled = self._running.pop(step, None) is None
+        if cancelled:
+            observer.step_cancelled(step)
+            return BuildResult(False, step=step)
+        code = ret.get('StatusCode', None)
+        error = ret.get('Error', None)
+        if code or error:
+            observer.step_failed(step)
+            return BuildResult(code=code, error=error, step=step)
+        observer.step_succeeded(step)
         return BuildResult()
 
+    def cancel_step(self, step):
+        with self._running_lock:
+            container = self._running.get(step)
+            self._running[step] = None
+        if container is not None:
+            try:
+                container.kill()
+            except docker.errors.APIError as err:
+                logger.warning("Failed to kill container %s: %s", container, err)
+
+    def image_id(self, step):
+        try:
+            return self._client.images.get(step.img).id
+        except docker.errors.APIError:
+            return None
+
     def verify(self):
         try:
             client = self._client
@@ -182,8 +486,20 @@ You might be able to add yourself to that group with 'sudo adduser docker'.""")
         except Exception as e:
             return "{}: {}".format(e.__class__.__name__, e)
 
+    @property
+    def _workers(self):
+        with self._running_lock:
+            if self._worker_pool is None:
+                timeout = self.context.environ.get('DOCKER_IDLE_TIMEOUT', None)
+                self._worker_pool = WorkerPool(self._client, self.LABEL_PREFIX,
+                    int(timeout) if timeout else WorkerPool.IDLE_TIMEOUT)
+            return self._worker_pool
+
     def cleanup(self, force=False):
-        containers = self._client.containers.list({'label': self.LABEL_PREFIX})
+        if self._worker_pool is not None:
+            self._worker_pool.close()
+        containers = self._client.containers.list(all=True,
+            filters={'label': self.LABEL_PREFIX})
         if not force:
             now = str(datetime.now())
             expire_label = self.LABEL_PREFIX + '.expire'
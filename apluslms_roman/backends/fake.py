@@ -0,0 +1,220 @@
+"""
+A backend, which replays recorded or configured step runs without containers.
+It's used to measure and load test the builder, the scheduler and observers.
+
+A replay file is JSON:
+
+  {"version": 1,
+   "default": {...},
+   "steps": {"<name or index>": {
+     "prepare": seconds to prepare the step,
+     "duration": seconds to build the step,
+     "output": [[seconds from the start, "line"], ...],
+     "lines": number of generated lines, spread over the duration,
+     "line_length": length of the generated lines,
+     "code": exit code,
+     "error": error message,
+     "prepare_error": error message of a failed preparation}}}
+
+All fields are optional. Steps missing from the file use the "default" entry.
+ReplayRecorder creates a replay file from a build with any backend.
+"""
+import json
+from hashlib import sha256
+from os import replace
+from threading import Event, Lock
+from time import time
+
+from ..observer import BuildObserver, Message, Phase, StepState
+from . import (
+    Backend,
+    BuildResult,
+)
+
+
+REPLAY_VERSION = 1
+
+
+def load_replay(path):
+    with open(path, encoding='utf-8') as f:
+        replay = json.load(f)
+    if replay.get('version') != REPLAY_VERSION:
+        raise ValueError("Unsupported replay version {} in {}"
+            .format(replay.get('version'), path))
+    return replay
+
+
+def get_step_key(step):
+    return str(step.name or step.ref)
+
+
+class FakeBackend(Backend):
+    """
+    Replays the steps from the file in option FAKE_REPLAY. Times are
+    multiplied by FAKE_SPEED, e.g. 0 builds without waiting. Without a replay
+    file, every step succeeds immediately.
+    """
+    name = 'fake'
+
+    def __init__(self, context):
+        super().__init__(context)
+        env = context.environ
+        path = env.get('FAKE_REPLAY')
+        self.replay = load_replay(path) if path else {'version': REPLAY_VERSION}
+        self.speed = float(env.get('FAKE_SPEED', 1))
+        # step -> event, which is set when the step is cancelled
+        self._cancel_events = {}
+        self._lock = Lock()
+
+    def get_run(self, step):
+        """Returns the replay entry of the step."""
+        run = dict(self.replay.get('default') or {})
+        steps = self.replay.get('steps') or {}
+        run.update(steps.get(get_step_key(step)) or steps.get(str(step.ref)) or {})
+        return run
+
+    def _get_output(self, run):
+        output = list(run.get('output') or ())
+        lines = int(run.get('lines', 0))
+        if lines:
+            line = 'x' * int(run.get('line_length', 80))
+            interval = float(run.get('duration', 0)) / lines
+            output.extend((i * interval, line) for i in range(lines))
+            output.sort(key=lambda item: item[0])
+        return output
+
+    def _wait(self, event, start, offset):
+        """Waits until `offset` scaled seconds after `start`. Returns True if cancelled."""
+        delay = start + offset * self.speed - time()
+        if delay > 0:
+            return event.wait(delay)
+        return event.is_set()
+
+    def prepare(self, task, observer):
+        result = BuildResult()
+        for step in task.steps:
+            step_result = self.prepare_step(task, step, observer)
+            if not step_result.ok and result.ok:
+                result = step_result
+        return result
+
+    def prepare_step(self, task, step, observer):
+        observer.step_preflight(step)
+        run = self.get_run(step)
+        self._wait(Event(), time(), float(run.get('prepare', 0)))
+        error = run.get('prepare_error')
+        if error:
+            observer.step_failed(step)
+            return BuildResult(error=error, step=step)
+        observer.step_succeeded(step)
+        return BuildResult()
+
+    def build_step(self, task, step, observer):
+        observer.step_pending(step)
+        run = self.get_run(step)
+        with self._lock:
+            event = self._cancel_events.setdefault(step, Event())
+        try:
+            start = time()
+            observer.step_running(step)
+            with self.open_log(step, observer) as log:
+                for offset, line in self._get_output(run):
+                    if self._wait(event, start, offset):
+                        break
+                    log.feed((line + '\n').encode('utf-8'))
+            cancelled = self._wait(event, start, float(run.get('duration', 0)))
+        finally:
+            with self._lock:
+                self._cancel_events.pop(step, None)
+        if cancelled:
+            observer.step_cancelled(step)
+            return BuildResult(False, step=step)
+        code = int(run.get('code', 0))
+        error = run.get('error')
+        if code or error:
+            observer.step_failed(step)
+            return BuildResult(code=code, error=error, step=step)
+        observer.step_succeeded(step)
+        return BuildResult()
+
+    def cancel_step(self, step):
+        with self._lock:
+            self._cancel_events.setdefault(step, Event()).set()
+
+    def image_id(self, step):
+        return 'fake:' + sha256(step.img.encode('utf-8')).hexdigest()
+
+    def verify(self):
+        return None
+
+    def version_info(self):
+        return "Fake backend:\n  Replay steps: {}\n  Speed: {}".format(
+            len(self.replay.get('steps') or {}), self.speed)
+
+
+class ReplayRecorder(BuildObserver):
+    """
+    Records the timing, the output and the result of each step as a replay
+    for FakeBackend. Messages are passed on to `observer`, if given.
+    """
+
+    def __init__(self, observer=None):
+        super().__init__()
+        self._observer = observer
+        if observer is not None:
+            self._lock = observer._lock
+        self._steps = {}
+        self._starts = {}
+
+    def _get_run(self, step):
+        return self._steps.setdefault(get_step_key(step), {})
+
+    def _message(self, phase, type_, step=None, state=None, data=None):
+        if self._observer is not None:
+            if type_ == Message.PHASE_UPDATE:
+                self._observer._phase_update(phase)
+            else:
+                self._observer._message(phase, type_, step, state, data)
+        if step is None:
+            return
+        now = time()
+        if type_ == Message.STATE_UPDATE:
+            if phase == Phase.PREPARE and state == StepState.PREFLIGHT:
+                self._starts[(phase, step)] = now
+            elif phase == Phase.BUILD and state == StepState.RUNNING:
+                self._starts[(phase, step)] = now
+            elif state.completed and (phase, step) in self._starts:
+                duration = round(now - self._starts[(phase, step)], 3)
+                key = 'prepare' if phase == Phase.PREPARE else 'duration'
+                self._get_run(step)[key] = duration
+                if state == StepState.FAILED and phase == Phase.PREPARE:
+                    self._get_run(step).setdefault('prepare_error', 'failed')
+                elif state == StepState.FAILED:
+                    self._get_run(step).setdefault('code', 1)
+        elif type_ == Message.CONTAINER_MSG:
+            start = self._starts.get((Phase.BUILD, step), now)
+            output = self._get_run(step).setdefault('output', [])
+            output.extend([round(now - start, 3), line] for line in data)
+        elif type_ == Message.RESULT_MSG and data[0]:
+            code, error = data
+            if phase == Phase.PREPARE:
+                self._get_run(step)['prepare_error'] = error or 'failed'
+            else:
+                self._get_run(step)['code'] = code
+                if error:
+                    self._get_run(step)['error'] = error
+
+    def done(self, data=None):
+        super().done(data)
+        if self._observer is not None:
+            self._observer.done(data)
+
+    def get_replay(self):
+        with self._lock:
+            return {'version': REPLAY_VERSION, 'steps': json.loads(json.dumps(self._steps))}
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.get_replay(), f, indent=1)
+        replace(tmp, path)
@@ -0,0 +1,154 @@
+import platform
+import signal
+from functools import partial
+from os import environ, killpg, symlink
+from os.path import join
+from shlex import split as shlex_split
+from shutil import rmtree, which
+from subprocess import DEVNULL, PIPE, STDOUT, Popen
+from tempfile import mkdtemp
+from threading import Lock
+
+from . import (
+    Backend,
+    BuildResult,
+)
+
+
+CHUNK_SIZE = 65536
+
+
+class LocalBackend(Backend):
+    """
+    Runs the commands of steps as subprocesses on the host, without containers.
+
+    The layout of a container is emulated with a temporary work directory,
+    where `src` links to the project and `build` to the build directory.
+    Commands are run in the work directory or in the project directory, when
+    the step has `mnt`. The paths are also given in the environment variables
+    ROMAN_WORK_PATH, ROMAN_SRC_PATH and ROMAN_BUILD_PATH. Images, resource
+    limits and the user of the settings are not used.
+    """
+    name = 'local'
+
+    def __init__(self, context):
+        super().__init__(context)
+        # step -> running process, None when the step has been cancelled
+        self._running = {}
+        self._running_lock = Lock()
+
+    @staticmethod
+    def get_command(step):
+        if isinstance(step.cmd, str):
+            return shlex_split(step.cmd)
+        return list(step.cmd)
+
+    def prepare(self, task, observer):
+        result = BuildResult()
+        for step in task.steps:
+            step_result = self.prepare_step(task, step, observer)
+            if not step_result.ok and result.ok:
+                result = step_result
+        return result
+
+    def prepare_step(self, task, step, observer):
+        observer.step_preflight(step)
+        if not step.cmd:
+            error = "the step has no cmd, which the local backend could run"
+        else:
+            program = self.get_command(step)[0]
+            error = None if which(program) else "command not found: {}".format(program)
+        if error:
+            observer.step_failed(step)
+            return BuildResult(error=error, step=step)
+        observer.step_succeeded(step)
+        return BuildResult()
+
+    def _get_environment(self, task, step, work_path):
+        env = dict(environ)
+        env.update(step.env or {})
+        env.update(
+            ROMAN_WORK_PATH=work_path,
+            ROMAN_SRC_PATH=task.path,
+            ROMAN_BUILD_PATH=task.build_path,
+        )
+        return env
+
+    def _start_running(self, step, process):
+        """Registers the process for cancel_step. Returns False if cancelled."""
+        with self._running_lock:
+            cancelled = step in self._running
+            self._running[step] = process
+        return not cancelled
+
+    def _run_process(self, task, step, observer):
+        work_path = mkdtemp(prefix='roman-')
+        try:
+            symlink(task.path, join(work_path, 'src'))
+            symlink(task.build_path, join(work_path, 'build'))
+            command = self.get_command(step)
+            observer.manager_msg(step, "Running {}".format(' '.join(command)))
+            # a new session, so the whole process group can be killed
+            process = Popen(command, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT,
+                cwd=task.path if step.mnt else work_path,
+                env=self._get_environment(task, step, work_path),
+                start_new_session=True)
+            try:
+                if not self._start_running(step, process):
+                    self._kill(process)
+                    raise KeyboardInterrupt
+                observer.step_running(step)
+                with self.open_log(step, observer) as log:
+                    for chunk in iter(partial(process.stdout.read1, CHUNK_SIZE), b''):
+                        log.feed(chunk)
+            finally:
+                process.stdout.close()
+                code = process.wait()
+            return code
+        finally:
+            rmtree(work_path, ignore_errors=True)
+
+    def build_step(self, task, step, observer):
+        observer.step_pending(step)
+        try:
+            code = self._run_process(task, step, observer)
+        except OSError as err:
+            observer.step_failed(step)
+            error = "%s %s" % (err.__class__.__name__, err)
+            return BuildResult(error=error, step=step)
+        except KeyboardInterrupt:
+            observer.step_cancelled(step)
+            return BuildResult(False, step=step)
+        finally:
+            with self._running_lock:
+                cancelled = self._running.pop(step, None) is None
+        if cancelled:
+            observer.step_cancelled(step)
+            return BuildResult(False, step=step)
+        if code:
+            observer.step_failed(step)
+            return BuildResult(code=code, step=step)
+        observer.step_succeeded(step)
+        return BuildResult()
+
+    def cancel_step(self, step):
+        with self._running_lock:
+            process = self._running.get(step)
+            self._running[step] = None
+        if process is not None:
+            self._kill(process)
+
+    @staticmethod
+    def _kill(process):
+        if process.poll() is None:
+            try:
+                killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def verify(self):
+        return None
+
+    def version_info(self):
+        return "Local backend:\n  Os: {}\n  Python: {}".format(
+            platform.platform(), platform.python_version())
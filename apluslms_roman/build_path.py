@@ -0,0 +1,194 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+from os import fsencode, link, listdir, makedirs, readlink, rename, symlink, walk
+from os.path import exists, isdir, islink, join, relpath
+from shutil import copy2, copyfileobj, copystat, rmtree
+from threading import Thread
+from uuid import uuid4
+
+
+logger = logging.getLogger(__name__)
+
+# directories in the project directory
+BUILD_DIR = '_build'
+# the next build directory in atomic builds
+NEXT_DIR = '_build.next'
+# old build directories, which are being deleted
+TRASH_DIR = '_build.trash'
+BUILD_DIRS = (BUILD_DIR, NEXT_DIR, TRASH_DIR)
+
+# ways to seed the next build directory with the current output
+SEED_LINK = 'link'
+SEED_COPY = 'copy'
+SEED_MODES = (SEED_LINK, SEED_COPY)
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+# ioctl, which makes a file share the data of another file (linux/fs.h)
+FICLONE = 0x40049409
+COPY_BUFFER_SIZE = 2**20
+
+
+def move_to_trash(project_path, path):
+    """
+    Moves `path` to the trash directory of the project with a rename, which is
+    atomic and fast compared to deleting a large tree.
+    """
+    trash = join(project_path, TRASH_DIR)
+    makedirs(trash, exist_ok=True)
+    rename(path, join(trash, uuid4().hex))
+
+
+def empty_trash(project_path, background=True):
+    """
+    Deletes the trash directory of the project, including leftovers of earlier
+    runs. Returns the deleting thread or None.
+    """
+    trash = join(project_path, TRASH_DIR)
+    if not isdir(trash):
+        return None
+    def delete():
+        for name in listdir(trash):
+            rmtree(join(trash, name), ignore_errors=True)
+        try:
+            rmtree(trash)
+        except OSError as err:
+            # e.g. a concurrent build moved a new directory to the trash
+            logger.debug("Failed to remove %s: %s", trash, err)
+    if not background:
+        delete()
+        return None
+    # a daemon thread doesn't delay the exit, the rest is deleted on the next run
+    thread = Thread(target=delete, name='empty-trash', daemon=True)
+    thread.start()
+    return thread
+
+
+def prepare_build_dir(project_path, clean=False):
+    """
+    Creates the build directory of the project and returns its path.
+    With `clean`, the old directory is moved aside and deleted in the background.
+    """
+    path = join(project_path, BUILD_DIR)
+    if clean and isdir(path):
+        move_to_trash(project_path, path)
+    makedirs(path, exist_ok=True)
+    empty_trash(project_path)
+    return path
+
+
+def link_tree(source, target):
+    """
+    Creates the directory tree of `source` to `target` with hardlinks to the
+    files. Files are copied, when hardlinks are not supported.
+    """
+    for dirpath, dirnames, filenames in walk(source):
+        reldir = relpath(dirpath, source)
+        makedirs(join(target, reldir), exist_ok=True)
+        for name in filenames + [d for d in dirnames if islink(join(dirpath, d))]:
+            src, dst = join(dirpath, name), join(target, reldir, name)
+            if islink(src):
+                symlink(readlink(src), dst)
+                continue
+            try:
+                link(src, dst)
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                copy2(src, dst)
+
+
+def clone_file(source, target):
+    """
+    Copies the file `source` to `target` as a reflink, which shares the data
+    until either file is written, when the file system supports it.
+    Otherwise, the data is copied.
+    """
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    copystat(source, target)
+
+
+def clone_tree(source, target):
+    """
+    Creates a copy of the directory tree `source` to `target`. Files are
+    reflinked or copied, never hardlinked, so writing to a file in `target`
+    doesn't change `source`.
+    """
+    for dirpath, dirnames, filenames in walk(source):
+        reldir = relpath(dirpath, source)
+        makedirs(join(target, reldir), exist_ok=True)
+        for name in filenames + [d for d in dirnames if islink(join(dirpath, d))]:
+            src, dst = join(dirpath, name), join(target, reldir, name)
+            if islink(src):
+                symlink(readlink(src), dst)
+            else:
+                clone_file(src, dst)
+
+
+def prepare_next_build_dir(project_path, clean=False, seed=SEED_LINK):
+    """
+    Creates an empty next build directory and returns its path. Without
+    `clean`, the directory is seeded with the current output, so incremental
+    tools can skip unchanged files. With SEED_LINK, the files are hardlinks
+    to the current output, so they must be replaced, not written to, as the
+    current output would be modified too. With SEED_COPY, the files are
+    reflinked, when the file system supports it, or copied.
+    """
+    path = join(project_path, NEXT_DIR)
+    if exists(path):
+        # the output of a failed or an interrupted build
+        move_to_trash(project_path, path)
+    current = join(project_path, BUILD_DIR)
+    if not clean and isdir(current):
+        if seed == SEED_COPY:
+            clone_tree(current, path)
+        else:
+            link_tree(current, path)
+    else:
+        makedirs(path)
+    empty_trash(project_path)
+    return path
+
+
+def exchange(a, b):
+    """
+    Swaps the paths `a` and `b` atomically with renameat2(RENAME_EXCHANGE).
+    Raises OSError, if it's not supported by the system or the file system.
+    """
+    try:
+        renameat2 = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).renameat2
+    except (AttributeError, OSError, TypeError) as err:
+        raise OSError(errno.ENOSYS, "renameat2 is not available: {}".format(err))
+    if renameat2(AT_FDCWD, fsencode(a), AT_FDCWD, fsencode(b), RENAME_EXCHANGE) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, errno.errorcode.get(code, str(code)))
+
+
+def swap_build_dir(project_path):
+    """
+    Replaces the build directory with the next build directory. The previous
+    output is deleted in the background. Without renameat2, the build
+    directory is missing for the moment between two renames.
+    """
+    current = join(project_path, BUILD_DIR)
+    path = join(project_path, NEXT_DIR)
+    if isdir(current):
+        try:
+            exchange(path, current)
+        except OSError as err:
+            logger.debug("Failed to exchange %s and %s: %s", path, current, err)
+            move_to_trash(project_path, current)
+            rename(path, current)
+        else:
+            move_to_trash(project_path, path)
+    else:
+        rename(path, current)
+    empty_trash(project_path)
+    return current
@@ -1,35 +1,357 @@
-from os import environ, getuid, getegid, mkdir
-from os.path import isdir
-from shutil import rmtree
+import asyncio
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import environ, getuid, getegid
+from os.path import abspath, isdir, join
+from threading import Lock
+from time import perf_counter
 
 from apluslms_yamlidator.utils.decorator import cached_property
 from apluslms_yamlidator.utils.collections import OrderedDict
 
 from .backends import (
     BACKENDS,
+    AsyncBackend,
     BackendContext,
     BuildResult,
     BuildStep,
     BuildTask,
+    SyncBackendAdapter,
 )
-from .observer import StreamObserver
+from .build_path import (
+    BUILD_DIRS,
+    NEXT_DIR,
+    SEED_COPY,
+    SEED_LINK,
+    prepare_build_dir,
+    prepare_next_build_dir,
+    swap_build_dir,
+)
+from .manifest import FileIndex
+from .metrics import observe_build, observe_step
+from .observer import Phase, PhaseObserver, StreamObserver
+from .profiling import profile_phase
+from .step_cache import CachingStepRunner
+from .tracing import span
 from .utils.importing import import_string
 from .utils.translation import _
+from .watcher import matches_inputs
+
+
+logger = logging.getLogger(__name__)
+
+def run_coroutine(coro):
+    """Runs the coroutine to completion in a new event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def get_step_dependencies(steps):
+    """
+    Returns a dict, which maps each step to a set of steps it waits for.
+    A step without `depends_on` waits for the previous step, so builds stay
+    sequential by default. References to steps not in `steps` are ignored.
+    """
+    by_ref = {}
+    for step in steps:
+        by_ref[step.ref] = step
+        if step.name:
+            by_ref[step.name.lower()] = step
+
+    deps = {}
+    previous = None
+    for step in steps:
+        if step.depends_on is None:
+            deps[step] = {previous} if previous else set()
+        else:
+            refs = (int(ref) if isinstance(ref, int) or ref.isdigit() else ref.lower()
+                for ref in step.depends_on)
+            deps[step] = {by_ref[ref] for ref in refs if ref in by_ref}
+        previous = step
+    return deps
+
+
+def get_changed_steps(steps, paths):
+    """
+    Returns the steps to build after the project files in `paths` changed:
+    the steps with matching `inputs`, the steps without `inputs` and the steps
+    depending on those. All steps are returned, if `paths` is None.
+    """
+    if paths is None:
+        return list(steps)
+    deps = get_step_dependencies(steps)
+    changed = {step for step in steps if step.inputs is None
+        or any(matches_inputs(path, step.inputs) for path in paths)}
+    added = True
+    while added:
+        added = {step for step in steps if step not in changed and deps[step] & changed}
+        changed |= added
+    return [step for step in steps if step in changed]
+
+
+class AtomicBuildError(Exception):
+    pass
+
+
+def check_atomic(steps):
+    """
+    Raises AtomicBuildError, if some of the steps can't be built atomically.
+    Steps with `mnt` would write to the served _build instead of _build.next.
+    """
+    mounted = [str(step) for step in steps if step.mnt]
+    if mounted:
+        raise AtomicBuildError(_("Steps with mnt write to the project directory, so "
+            "they can't be built atomically: {}").format(', '.join(mounted)))
+
+
+class StepScheduler:
+    """
+    Builds steps with backend.build_step in a pool of `jobs` threads.
+    A step is started when all of its dependencies have succeeded. When a step
+    fails, no new steps are started and the running ones are cancelled.
+
+    In a pipelined build, `prepared` maps steps to futures of their
+    preparation results. A step is started only after its future has
+    completed and a failed preparation fails the build.
+
+    With a ResourceBudget, a started step waits until its `cpus` and `memory`
+    fit in the budget.
+    """
+
+    def __init__(self, backend, task, observer, jobs=1, prepared=None, budget=None):
+        self.backend = backend
+        self.task = task
+        self.observer = observer
+        self.jobs = max(1, jobs)
+        self.prepared = prepared or {}
+        self.budget = budget
+        self._lock = Lock()
+        self._running = {}
+        self._cancelled = False
+        self._stopping = False
+
+    def _is_prepared(self, step):
+        future = self.prepared.get(step)
+        return future is None or future.done()
+
+    def _failed_preparation(self, steps):
+        for step in steps:
+            future = self.prepared.get(step)
+            if future is not None and future.done():
+                result = future.result()
+                if not result.ok:
+                    return result
+        return None
+
+    def _cancel_running(self):
+        with self._lock:
+            self._stopping = True
+            steps = list(self._running.values())
+        for step in steps:
+            self.backend.cancel_step(step)
+
+    def cancel(self):
+        """
+        Stops starting new steps and cancels the running ones.
+        Can be called from other threads.
+        """
+        with self._lock:
+            self._cancelled = True
+        self._cancel_running()
+
+    def _build_step(self, task, step, observer):
+        start = perf_counter()
+        with span('step {}'.format(step), 'step', image=step.img), profile_phase('build'):
+            result = self._build_step_in_budget(task, step, observer)
+        observe_step(step, result, perf_counter() - start)
+        return result
+
+    def _build_step_in_budget(self, task, step, observer):
+        if self.budget is None or not (step.cpus or step.memory):
+            return self.backend.build_step(task, step, observer)
+        observer.step_pending(step)
+        lease = self.budget.try_acquire(step.cpus, step.memory)
+        if lease is None:
+            observer.manager_msg(step, "Waiting for resources")
+            lease = self.budget.acquire(step.cpus, step.memory,
+                cancelled=lambda: self._stopping)
+        if lease is None:
+            observer.step_cancelled(step)
+            return BuildResult(False, step=step)
+        try:
+            return self.backend.build_step(task, step, observer)
+        finally:
+            self.budget.release(lease)
+
+    def run(self):
+        task, observer = self.task, self.observer
+        deps = get_step_dependencies(task.steps)
+        pending = list(task.steps)
+        running = self._running
+        succeeded = set()
+        result = None
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            try:
+                while pending or running:
+                    if result is None and self._cancelled:
+                        result = BuildResult(False)
+                    if result is None:
+                        result = self._failed_preparation(pending)
+                        if result is not None:
+                            self._cancel_running()
+                    if result is None:
+                        for step in [s for s in pending
+                                if deps[s] <= succeeded and self._is_prepared(s)]:
+                            if len(running) >= self.jobs:
+                                break
+                            with self._lock:
+                                if self._cancelled:
+                                    break
+                                pending.remove(step)
+                                future = executor.submit(self._build_step, task, step, observer)
+                                running[future] = step
+                    waiting = set(running)
+                    if result is None:
+                        waiting.update(self.prepared[s] for s in pending
+                            if not self._is_prepared(s))
+                    if not waiting:
+                        if result is None and self._cancelled:
+                            # cancelled while starting steps
+                            continue
+                        break
+                    finished, _ = wait(waiting, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        if future not in running:
+                            # a preparation, which is handled above
+                            continue
+                        with self._lock:
+                            step = running.pop(future)
+                        step_result = future.result()
+                        if step_result.ok:
+                            succeeded.add(step)
+                        elif result is None:
+                            result = step_result
+                            self._cancel_running()
+            except BaseException:
+                self._cancel_running()
+                raise
+
+        if result is None and pending:
+            raise RuntimeError("Unable to resolve step dependencies for steps: {}"
+                .format(', '.join(str(s) for s in pending)))
+        return result or BuildResult()
+
+
+class AsyncStepScheduler(StepScheduler):
+    """
+    StepScheduler for an AsyncBackend. Steps are run as tasks in the current
+    event loop instead of threads. Steps waiting for a ResourceBudget poll it
+    without blocking the loop.
+    """
+
+    async def _build_step_async(self, task, step, observer):
+        start = perf_counter()
+        result = await self._build_step_in_budget_async(task, step, observer)
+        observe_step(step, result, perf_counter() - start)
+        return result
+
+    async def _build_step_in_budget_async(self, task, step, observer):
+        if self.budget is None or not (step.cpus or step.memory):
+            return await self.backend.build_step(task, step, observer)
+        observer.step_pending(step)
+        lease = self.budget.try_acquire(step.cpus, step.memory)
+        if lease is None:
+            observer.manager_msg(step, "Waiting for resources")
+        while lease is None:
+            if self._stopping:
+                observer.step_cancelled(step)
+                return BuildResult(False, step=step)
+            await asyncio.sleep(self.budget.POLL_INTERVAL)
+            lease = self.budget.try_acquire(step.cpus, step.memory)
+        try:
+            return await self.backend.build_step(task, step, observer)
+        finally:
+            self.budget.release(lease)
+
+    async def run(self):
+        backend, task, observer = self.backend, self.task, self.observer
+        deps = get_step_dependencies(task.steps)
+        pending = list(task.steps)
+        running = {}
+        succeeded = set()
+        result = None
+
+        try:
+            while pending or running:
+                if result is None:
+                    for step in [s for s in pending if deps[s] <= succeeded]:
+                        if len(running) >= self.jobs:
+                            break
+                        pending.remove(step)
+                        future = asyncio.ensure_future(
+                            self._build_step_async(task, step, observer))
+                        running[future] = step
+                if not running:
+                    break
+                finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    step_result = future.result()
+                    if step_result.ok:
+                        succeeded.add(step)
+                    elif result is None:
+                        result = step_result
+                        self._stopping = True
+                        for other in running.values():
+                            await backend.cancel_step(other)
+        except BaseException:
+            # includes asyncio.CancelledError
+            self._stopping = True
+            for step in running.values():
+                await backend.cancel_step(step)
+            if running:
+                await asyncio.wait(running)
+            raise
+
+        if result is None and pending:
+            raise RuntimeError("Unable to resolve step dependencies for steps: {}"
+                .format(', '.join(str(s) for s in pending)))
+        return result or BuildResult()
+
 
 class Builder:
     def __init__(self, engine, config, observer=None, environment=None):
         if not isdir(config.dir):
             raise ValueError(_("config.dir isn't a directory."))
         self.config = config
-        self.path = config.dir
+        self.path = abspath(config.dir)
         self._engine = engine
         self._observer = observer or StreamObserver()
         self._environment = environment or []
+        self._scheduler = None
+        self._cancelled = False
+
+    @cached_property
+    def source_index(self):
+        return FileIndex(self.path, exclude=BUILD_DIRS)
 
+    def get_changes(self):
+        """
+        Returns an IndexDiff of the project files (excluding _build) changed
+        since the previous call or the previous cached build.
+        """
+        diff = self.source_index.update()
+        self.source_index.save()
+        return diff
 
     def get_steps(self, refs: list = None):
-        steps = [BuildStep.from_config(i, step, self._environment)
-            for i, step in enumerate(self.config.steps)]
+        with span('steps.expand_env', steps=len(self.config.steps)), profile_phase('config'):
+            steps = [BuildStep.from_config(i, step, self._environment)
+                for i, step in enumerate(self.config.steps)]
         if refs:
             name_dict = {step.name: step for step in steps}
             refs = [int(ref) if ref.isdigit() else ref.lower() for ref in refs]
@@ -38,30 +360,154 @@ class Builder:
             steps = list(OrderedDict.fromkeys(steps))
         return steps
 
-    def build(self, step_refs: list = None, clean_build=False):
+    def _get_task(self, steps, atomic=False):
+        if atomic:
+            check_atomic(steps)
+            return BuildTask(self.path, steps, join(self.path, NEXT_DIR))
+        return BuildTask(self.path, steps)
+
+    def _prepare_build_path(self, clean_build, atomic=False):
+        # FIXME: add support for other build paths
+        if atomic:
+            seed = SEED_COPY if atomic == SEED_COPY else SEED_LINK
+            prepare_next_build_dir(self.path, clean_build, seed)
+        else:
+            prepare_build_dir(self.path, clean_build)
+
+    def _finish_build_path(self, result, atomic=False):
+        """Replaces the output with the next build directory, if the atomic build succeeded."""
+        if atomic and result.ok:
+            swap_build_dir(self.path)
+
+    def build(self, step_refs: list = None, clean_build=False, jobs=1, step_cache=None,
+            pipeline=False, budget=None, atomic=False):
+        """
+        Builds the steps. With `atomic`, the steps are built to _build.next,
+        which replaces _build only when the build succeeds. `atomic` can be
+        SEED_COPY to seed _build.next with copies instead of hardlinks.
+        """
         backend = self._engine.backend
+        self._cancelled = False
+        if isinstance(backend, AsyncBackend):
+            if step_cache is not None:
+                logger.warning("The step cache is not supported by async backends")
+            if pipeline:
+                logger.warning("Pipelined builds are not supported by async backends")
+            try:
+                return run_coroutine(self.build_async(step_refs, clean_build, jobs,
+                    atomic, budget))
+            except KeyboardInterrupt:
+                return BuildResult(False)
         observer = self._observer
         steps = self.get_steps(step_refs) # NOTE: may raise KeyError or IndexError
         try:
-            task = BuildTask(self.path, steps)
-            observer.enter_prepare()
-            result = backend.prepare(task, observer)
-            observer.result_msg(result)
-            if result.ok:
-                observer.enter_build()
-                # FIXME: add support for other build paths
-                if clean_build:
-                    if isdir('_build'):
-                        rmtree('_build')
-                if clean_build or not isdir('_build'):
-                    mkdir('_build')
-                result = backend.build(task, observer)
+            task = self._get_task(steps, atomic)
+            runner = backend
+            if step_cache is not None:
+                runner = CachingStepRunner(backend, step_cache, self.source_index)
+            if pipeline:
+                result = self._build_pipelined(runner, task, clean_build, jobs, budget, atomic)
+            else:
+                observer.enter_prepare()
+                with span('build.prepare'), profile_phase('prepare'):
+                    result = backend.prepare(task, observer)
                 observer.result_msg(result)
+                if result.ok:
+                    observer.enter_build()
+                    self._prepare_build_path(clean_build, atomic)
+                    with span('build.steps', jobs=jobs), profile_phase('build'):
+                        result = self._run_scheduler(
+                            StepScheduler(runner, task, observer, jobs, budget=budget))
+                    observer.result_msg(result)
+            self._finish_build_path(result, atomic)
+            if step_cache is not None:
+                runner.save()
+                step_cache.prune()
+            observe_build(result)
             observer.done(result)
         except KeyboardInterrupt:
             return BuildResult(False)
         return result
 
+    def _run_scheduler(self, scheduler):
+        self._scheduler = scheduler
+        try:
+            if self._cancelled:
+                scheduler.cancel()
+            return scheduler.run()
+        finally:
+            self._scheduler = None
+
+    def cancel(self):
+        """
+        Cancels the running build() from another thread. Steps being prepared
+        are completed, but no more steps are built.
+        """
+        self._cancelled = True
+        scheduler = self._scheduler
+        if scheduler is not None:
+            scheduler.cancel()
+
+    async def build_async(self, step_refs: list = None, clean_build=False, jobs=1,
+            atomic=False, budget=None):
+        """
+        Builds the project in the running event loop. Many builders can build
+        concurrently in a single loop. Steps of synchronous backends are run
+        in the default executor of the loop.
+        """
+        backend = self._engine.async_backend
+        observer = self._observer
+        steps = self.get_steps(step_refs) # NOTE: may raise KeyError or IndexError
+        task = self._get_task(steps, atomic)
+        observer.enter_prepare()
+        result = await backend.prepare(task, observer)
+        observer.result_msg(result)
+        if result.ok:
+            observer.enter_build()
+            self._prepare_build_path(clean_build, atomic)
+            result = await AsyncStepScheduler(backend, task, observer, jobs,
+                budget=budget).run()
+            observer.result_msg(result)
+        self._finish_build_path(result, atomic)
+        observe_build(result)
+        observer.done(result)
+        return result
+
+    def _prepare_step(self, task, step, observer):
+        with profile_phase('prepare'):
+            return self._engine.backend.prepare_step(task, step, observer)
+
+    def _build_pipelined(self, runner, task, clean_build, jobs, budget=None, atomic=False):
+        """
+        Prepares the steps in the background and builds each step as soon as
+        it has been prepared and its dependencies have succeeded.
+        """
+        backend = self._engine.backend
+        observer = self._observer
+        self._prepare_build_path(clean_build, atomic)
+        observer.enter_prepare()
+        prepare_observer = PhaseObserver(observer, Phase.PREPARE)
+        executor = ThreadPoolExecutor(max_workers=backend.prepare_jobs)
+        prepared = OrderedDict()
+        try:
+            for step in task.steps:
+                prepared[step] = executor.submit(
+                    self._prepare_step, task, step, prepare_observer)
+            observer.enter_build()
+            with span('build.steps', jobs=jobs, pipeline=True), profile_phase('build'):
+                result = self._run_scheduler(
+                    StepScheduler(runner, task, observer, jobs, prepared, budget))
+        finally:
+            # don't start preparing steps, which won't be built
+            for future in prepared.values():
+                future.cancel()
+            executor.shutdown()
+        for step, future in prepared.items():
+            if future.cancelled():
+                prepare_observer.step_cancelled(step)
+        observer.result_msg(result)
+        return result
+
 
 class BackendError(Exception):
 
@@ -71,7 +517,13 @@ class BackendError(Exception):
 
 
 class Engine:
-    def __init__(self, backend_class=None, settings=None):
+    """
+    Creates the backend. Backend options are read from the settings and from
+    the variables of `env`, which defaults to the environment of the process,
+    prefixed with the name of the backend, e.g. DOCKER_.
+    """
+
+    def __init__(self, backend_class=None, settings=None, env=None):
         backend_name = None
         if backend_class is None:
             if settings and 'backend' in settings:
@@ -100,7 +552,9 @@ class Engine:
                 for k, v in settings['backends'][backend_name].items()
                 if k != 'type'})
         # environment
-        options.update({k: v for k, v in environ.items() if k.startswith(prefix)})
+        env = environ if env is None else env
+        self.backend_environ = {k: v for k, v in env.items() if k.startswith(prefix)}
+        options.update(self.backend_environ)
         # command line
         if settings:
             options.update({prefix + k.replace('-', '_').upper(): v
@@ -112,11 +566,27 @@ class Engine:
     def backend(self):
         return self._backend_class(self._backend_context)
 
+    @cached_property
+    def async_backend(self):
+        backend = self.backend
+        if isinstance(backend, AsyncBackend):
+            return backend
+        return SyncBackendAdapter(backend)
+
+    def _call(self, name, *args):
+        result = getattr(self.backend, name)(*args)
+        if isinstance(self.backend, AsyncBackend):
+            result = run_coroutine(result)
+        return result
+
     def verify(self):
-        return self.backend.verify()
+        return self._call('verify')
 
     def version_info(self):
-        return self.backend.version_info()
+        return self._call('version_info')
+
+    def cleanup(self, force=False):
+        return self._call('cleanup', force)
 
     def create_builder(self, *args, **kwargs):
         return Builder(self, *args, **kwargs)
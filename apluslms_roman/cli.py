@@ -1,27 +1,58 @@
 import argparse
 import logging
-from collections import namedtuple
+import re
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from glob import glob
 from itertools import chain
-from os import chdir, getcwd
-from os.path import abspath, basename, expanduser, expandvars, join as path_join
-from sys import executable, exit as _exit, stderr, stdout
+from os import chdir, getcwd, getegid, getuid
+from os.path import abspath, basename, expanduser, expandvars, isdir, join as path_join, relpath
+from sys import argv as sys_argv, executable, exit as _exit, stderr, stdout
+from threading import RLock, Thread
+from time import localtime, strftime, time
 
 from apluslms_yamlidator.document import Document
 from apluslms_yamlidator.utils.yaml import rt_dump as yaml_dump
 from apluslms_yamlidator.validator import ValidationError, render_error
 
 from . import __version__
-from .builder import BackendError, Engine
+from .backends.fake import ReplayRecorder
+from .build_path import SEED_LINK, SEED_MODES
+from .builder import AtomicBuildError, BackendError, Engine, check_atomic, get_changed_steps
 from .configuration import ProjectConfig, ProjectConfigError
-from .observer import StreamObserver
+from .daemon import (
+    SOCKET_ENV,
+    BuildDaemon,
+    BuildService,
+    DaemonError,
+    EventObserver,
+    forward_to_daemon,
+)
+from .log_buffer import QuietSuccessObserver
+from .log_store import LogRecorder, LogStore
+from .metrics import MetricsServer, export_textfile
+from .observer import JsonLinesObserver, StreamObserver
+from .profiling import (
+    PROFILE_MODES,
+    get_profiler,
+    profile_phase,
+    start_profiling,
+    stop_profiling,
+)
+from .resources import ResourceBudget, parse_size
 from .settings import GlobalSettings
+from .step_cache import StepCache
+from .tracing import span, trace_to
 from .utils.env import EnvDict, EnvError
 from .utils.translation import _
+from .watcher import create_watcher, wait_for_changes
 
 
 LOG_LEVELS = [logging.WARNING, logging.INFO, logging.DEBUG]
+OUTPUT_FORMATS = ('text', 'jsonl')
+# seconds to wait for more changes in watch mode
+WATCH_DEBOUNCE = 0.5
 logger = logging.getLogger(__name__)
 
 
@@ -38,6 +69,16 @@ def warning(message):
     print(_("WARNING: %s") % (message,), file=stderr)
 
 
+def positive_int(value):
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError(_("expected a positive integer"))
+    return value
+
+
 _ActionContext = namedtuple('ActionContext',
     ('parser', 'args', 'settings', 'action'))
 class ActionContext(_ActionContext):
@@ -49,7 +90,16 @@ class ActionContext(_ActionContext):
         return action.__name__
 
     def run(self):
-        return self.action(self)
+        profiler = get_profiler()
+        if profiler is None:
+            return self.action(self)
+        try:
+            with profile_phase('action'):
+                return self.action(self)
+        finally:
+            stop_profiling()
+            profiler.save()
+            print(_("Wrote profiles to {}").format(profiler.path), file=stderr)
 
 
 class CallbackSubParsersAction(argparse._SubParsersAction):
@@ -140,6 +190,24 @@ class CallbackArgumentParser(argparse.ArgumentParser):
             parser.set_defaults(**defaults)
 
 
+class ParserExit(Exception):
+    def __init__(self, status=0, message=None):
+        super().__init__(message)
+        self.status = status
+
+
+class DaemonArgumentParser(CallbackArgumentParser):
+    """
+    Raises ParserExit instead of printing and exiting, as the daemon parses
+    commands of its clients.
+    """
+    def exit(self, status=0, message=None):
+        raise ParserExit(status, message)
+
+    def error(self, message):
+        raise ParserExit(2, message)
+
+
 ## The command-line interface
 
 # a basic parser interface
@@ -151,12 +219,12 @@ def configure_logging():
     )
 
 
-def create_parser(version=__version__,
+def create_parser(version=__version__, parser_class=CallbackArgumentParser,
                   **kwargs):
     # the parser
     kwargs.setdefault('description', _("A project material builder"))
     #parser = argparse.ArgumentParser(**kwargs)
-    parser = CallbackArgumentParser(**kwargs)
+    parser = parser_class(**kwargs)
 
     if parser.prog == '__main__.py':
         parser.prog = "{} -m {}".format(
@@ -175,6 +243,19 @@ def create_parser(version=__version__,
     parser.add_argument('--debug',
         action='store_true',
         help=_("show all logged messages"))
+    parser.add_argument('--no-daemon',
+        action='store_true',
+        help=_("build in this process, even if a roman daemon is running"))
+    parser.add_argument('--profile',
+        nargs='?',
+        const='cpu',
+        choices=PROFILE_MODES,
+        help=_("profile roman itself with cProfile (cpu, the default) or "
+            "tracemalloc (mem) and write a report per phase to --profile-dir"))
+    parser.add_argument('--profile-dir',
+        metavar=_('DIR'),
+        default='roman-profile',
+        help=_("write profiles to DIR (default: %(default)s)"))
     # setting file support
 
     # global roman settings (user settings)
@@ -201,8 +282,16 @@ def create_parser(version=__version__,
     return parser
 
 
+def normalize_args(args):
+    """Allows --profile without a value before the action, e.g. `roman --profile build`."""
+    return ['--profile=cpu' if arg == '--profile' else arg for arg in args]
+
+
 def parse_actioncontext(parser, *, args=None):
-    args = parser.parse_args(args=args)
+    args = parser.parse_args(args=normalize_args(sys_argv[1:] if args is None else args))
+    if args.profile:
+        # before changing the directory
+        start_profiling(args.profile, abspath(args.profile_dir))
 
     # set logging level
     max_level = len(LOG_LEVELS)-1
@@ -223,7 +312,8 @@ def parse_actioncontext(parser, *, args=None):
     logger.debug(_("Loading settings from '%s'"), config)
 
     try:
-        settings = GlobalSettings.load(config, allow_missing=True)
+        with profile_phase('settings'):
+            settings = GlobalSettings.load(config, allow_missing=True)
     except ValidationError as e:
         exit(1, '\n'.join(render_error(e)))
     except OSError as e:
@@ -244,6 +334,19 @@ def parse_actioncontext(parser, *, args=None):
 # parser configuration for roman cli
 
 def add_cli_actions(parser):
+    def add_quiet_args(build):
+        build.add_argument('--quiet-success', action='store_true',
+            help=_("show the output of a step only when the step fails"))
+        build.add_argument('--failure-tail', metavar=_('N'), type=positive_int,
+            help=_("with --quiet-success, show only the last N lines of a failed step"))
+
+    def add_atomic_args(build):
+        build.add_argument('--atomic', action='store_true',
+            help=_("build to _build.next and replace _build with it, when the build succeeds"))
+        build.add_argument('--atomic-seed', choices=SEED_MODES, default=SEED_LINK,
+            help=_("start _build.next with hardlinks to or copies of the files in _build "
+                "(default: %(default)s)"))
+
     def add_env_args(env):
         env.add_argument('-d', '--delete', action='append',
             help=_("delete value from environment"))
@@ -277,12 +380,45 @@ def add_cli_actions(parser):
             "order (use either index or step name)"))
     build.add_argument('--no-color', action='store_true',
         help=_("print output with no colors"))
+    build.add_argument('--cache', action='store_true',
+        help=_("reuse outputs of unchanged steps from the step cache"))
+    build.add_argument('-j', '--jobs', metavar=_('N'), type=positive_int, default=1,
+        help=_("build up to N steps in parallel, when their dependencies allow it"))
+    build.add_argument('--pipeline', action='store_true',
+        help=_("start building steps while images for later steps are downloaded"))
+    build.add_argument('-w', '--watch', action='store_true',
+        help=_("build again, when project files change"))
+    add_atomic_args(build)
+    build.add_argument('--record', metavar=_('FILE'),
+        help=_("record the step times and output to FILE for the fake backend"))
+    build.add_argument('--trace', metavar=_('FILE'),
+        help=_("write a timeline of the build to FILE in the Chrome trace event format"))
+    build.add_argument('--output', choices=OUTPUT_FORMATS, default='text',
+        help=_("print the progress as text or as a JSON object per line (default: text)"))
+    add_quiet_args(build)
 
     # build is the default callback. set defaults for it
     build.copy_defaults_to(parser)
     parser.set_callback(build_action)
 
 
+    build_many = parser.add_parser('build-many',
+        callback=build_many_action,
+        help=_("build multiple projects in parallel"))
+    build_many.add_argument('directories', metavar=_('DIR'), nargs='+',
+        help=_("project directories (glob patterns are expanded)"))
+    build_many.add_argument('--clean', action='store_true',
+        help=_("delete old build files before building"))
+    build_many.add_argument('--cache', action='store_true',
+        help=_("reuse outputs of unchanged steps from the step cache"))
+    add_atomic_args(build_many)
+    build_many.add_argument('--no-color', action='store_true',
+        help=_("print output with no colors"))
+    build_many.add_argument('-j', '--jobs', metavar=_('N'), type=positive_int, default=1,
+        help=_("build up to N projects in parallel"))
+    add_quiet_args(build_many)
+
+
     parser.add_parser('init',
         callback=init_action,
         help=("create roman settings file in current directory"))
@@ -368,6 +504,43 @@ def add_cli_actions(parser):
         validate_schema.add_argument('data_files', metavar='file', nargs='+',
             help=_("a YAML/JSON file(s) to be validated"))
 
+    daemon = parser.add_parser('daemon',
+        callback=daemon_action,
+        help=_("run a build server, which keeps settings and backends loaded "
+            "between builds"))
+    daemon.add_argument('--socket', metavar=_('PATH'),
+        help=_("listen on the Unix socket PATH (clients use ${} or "
+            "a socket in the cache directory)").format(SOCKET_ENV))
+    daemon.add_argument('--metrics-port', metavar=_('PORT'), type=positive_int,
+        help=_("serve Prometheus metrics at http://127.0.0.1:PORT/metrics"))
+
+    logs = parser.add_parser('logs',
+        callback=logs_action,
+        help=_("show the stored output of previous builds"))
+    logs.add_argument('build', metavar=_('BUILD'), nargs='?',
+        help=_("a build id or its unique prefix (default: the latest build of the "
+            "project in the working directory)"))
+    logs.add_argument('step', metavar=_('STEP'), nargs='?',
+        help=_("show only the output of the step with this index or name"))
+    logs.add_argument('--grep', metavar=_('RE'),
+        help=_("show only the lines matching the regular expression RE"))
+    logs.add_argument('--tail', metavar=_('N'), type=positive_int,
+        help=_("show only the last N lines (or matches) of each step"))
+    logs.add_argument('--list', action='store_true',
+        help=_("list the stored builds"))
+
+    cache = parser.add_parser('cache',
+        help=_("manage the build step cache"))
+    with cache.use_subparsers(title=_("Cache actions")):
+        cache.add_parser('stats',
+            callback=cache_stats_action,
+            help=_("show the size of the step cache"))
+        prune = cache.add_parser('prune',
+            callback=cache_prune_action,
+            help=_("remove least recently used entries over the size limit"))
+        prune.add_argument('-a', '--all', action='store_true',
+            help=_("remove all entries"))
+
     backend = parser.add_parser('backend',
         help=_("backend actions"))
     with backend.use_subparsers(title=_("Backend actions")):
@@ -387,14 +560,26 @@ def add_cli_actions(parser):
     return parser
 
 
+# commands with these arguments are never sent to a daemon
+NO_DAEMON_ARGS = ('--no-daemon', '-h', '--help', '-V', '--version')
+
+
 def main(*, args=None):
     """
     CLI main function:
+    0. forward the command to a daemon, if one is running
     1. parse arguments
     2. execute action with the arguments
     3. exit with the code from the action
     """
     configure_logging()
+    if args is None:
+        args = sys_argv[1:]
+    # profiles of this process would not include a build run by the daemon
+    if not any(arg in NO_DAEMON_ARGS or arg.startswith('--profile') for arg in args):
+        code = forward_to_daemon(args, stream=stdout, err_stream=stderr)
+        if code is not None:
+            exit(code)
     parser = create_parser()
     add_cli_actions(parser)
     context = parse_actioncontext(parser, args=args)
@@ -452,7 +637,7 @@ def report_save(output):
         print("File created.")
 
 
-def verify_engine(engine, only_when_error=False):
+def verify_engine(engine, only_when_error=False, file=None):
     error = engine.verify()
     if error:
         print(_(
@@ -461,9 +646,9 @@ def verify_engine(engine, only_when_error=False):
                 engine.backend.__module__,
                 engine.backend.__class__.__name__,
                 error,
-        ))
+        ), file=file)
         if hasattr(engine.backend, 'debug_hint'):
-            print("\n" + engine.backend.debug_hint)
+            print("\n" + engine.backend.debug_hint, file=file)
         return False
     if not only_when_error:
         print(_(
@@ -475,6 +660,69 @@ def verify_engine(engine, only_when_error=False):
     return True
 
 
+def get_atomic(args):
+    """Returns the atomic option of Builder.build: False or the seed mode."""
+    return args.atomic_seed if args.atomic else False
+
+
+def get_message_file(args):
+    """
+    Returns the file for messages to the user: stderr, when stdout is used
+    for the events of --output=jsonl, otherwise None for stdout.
+    """
+    return stderr if getattr(args, 'output', 'text') != 'text' else None
+
+
+def get_colors(args):
+    """Returns the colors option of StreamObserver: off or only on a TTY."""
+    return False if args.no_color else None
+
+
+def create_observer(args, **kwargs):
+    if getattr(args, 'output', None) == 'jsonl':
+        observer = JsonLinesObserver(lock=kwargs.get('lock'))
+    else:
+        observer = StreamObserver(colors=get_colors(args), **kwargs)
+    if args.quiet_success:
+        observer = QuietSuccessObserver(observer, tail=args.failure_tail)
+    return observer
+
+
+def get_log_store(settings):
+    return LogStore(keep=settings.mlget('logs.keep', None))
+
+
+def record_logs(settings, config, observer):
+    """Wraps the observer with a LogRecorder, unless storing logs is disabled."""
+    store = get_log_store(settings)
+    if not store.keep:
+        return observer
+    return LogRecorder(observer, store, abspath(config.dir))
+
+
+def get_step_cache(context):
+    size = context.settings.mlget('cache.size', None)
+    return StepCache(max_size=int(size) * 2**20 if size else None)
+
+
+def parse_resource_budget(settings):
+    """Returns a ResourceBudget or None, if not configured. May raise ValueError."""
+    cpus = settings.mlget('resources.cpus', None)
+    memory = settings.mlget('resources.memory', None)
+    if cpus is None and memory is None:
+        return None
+    return ResourceBudget(
+        cpus=float(cpus) if cpus is not None else None,
+        memory=parse_size(memory))
+
+
+def get_resource_budget(context):
+    try:
+        return parse_resource_budget(context.settings)
+    except ValueError as err:
+        exit(1, _("Invalid resource budget: {}").format(err))
+
+
 def get_project_environment(context, config=None):
     if config is None:
         config = get_config(context)
@@ -549,10 +797,38 @@ def env_add(env, args):
 
 # actions
 
+def export_metrics(context, cwd=None):
+    """Adds the metrics to the textfile of the settings. Relative to `cwd`, if given."""
+    path = context.settings.mlget('metrics.textfile', None)
+    if not path:
+        return
+    path = expanduser(expandvars(path))
+    if cwd is not None:
+        path = path_join(cwd, path)
+    try:
+        export_textfile(path)
+    except OSError as err:
+        warning(_("Failed to write the metrics to {}: {}").format(path, err))
+
+
 def build_action(context):
-    config = get_config(context)
+    try:
+        if context.args.trace:
+            with trace_to(context.args.trace):
+                return run_build(context)
+        return run_build(context)
+    finally:
+        export_metrics(context)
+
+
+def run_build(context):
+    with span('config.load'):
+        config = get_config(context)
     engine = get_engine(context)
-    observer = StreamObserver(colors=not context.args.no_color)
+    observer = record_logs(context.settings, config, create_observer(context.args))
+    recorder = None
+    if context.args.record:
+        recorder = observer = ReplayRecorder(observer)
     builder = engine.create_builder(
         config,
         observer=observer,
@@ -563,30 +839,333 @@ def build_action(context):
         step_list_action(context)
         return 0
 
-    if not verify_engine(engine, only_when_error=True):
+    messages = get_message_file(context.args)
+    with span('backend.verify'):
+        verified = verify_engine(engine, only_when_error=True, file=messages)
+    if not verified:
         return 1
     if not config.steps:
-        print("Nothing to build.")
+        print(_("Nothing to build."), file=messages)
         return 1
 
     # build project
     steps = context.args.steps
     if steps:
-        steps = chain.from_iterable(step.split(',') for step in steps)
+        steps = list(chain.from_iterable(step.split(',') for step in steps))
 
     try:
-        result = builder.build(step_refs=steps, clean_build=context.args.clean)
+        if context.args.watch:
+            return watch_build(context, engine, config, steps)
+        result = builder.build(step_refs=steps, clean_build=context.args.clean,
+            jobs=context.args.jobs,
+            step_cache=get_step_cache(context) if context.args.cache else None,
+            pipeline=context.args.pipeline,
+            budget=get_resource_budget(context),
+            atomic=get_atomic(context.args))
     except KeyError as err:
         exit(1, _("No step named {}.").format(err.args[0]))
     except IndexError as err:
         exit(1, _("Index {} is out of range. There are {} steps. Indexing "
             "begins at 0.").format(err.args[0], len(config.steps)))
-    except EnvError as err:
+    except (AtomicBuildError, EnvError) as err:
         exit(1, str(err))
 
+    if recorder is not None:
+        try:
+            recorder.save(context.args.record)
+        except OSError as err:
+            exit(1, _("Failed to save the recording: {}").format(err))
     return result.code
 
 
+def watch_build(context, engine, config, step_refs):
+    """
+    Builds the project and then again after files change. Only the steps,
+    which use the changed files, are built. A build in progress is cancelled,
+    when more changes arrive.
+    """
+    args = context.args
+    messages = get_message_file(args)
+    step_cache = get_step_cache(context) if args.cache else None
+    budget = get_resource_budget(context)
+    watch = config.get('watch', {})
+    watcher = create_watcher(config.dir, watch.get('ignore', ()))
+    debounce = watch.get('debounce', WATCH_DEBOUNCE)
+
+    def create_builder(config):
+        builder = engine.create_builder(
+            config,
+            observer=record_logs(context.settings, config, create_observer(args)),
+            environment=get_project_environment(context, config),
+        )
+        steps = builder.get_steps(step_refs)
+        if args.atomic:
+            check_atomic(steps)
+        return builder, steps
+
+    def start_build(steps, clean_build=False):
+        thread = Thread(target=builder.build, kwargs=dict(
+            step_refs=[str(step.ref) for step in steps],
+            clean_build=clean_build,
+            jobs=args.jobs,
+            step_cache=step_cache,
+            pipeline=args.pipeline,
+            budget=budget,
+            atomic=get_atomic(args),
+        ))
+        thread.start()
+        return thread
+
+    builder, selected = create_builder(config)
+    thread = start_build(selected, args.clean)
+    try:
+        while True:
+            changes = wait_for_changes(watcher, debounce)
+            if thread.is_alive():
+                print(_("\nFiles changed, cancelling the build"), file=messages)
+                builder.cancel()
+                thread.join()
+            if changes is None or relpath(config.path, config.dir) in changes:
+                try:
+                    config = ProjectConfig.load(config.path)
+                    builder, selected = create_builder(config)
+                except (ValidationError, ProjectConfigError, KeyError, IndexError,
+                        AtomicBuildError, EnvError) as err:
+                    error = render_error(err) if isinstance(err, ValidationError) else [str(err)]
+                    print(_("Invalid project configuration: {}").format('\n'.join(error)),
+                        file=messages)
+                    continue
+                changes = None
+            steps = get_changed_steps(selected, changes)
+            if not steps:
+                continue
+            print(_("\nRebuilding steps: {}\n").format(', '.join(str(s) for s in steps)),
+                file=messages)
+            thread = start_build(steps)
+    except KeyboardInterrupt:
+        builder.cancel()
+    finally:
+        thread.join()
+        watcher.close()
+    return 0
+
+
+def build_many_action(context):
+    try:
+        return run_build_many(context)
+    finally:
+        export_metrics(context)
+
+
+def run_build_many(context):
+    directories = []
+    for pattern in context.args.directories:
+        pattern = expanduser(expandvars(pattern))
+        directories.extend(abspath(p) for p in sorted(glob(pattern)) if isdir(p))
+    directories = list(OrderedDict.fromkeys(directories))
+    if not directories:
+        print(_("No project directories found."))
+        return 1
+
+    engine = get_engine(context)
+    if not verify_engine(engine, only_when_error=True):
+        return 1
+    step_cache = get_step_cache(context) if context.args.cache else None
+    budget = get_resource_budget(context)
+    names = [d if relpath(d).startswith('..') else relpath(d) for d in directories]
+    width = max(len(name) for name in names)
+    lock = RLock()
+
+    def print_error(name, err):
+        error = render_error(err) if isinstance(err, ValidationError) else [str(err)]
+        with lock:
+            for line in '\n'.join(error).splitlines():
+                print("{:{}} | {}".format(name, width, line))
+
+    # configurations are loaded in this thread, as loading the schemas isn't thread safe
+    results = OrderedDict()
+    builders = OrderedDict()
+    for path, name in zip(directories, names):
+        start = time()
+        try:
+            config = ProjectConfig.find_from(path)
+            if not config.steps:
+                results[name] = (_("nothing to build"), 0, time() - start)
+                continue
+            observer = create_observer(context.args,
+                prefix="{:{}} | ".format(name, width),
+                lock=lock)
+            builders[name] = engine.create_builder(
+                config,
+                observer=record_logs(context.settings, config, observer),
+                environment=get_project_environment(context, config),
+            )
+        except (FileNotFoundError, ProjectConfigError, ValidationError, EnvError) as err:
+            print_error(name, err)
+            results[name] = (_("invalid configuration"), 1, time() - start)
+
+    def build_project(name, builder):
+        start = time()
+        try:
+            result = builder.build(clean_build=context.args.clean,
+                step_cache=step_cache, budget=budget, atomic=get_atomic(context.args))
+        except (AtomicBuildError, EnvError) as err:
+            print_error(name, err)
+            return _("invalid configuration"), 1, time() - start
+        except Exception as err:
+            # e.g. an error of the backend, which shouldn't stop the other builds
+            logger.debug("Failed to build %s", name, exc_info=True)
+            print_error(name, err)
+            return _("error"), 1, time() - start
+        return str(result), result.code or (0 if result.ok else 1), time() - start
+
+    with ThreadPoolExecutor(max_workers=context.args.jobs) as executor:
+        futures = OrderedDict((name, executor.submit(build_project, name, builder))
+            for name, builder in builders.items())
+        try:
+            for name, future in futures.items():
+                results[name] = future.result()
+        except KeyboardInterrupt:
+            for future in futures.values():
+                future.cancel()
+            for builder in builders.values():
+                builder.cancel()
+            raise
+
+    print()
+    print("{:{}}  {:>8}  {}".format(_('PROJECT'), width, _('TIME'), _('RESULT')))
+    for name in names:
+        message, code, duration = results[name]
+        print("{:{}}  {:>7.1f}s  {}".format(name, width, duration, message))
+    return 1 if any(result[1] for result in results.values()) else 0
+
+
+def handle_daemon_request(service, parser, request, send):
+    """
+    Builds a project for a client of the daemon. Returns the exit code or
+    None, when the client should run the command itself.
+    """
+    try:
+        args = parser.parse_args(request['argv'])
+    except ParserExit:
+        return None
+    if parser.get_callback(args) is not build_action or args.no_daemon or args.watch \
+            or args.record or args.trace or args.profile or args.output != 'text':
+        return None
+    if args.steps and any(step == '?' for step in args.steps):
+        return None
+    # backends run steps as the user and with the environment of the client
+    if 'env' not in request or (request.get('uid'), request.get('gid')) != (getuid(), getegid()):
+        return None
+
+    def error(message):
+        send({'event': 'output', 'text': message, 'stderr': True})
+        return 1
+
+    # the daemon serves many clients, so it never changes the working directory
+    path = path_join(request['cwd'], *(expanduser(expandvars(d)) for d in args.directory))
+    if args.config is not None:
+        settings_path = path_join(path, expanduser(expandvars(args.config)))
+    else:
+        settings_path = GlobalSettings.get_config_path()
+    try:
+        if GlobalSettings.namespace_has_values(args):
+            settings = GlobalSettings.load(settings_path, allow_missing=True)
+            settings.update_from_namespace(args)
+        else:
+            settings = service.get_settings(settings_path)
+        engine = service.get_engine(settings, request['env'])
+        budget = parse_resource_budget(settings)
+        if args.project_config:
+            config = ProjectConfig.load_from(
+                path_join(path, expanduser(expandvars(args.project_config))))
+        else:
+            config = ProjectConfig.find_from(path)
+    except ValidationError as err:
+        return error('\n'.join(render_error(err)))
+    except BackendError as err:
+        return error(_("ERROR: Unable to find backend '{}'.").format(err.backend))
+    except ProjectConfigError as err:
+        return error(_("Invalid project configuration: {}").format(err))
+    except (DaemonError, OSError, ValueError) as err:
+        return error(str(err))
+    if not config.steps:
+        return error(_("Nothing to build."))
+
+    context = ActionContext(parser, args, settings, build_action)
+    steps = args.steps
+    if steps:
+        steps = chain.from_iterable(step.split(',') for step in steps)
+    send({'event': 'start', 'colors': get_colors(args)})
+    observer = EventObserver(send)
+    if args.quiet_success:
+        observer = QuietSuccessObserver(observer, tail=args.failure_tail)
+    observer = record_logs(settings, config, observer)
+    try:
+        builder = engine.create_builder(
+            config,
+            observer=observer,
+            environment=get_project_environment(context, config),
+        )
+        with service.project_lock(config.dir):
+            result = builder.build(step_refs=steps, clean_build=args.clean,
+                jobs=args.jobs,
+                step_cache=get_step_cache(context) if args.cache else None,
+                pipeline=args.pipeline,
+                budget=budget,
+                atomic=get_atomic(args))
+    except KeyError as err:
+        return error(_("No step named {}.").format(err.args[0]))
+    except IndexError as err:
+        return error(_("Index {} is out of range. There are {} steps. Indexing "
+            "begins at 0.").format(err.args[0], len(config.steps)))
+    except (AtomicBuildError, EnvError) as err:
+        return error(str(err))
+    finally:
+        if service.textfile_metrics:
+            export_metrics(context, path)
+    return result.code
+
+
+def daemon_action(context):
+    parser = create_parser(parser_class=DaemonArgumentParser)
+    add_cli_actions(parser)
+    service = BuildService()
+    # the metrics are kept in the registry for the metrics server
+    service.textfile_metrics = not context.args.metrics_port
+    try:
+        # load the default settings and connect to the backend before serving
+        service.get_engine(service.get_settings(GlobalSettings.get_config_path()))
+    except (BackendError, DaemonError, ValidationError, OSError) as err:
+        warning(err)
+    try:
+        server = BuildDaemon(partial(handle_daemon_request, service, parser),
+            context.args.socket)
+    except (DaemonError, OSError) as err:
+        exit(1, str(err))
+    print(_("Listening on {}").format(server.path))
+    metrics_server = None
+    if context.args.metrics_port:
+        try:
+            metrics_server = MetricsServer(('127.0.0.1', context.args.metrics_port))
+        except OSError as err:
+            server.server_close()
+            exit(1, _("Unable to serve metrics: {}").format(err))
+        Thread(target=metrics_server.serve_forever, daemon=True).start()
+        print(_("Serving metrics at http://127.0.0.1:{}/metrics").format(
+            context.args.metrics_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+    return 0
+
+
 def init_action(context):
     project_config = context.args.project_config
     try:
@@ -865,6 +1444,97 @@ def validate_schema_action(context):
     return 0
 
 
+def cache_stats_action(context):
+    stats = get_step_cache(context).stats()
+    print(_("Entries: {}\nObjects: {}\nSize: {:.1f} MiB of {:.1f} MiB").format(
+        stats.entries, stats.objects, stats.size / 2**20, stats.max_size / 2**20))
+
+
+def cache_prune_action(context):
+    cache = get_step_cache(context)
+    freed = cache.prune(0 if context.args.all else None)
+    print(_("Removed {:.1f} MiB from the step cache.").format(freed / 2**20))
+
+
+def logs_list(store):
+    builds = store.list_builds()
+    if not builds:
+        print(_("No stored builds."))
+        return 0
+    width = max(len(build.id) for build in builds)
+    print("{:{}}  {:19}  {}".format(_('BUILD'), width, _('STARTED'), _('RESULT')))
+    for build in builds:
+        info = build.info
+        print("{:{}}  {:19}  {}\n  {}".format(build.id, width,
+            strftime('%Y-%m-%d %H:%M:%S', localtime(info['start'])),
+            info['result'] or _("unfinished"), info['project']))
+    return 0
+
+
+def print_lines(lines, prefix=None):
+    """Prints (line number, line) pairs. With `prefix`, lines are prefixed by it and the number."""
+    batch = []
+    for number, line in lines:
+        batch.append(line if prefix is None else "{}:{}: {}".format(prefix, number + 1, line))
+        if len(batch) >= 1000:
+            print('\n'.join(batch))
+            batch = []
+    if batch:
+        print('\n'.join(batch))
+
+
+def logs_action(context):
+    args = context.args
+    store = get_log_store(context.settings)
+    if args.list:
+        return logs_list(store)
+    cwd = getcwd()
+    build_ref, step_ref = args.build, args.step
+    if build_ref is not None and step_ref is None:
+        # a single argument is a step of the latest build, if there is such step
+        latest = store.get_build(cwd=cwd)
+        if latest is not None and latest.get_step(build_ref) is not None:
+            build_ref, step_ref = None, build_ref
+    build = store.get_build(build_ref, cwd=cwd)
+    if build is None:
+        if build_ref is None:
+            exit(1, _("No stored builds."))
+        exit(1, _("No single build matches {}. Use '{} logs --list' to list the builds.")
+            .format(build_ref, context.parser.prog))
+    steps = build.info['steps']
+    if step_ref is not None:
+        steps = [build.get_step(step_ref)]
+        if steps[0] is None:
+            exit(1, _("There is no output of step {} in build {}.").format(step_ref, build.id))
+    pattern = None
+    if args.grep is not None:
+        try:
+            pattern = re.compile(args.grep)
+        except re.error as err:
+            exit(1, _("Invalid regular expression {}: {}").format(args.grep, err))
+
+    matches = 0
+    try:
+        for step in steps:
+            with build.open_step(step) as log:
+                if pattern is not None:
+                    lines = log.grep(pattern)
+                    if args.tail is not None:
+                        lines = deque(lines, maxlen=args.tail)
+                    lines = list(lines)
+                    matches += len(lines)
+                    print_lines(lines, step['name'])
+                    continue
+                if len(steps) > 1:
+                    print(_("step {}").format(step['name']))
+                print_lines(log.tail(args.tail) if args.tail is not None else log.get_lines())
+                if len(steps) > 1:
+                    print()
+    except OSError as err:
+        exit(1, _("Failed to read the output of build {}: {}").format(build.id, err))
+    return 1 if pattern is not None and not matches else 0
+
+
 def backend_test_action(context, verbose=False):
     engine = get_engine(context)
     if not verify_engine(engine):
@@ -877,7 +1547,7 @@ def backend_test_action(context, verbose=False):
 
 def backend_clean_action(context):
     engine = get_engine(context)
-    engine.backend.cleanup(context.args.force)
+    engine.cleanup(context.args.force)
 
 
 if __name__ == '__main__':
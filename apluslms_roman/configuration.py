@@ -7,6 +7,8 @@ from apluslms_yamlidator.document import Document
 from apluslms_yamlidator.utils.collections import Mapping
 from apluslms_yamlidator.utils.version import Version
 
+from .profiling import profile_phase
+from .tracing import span
 from .utils.translation import _
 
 
@@ -36,7 +38,7 @@ class ProjectConfig(Document):
                 _("Path {} doesn't exist or is not a directory").format(path)
             )
 
-        file_ = next((file_ for file_ in files if isfile(file_)), None)
+        file_ = next((file_ for file_ in files if isfile(join(path, file_))), None)
         config = join(path, file_) if file_ else None
         if not config or not isfile(config):
             raise FileNotFoundError((
@@ -58,6 +60,10 @@ class ProjectConfig(Document):
         raise FileNotFoundError("Given file '{}' doesn't exist.".format(config))
 
     def validate(self, *args, **kwargs):
+        with span('config.validate'), profile_phase('config'):
+            self._validate(*args, **kwargs)
+
+    def _validate(self, *args, **kwargs):
         super().validate(*args, **kwargs)
         if not self.steps:
             return
@@ -67,6 +73,46 @@ class ProjectConfig(Document):
             raise ProjectConfigError(("Step names should be unique.\n"
                 "Following names were used more than once:\n  - {}")
                 .format('\n  - '.join(names)))
+        self._validate_dependencies()
+
+    def _validate_dependencies(self):
+        deps = []
+        for idx, step in enumerate(self.steps):
+            if not isinstance(step, (dict, Mapping)) or 'depends_on' not in step:
+                deps.append([idx - 1] if idx else [])
+                continue
+            step_deps = []
+            for ref in step['depends_on']:
+                try:
+                    dep = self.ref_to_index(str(ref))
+                except KeyError:
+                    dep = None
+                if dep is None or dep >= len(self.steps):
+                    raise ProjectConfigError(
+                        _("Step {} depends on an unknown step '{}'.").format(idx, ref))
+                step_deps.append(dep)
+            deps.append(step_deps)
+
+        # depth-first search for dependency cycles
+        visiting, visited = set(), set()
+        for root in range(len(deps)):
+            if root in visited:
+                continue
+            stack = [(root, iter(deps[root]))]
+            visiting.add(root)
+            while stack:
+                idx, it = stack[-1]
+                dep = next(it, None)
+                if dep is None:
+                    stack.pop()
+                    visiting.discard(idx)
+                    visited.add(idx)
+                elif dep in visiting:
+                    raise ProjectConfigError(
+                        _("Step {} has a circular dependency.").format(dep))
+                elif dep not in visited:
+                    visiting.add(dep)
+                    stack.append((dep, iter(deps[dep])))
 
     def add_step(self, step):
         if 'name' in step:
@@ -0,0 +1,249 @@
+"""
+A long running build server, which keeps the settings, engines and backend
+caches loaded between builds. The server listens on a Unix domain socket.
+
+The protocol is line delimited JSON. A client sends a single request
+{"argv": [...], "cwd": "...", "env": {...}, "uid": int, "gid": int} and the
+server replies with a stream of events:
+
+  {"event": "start", "colors": bool}    - the build was accepted, colors
+                                          are null when shown only on a TTY
+  {"event": "observer", ...}            - a BuildObserver message
+  {"event": "output", "text": str, "stderr": bool}
+  {"event": "exit", "code": int}        - the build is done
+  {"event": "unsupported"}              - the client should run the command
+"""
+import json
+import logging
+import socket
+from os import chmod, environ, getcwd, getegid, getuid, makedirs, remove, stat
+from os.path import dirname, exists, join
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+from threading import Lock
+
+from . import CACHE_DIR
+from .builder import Engine
+from .observer import BuildObserver, Message, Phase, StepState, StreamObserver, get_event
+from .settings import GlobalSettings
+from .utils.translation import _
+
+
+logger = logging.getLogger(__name__)
+
+SOCKET_ENV = 'ROMAN_DAEMON_SOCKET'
+
+
+class DaemonError(Exception):
+    pass
+
+
+def get_socket_path():
+    return environ.get(SOCKET_ENV) or join(CACHE_DIR, 'daemon.sock')
+
+
+def connect(path=None):
+    """Returns a socket connected to the daemon or None, if it isn't running."""
+    path = path or get_socket_path()
+    if not exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def is_running(path=None):
+    sock = connect(path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+class EventObserver(BuildObserver):
+    """Sends the observer messages as JSON compatible events with `send`."""
+
+    def __init__(self, send):
+        super().__init__()
+        self._send = send
+
+    def _message(self, phase, type_, step=None, state=None, data=None):
+        event = get_event(phase, type_, step, state, data)
+        event['event'] = 'observer'
+        self._send(event)
+
+
+def replay_event(observer, event):
+    """Passes an event from an EventObserver to another observer."""
+    phase = Phase[event['phase']]
+    type_ = Message[event['type']]
+    with observer._lock:
+        if type_ == Message.PHASE_UPDATE:
+            observer._phase_update(phase)
+        else:
+            state = StepState[event['state']] if event['state'] else None
+            observer._message(phase, type_, event['step'], state, event['data'])
+
+
+def forward_to_daemon(argv, cwd=None, path=None, stream=None, err_stream=None, env=None):
+    """
+    Sends the command to a running daemon and writes the build output to
+    `stream`. Returns the exit code or None, when no daemon is running or
+    the daemon doesn't handle the command. The backend is configured with
+    `env`, which defaults to the environment of this process.
+    """
+    sock = connect(path)
+    if sock is None:
+        return None
+    request = {
+        'argv': list(argv),
+        'cwd': cwd or getcwd(),
+        'env': dict(environ if env is None else env),
+        'uid': getuid(),
+        'gid': getegid(),
+    }
+    with sock, sock.makefile('rb') as reader:
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        observer = None
+        for line in reader:
+            event = json.loads(line.decode('utf-8'))
+            kind = event.get('event')
+            if kind == 'unsupported':
+                return None
+            elif kind == 'start':
+                observer = StreamObserver(stream, colors=event['colors'])
+            elif kind == 'observer' and observer is not None:
+                replay_event(observer, event)
+            elif kind == 'output':
+                out = err_stream if event.get('stderr') else stream
+                print(event['text'], file=out)
+            elif kind == 'exit':
+                return event['code']
+    if observer is None:
+        # the daemon was stopped before it replied
+        return None
+    print(_("Lost the connection to the roman daemon."), file=err_stream)
+    return 1
+
+
+class BuildService:
+    """
+    Keeps the settings and engines loaded between builds. Settings are loaded
+    again, when the settings file has been modified. With `textfile_metrics`,
+    the metrics are added to the textfile of the settings after each build.
+    """
+
+    def __init__(self):
+        self.textfile_metrics = True
+        self._lock = Lock()
+        self._settings = {}
+        self._engines = {}
+        self._project_locks = {}
+
+    def get_settings(self, path):
+        try:
+            mtime = stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            cached = self._settings.get(path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+        settings = GlobalSettings.load(path, allow_missing=True)
+        with self._lock:
+            self._settings[path] = (mtime, settings)
+        return settings
+
+    def get_engine(self, settings, env=None):
+        """
+        Returns a verified engine for the settings and the environment `env`
+        of the client. Engines are shared by clients with the same backend
+        variables in their environment. Raises DaemonError, if the backend
+        can't be used. May raise BackendError.
+        """
+        engine = Engine(settings=settings, env=env)
+        key = (id(settings), frozenset(engine.backend_environ.items()))
+        with self._lock:
+            cached = self._engines.get(key)
+            if cached and cached[0] is settings:
+                return cached[1]
+        error = engine.verify()
+        if error:
+            raise DaemonError(_("Container backend connection failed.\n\n{}").format(error))
+        with self._lock:
+            # drop engines of settings, which have been reloaded
+            active = {id(s) for _, s in self._settings.values()}
+            self._engines = {k: v for k, v in self._engines.items() if k[0] in active}
+            self._engines[key] = (settings, engine)
+        return engine
+
+    def project_lock(self, path):
+        """Returns a lock, which serializes builds of the project in `path`."""
+        with self._lock:
+            return self._project_locks.setdefault(path, Lock())
+
+
+class DaemonRequestHandler(StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return
+        lock = Lock()
+        connected = [True]
+
+        def send(event):
+            # the build continues, even if the client disconnects
+            data = (json.dumps(event, default=str) + '\n').encode('utf-8')
+            with lock:
+                if not connected[0]:
+                    return
+                try:
+                    self.wfile.write(data)
+                    self.wfile.flush()
+                except OSError:
+                    connected[0] = False
+
+        try:
+            code = self.server.handler(request, send)
+        except Exception as err:
+            logger.exception("Failed to handle the command %r", request.get('argv'))
+            send({'event': 'output', 'text': _("ERROR: {}").format(err), 'stderr': True})
+            code = 1
+        if code is None:
+            send({'event': 'unsupported'})
+        else:
+            send({'event': 'exit', 'code': code})
+
+
+class BuildDaemon(ThreadingMixIn, UnixStreamServer):
+    """
+    Serves requests of clients in threads. `handler(request, send)` runs the
+    request, sends events with `send` and returns the exit code or None, if
+    the request is not supported.
+    """
+    daemon_threads = True
+
+    def __init__(self, handler, path=None):
+        self.path = path or get_socket_path()
+        self.handler = handler
+        if exists(self.path):
+            if is_running(self.path):
+                raise DaemonError(_("A roman daemon is already listening on {}")
+                    .format(self.path))
+            # a stale socket of a stopped daemon
+            remove(self.path)
+        makedirs(dirname(self.path), exist_ok=True)
+        super().__init__(self.path, DaemonRequestHandler)
+        chmod(self.path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            remove(self.path)
+        except FileNotFoundError:
+            pass
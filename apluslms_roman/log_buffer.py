@@ -0,0 +1,136 @@
+"""
+Holds back the output of steps, so only the output of failed steps is shown.
+"""
+import gzip
+from collections import deque
+from tempfile import TemporaryFile
+
+from .observer import BuildObserver, Message, StepState
+
+
+class SpillBuffer:
+    """
+    Keeps the last lines of output in memory. When they exceed `memory_limit`
+    characters, the oldest half is moved to a gzip compressed temporary file,
+    so all lines are kept without using unbounded memory.
+    """
+    MEMORY_LIMIT = 2**20
+
+    def __init__(self, memory_limit=None):
+        self.memory_limit = memory_limit or self.MEMORY_LIMIT
+        self._lines = deque()
+        self._size = 0
+        self._file = None
+        self._writer = None
+        self.spilled = 0
+
+    def __len__(self):
+        return self.spilled + len(self._lines)
+
+    def extend(self, lines):
+        self._lines.extend(lines)
+        self._size += sum(len(line) + 1 for line in lines)
+        if self._size > self.memory_limit:
+            self._spill(self.memory_limit // 2)
+
+    def _spill(self, keep):
+        if self._file is None:
+            self._file = TemporaryFile(prefix='roman-log-')
+            # favour speed, the output is usually discarded
+            self._writer = gzip.GzipFile(fileobj=self._file, mode='wb', compresslevel=1)
+        spilled = []
+        while self._lines and self._size > keep:
+            line = self._lines.popleft()
+            self._size -= len(line) + 1
+            spilled.append(line)
+        self._writer.write(''.join(line + '\n' for line in spilled).encode('utf-8'))
+        self.spilled += len(spilled)
+
+    def _read_spilled(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._file.seek(0)
+        with gzip.GzipFile(fileobj=self._file, mode='rb') as reader:
+            for line in reader:
+                yield line.decode('utf-8')[:-1]
+
+    def get_lines(self, tail=None):
+        """Yields all lines or the last `tail` lines. Call only once."""
+        if tail is not None and tail <= len(self._lines):
+            yield from list(self._lines)[len(self._lines) - tail:]
+            return
+        if self.spilled:
+            spilled = self._read_spilled()
+            if tail is not None:
+                spilled = deque(spilled, maxlen=tail - len(self._lines))
+            yield from spilled
+        yield from self._lines
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._lines.clear()
+        self._size = 0
+
+
+class QuietSuccessObserver(BuildObserver):
+    """
+    Passes messages to `observer`, but holds back the output of each step in
+    a SpillBuffer. The output is discarded when the step succeeds or is
+    cancelled and shown before the failure, when the step fails. With
+    `tail`, only the last `tail` lines are shown.
+    """
+    BATCH_LINES = 1000
+
+    def __init__(self, observer, tail=None, memory_limit=None):
+        super().__init__()
+        self._observer = observer
+        self._lock = observer._lock
+        self.tail = tail
+        self.memory_limit = memory_limit
+        self._buffers = {}
+
+    def _message(self, phase, type_, step=None, state=None, data=None):
+        if type_ == Message.PHASE_UPDATE:
+            self._observer._phase_update(phase)
+            return
+        if type_ == Message.CONTAINER_MSG:
+            buffer = self._buffers.get(step)
+            if buffer is None:
+                buffer = self._buffers[step] = SpillBuffer(self.memory_limit)
+            buffer.extend(data)
+            return
+        if type_ == Message.STATE_UPDATE and state.completed and step in self._buffers:
+            buffer = self._buffers.pop(step)
+            try:
+                if state == StepState.FAILED:
+                    self._show(phase, step, buffer)
+            finally:
+                buffer.close()
+        self._observer._message(phase, type_, step, state, data)
+
+    def _show(self, phase, step, buffer):
+        observer = self._observer
+        if self.tail is not None and len(buffer) > self.tail:
+            observer._message(phase, Message.MANAGER_MSG, step, StepState.RUNNING,
+                ["Showing the last {} of {} lines of output".format(self.tail, len(buffer))])
+        batch = []
+        for line in buffer.get_lines(self.tail):
+            batch.append(line)
+            if len(batch) >= self.BATCH_LINES:
+                observer._message(phase, Message.CONTAINER_MSG, step, StepState.RUNNING, batch)
+                batch = []
+        if batch:
+            observer._message(phase, Message.CONTAINER_MSG, step, StepState.RUNNING, batch)
+
+    def done(self, data=None):
+        super().done(data)
+        for buffer in self._buffers.values():
+            buffer.close()
+        self._buffers.clear()
+        self._observer.done(data)
@@ -0,0 +1,178 @@
+"""
+Passes the output of a step from a backend to an observer.
+
+The output is decoded incrementally, so multibyte characters split between
+chunks are kept intact, and reassembled to lines. The lines are queued and
+delivered to the observer in batches by a separate thread, so a slow
+terminal doesn't slow down reading the output of the container.
+"""
+import codecs
+import logging
+from collections import deque
+from threading import Condition, Thread
+
+from .metrics import LOG_BYTES, LOG_DROPPED_LINES
+
+
+logger = logging.getLogger(__name__)
+
+# when the queue is full, wait for the observer
+BLOCK = 'block'
+# when the queue is full, drop new lines and report the number of them
+DROP = 'drop'
+LOG_POLICIES = (BLOCK, DROP)
+
+MAX_LINES = 10000
+MAX_LINE_LENGTH = 65536
+
+
+class LineSplitter:
+    """
+    Decodes chunks of UTF-8 and splits them to lines. A line longer than
+    `max_line_length` characters is split into many lines, so output without
+    newlines can't use unbounded memory.
+    """
+
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        self.max_line_length = max_line_length
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._partial = ''
+
+    def _split_long(self, lines):
+        limit = self.max_line_length
+        for line in lines:
+            while len(line) > limit:
+                yield line[:limit]
+                line = line[limit:]
+            yield line
+
+    def feed(self, data, final=False):
+        """Returns the lines completed by the bytes `data`, without newlines."""
+        limit = self.max_line_length
+        lines = (self._partial + self._decoder.decode(data, final)).split('\n')
+        partial = lines.pop()
+        if final and partial:
+            lines.append(partial)
+            partial = ''
+        while len(partial) > limit:
+            lines.append(partial[:limit])
+            partial = partial[limit:]
+        self._partial = partial
+        lines = [line[:-1] if line.endswith('\r') else line for line in lines]
+        if any(len(line) > limit for line in lines):
+            lines = list(self._split_long(lines))
+        return lines
+
+    def flush(self):
+        """Returns the rest of the output as lines."""
+        return self.feed(b'', final=True)
+
+
+class LogPipeline:
+    """
+    Delivers the output of `step` to `observer.container_msg` from a drain
+    thread. When `max_lines` lines are queued, the policy BLOCK makes feed()
+    wait and DROP discards the new lines. Dropped lines are counted and
+    reported to the observer on close().
+
+    Use as a context manager, which closes the pipeline:
+
+        with LogPipeline(observer, step) as log:
+            for chunk in stream:
+                log.feed(chunk)
+    """
+
+    def __init__(self, observer, step, policy=BLOCK, max_lines=MAX_LINES,
+            max_line_length=MAX_LINE_LENGTH):
+        if policy not in LOG_POLICIES:
+            raise ValueError("Unknown log policy {!r}, expected one of {}"
+                .format(policy, ', '.join(LOG_POLICIES)))
+        self.observer = observer
+        self.step = step
+        self.policy = policy
+        self.max_lines = max(1, int(max_lines))
+        self.lines = 0
+        self.bytes = 0
+        self.dropped_lines = 0
+        self.dropped_bytes = 0
+        self._splitter = LineSplitter(int(max_line_length))
+        self._queue = deque()
+        self._cond = Condition()
+        self._closed = False
+        self._error = None
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+
+    def feed(self, data):
+        """Adds a chunk of output bytes."""
+        self.bytes += len(data)
+        lines = self._splitter.feed(data)
+        if lines:
+            self._put(lines)
+
+    def _put(self, lines):
+        with self._cond:
+            if self._thread is None:
+                self._thread = Thread(target=self._drain,
+                    name='log {}'.format(self.step), daemon=True)
+                self._thread.start()
+            if self.policy == BLOCK:
+                while len(self._queue) >= self.max_lines and self._error is None:
+                    self._cond.wait()
+            elif len(self._queue) + len(lines) > self.max_lines:
+                self.dropped_lines += len(lines)
+                self.dropped_bytes += sum(len(line.encode('utf-8')) + 1 for line in lines)
+                return
+            self.lines += len(lines)
+            self._queue.extend(lines)
+            self._cond.notify_all()
+
+    def _drain(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                batch = list(self._queue)
+                self._queue.clear()
+                self._cond.notify_all()
+            if self._error is not None:
+                continue
+            try:
+                self.observer.container_msg(self.step, ''.join(line + '\n' for line in batch))
+            except Exception as err:
+                # keep draining, so feed() doesn't block forever
+                logger.exception("Failed to deliver the output of step %s", self.step)
+                with self._cond:
+                    self._error = err
+                    self._cond.notify_all()
+
+    def close(self, raise_errors=True):
+        """
+        Delivers the rest of the output and waits for the drain thread.
+        Re-raises an error of the observer, if `raise_errors` is true.
+        """
+        if self._closed:
+            return
+        lines = self._splitter.flush()
+        if lines:
+            self._put(lines)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        LOG_BYTES.inc(self.bytes, step=self.step)
+        if self.dropped_lines:
+            LOG_DROPPED_LINES.inc(self.dropped_lines, step=self.step)
+            self.observer.manager_msg(self.step,
+                "Dropped {} lines ({} bytes) of output, which could not be shown fast enough"
+                .format(self.dropped_lines, self.dropped_bytes))
+        if raise_errors and self._error is not None:
+            raise self._error
@@ -0,0 +1,360 @@
+"""
+Stores the output of builds, so it can be read later with `roman logs`.
+
+Every build has a directory under CACHE_DIR/logs with `build.json` and a log
+per step. A log is a sequence of gzip members, each holding a block of lines,
+so the whole file can also be read with zcat. Its index has an entry per
+block: the end offset of the block in the log and the number of lines up to
+the end of the block. Reading the last lines or a range of lines
+decompresses only the blocks containing them.
+"""
+import json
+import logging
+import re
+import struct
+import zlib
+from bisect import bisect_right
+from mmap import ACCESS_READ, mmap
+from itertools import count
+from os import getpid, listdir, makedirs, mkdir, replace
+from os.path import isdir, join, sep
+from shutil import rmtree
+from time import localtime, strftime, time
+
+from . import CACHE_DIR
+from .observer import BuildObserver, Message, Phase
+
+
+logger = logging.getLogger(__name__)
+
+LOG_SUFFIX = '.log.gz'
+INDEX_SUFFIX = '.idx'
+# end offset of a block in the log, number of lines up to the end of the block
+INDEX_ENTRY = struct.Struct('<QQ')
+BLOCK_SIZE = 2**16
+
+
+class StepLogWriter:
+    """
+    Appends lines to a step log. Lines are compressed in blocks of about
+    BLOCK_SIZE characters. The index entry of a block is written after the
+    block, so readers never see an entry of missing data.
+    """
+
+    def __init__(self, path, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.lines = 0
+        self._log = open(path + LOG_SUFFIX, 'ab')
+        self._index = open(path + INDEX_SUFFIX, 'ab')
+        self._offset = self._log.tell()
+        self._block = []
+        self._size = 0
+
+    def write(self, lines):
+        self._block.extend(lines)
+        self._size += sum(len(line) + 1 for line in lines)
+        if self._size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self._block or self._log.closed:
+            return
+        data = ''.join(line + '\n' for line in self._block).encode('utf-8')
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        block = compressor.compress(data) + compressor.flush()
+        self._log.write(block)
+        self._log.flush()
+        self._offset += len(block)
+        self.lines += len(self._block)
+        self._index.write(INDEX_ENTRY.pack(self._offset, self.lines))
+        self._index.flush()
+        self._block = []
+        self._size = 0
+
+    def close(self):
+        if self._log.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._log.close()
+            self._index.close()
+
+
+def map_file(path):
+    """Returns a read only mmap of the file or b'' for an empty file."""
+    with open(path, 'rb') as f:
+        try:
+            return mmap(f.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            # an empty file can't be mapped
+            return b''
+
+
+class StepLog:
+    """
+    Reads a step log written by StepLogWriter. The log and the index are
+    memory mapped and blocks are decompressed one at a time, when needed.
+    Line numbers start from 0.
+    """
+
+    def __init__(self, path):
+        self._data = map_file(path + LOG_SUFFIX)
+        index = map_file(path + INDEX_SUFFIX)
+        # an entry may be incomplete, while the log is being written
+        count = len(index) // INDEX_ENTRY.size
+        entries = [INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size) for i in range(count)]
+        self._offsets = [offset for offset, _ in entries]
+        self._ends = [lines for _, lines in entries]
+        if isinstance(index, mmap):
+            index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._ends[-1] if self._ends else 0
+
+    def close(self):
+        if isinstance(self._data, mmap):
+            self._data.close()
+
+    def _read_block(self, i):
+        start = self._offsets[i - 1] if i else 0
+        data = zlib.decompress(self._data[start:self._offsets[i]], 31)
+        return data.decode('utf-8', 'replace').split('\n')[:-1]
+
+    def get_lines(self, start=0, stop=None):
+        """Yields (line number, line) of lines from `start` up to `stop`."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        block = bisect_right(self._ends, start)
+        while start < stop:
+            first = self._ends[block - 1] if block else 0
+            lines = self._read_block(block)
+            for number in range(start, min(stop, self._ends[block])):
+                yield number, lines[number - first]
+            start = self._ends[block]
+            block += 1
+
+    def tail(self, count):
+        """Yields (line number, line) of the last `count` lines."""
+        return self.get_lines(max(0, len(self) - count))
+
+    def grep(self, pattern):
+        """Yields (line number, line) of lines matching the regular expression."""
+        search = re.compile(pattern).search
+        first = 0
+        for block, end in enumerate(self._ends):
+            for number, line in enumerate(self._read_block(block), first):
+                if search(line):
+                    yield number, line
+            first = end
+
+
+def create_build_id(now=None):
+    """Returns an id, which sorts by the start time of the build."""
+    now = time() if now is None else now
+    return '{}-{:06d}-{}'.format(strftime('%Y%m%d-%H%M%S', localtime(now)),
+        int(now * 10**6) % 10**6, getpid())
+
+
+class BuildLog:
+    """
+    The stored output of a build in `path`. `info` is saved in build.json and
+    contains the project directory, the start time, the result and the steps.
+    """
+    INFO_FILE = 'build.json'
+
+    def __init__(self, path, info):
+        self.path = path
+        self.info = info
+
+    @property
+    def id(self):
+        return self.info['id']
+
+    @classmethod
+    def load(cls, path):
+        with open(join(path, cls.INFO_FILE), encoding='utf-8') as f:
+            return cls(path, json.load(f))
+
+    def save(self):
+        tmp = join(self.path, self.INFO_FILE + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.info, f)
+        replace(tmp, join(self.path, self.INFO_FILE))
+
+    def _step_path(self, ref):
+        return join(self.path, str(ref))
+
+    def add_step(self, step):
+        """Adds the step to the build. Returns the step info and a StepLogWriter."""
+        info = {'ref': step.ref, 'name': str(step), 'state': None}
+        self.info['steps'].append(info)
+        return info, StepLogWriter(self._step_path(step.ref))
+
+    def get_step(self, ref):
+        """Returns the step info by a name or an index or None."""
+        for step in self.info['steps']:
+            if (str(step['ref']) == ref if ref.isdigit()
+                    else step['name'].lower() == ref.lower()):
+                return step
+        return None
+
+    def open_step(self, step):
+        """Returns a StepLog of the step info."""
+        return StepLog(self._step_path(step['ref']))
+
+
+class LogStore:
+    """
+    The build logs under `path`. Only the latest `keep` builds are kept.
+    """
+    DEFAULT_KEEP = 20
+
+    def __init__(self, path=None, keep=None):
+        self.path = path or join(CACHE_DIR, 'logs')
+        self.keep = self.DEFAULT_KEEP if keep is None else keep
+
+    def _list_ids(self):
+        if not isdir(self.path):
+            return []
+        return sorted(name for name in listdir(self.path) if not name.startswith('.'))
+
+    def create_build(self, project):
+        makedirs(self.path, exist_ok=True)
+        build_id = base_id = create_build_id()
+        for i in count(1):
+            path = join(self.path, build_id)
+            try:
+                mkdir(path)
+                break
+            except FileExistsError:
+                # another build started at the same time
+                build_id = '{}-{}'.format(base_id, i)
+        self.prune()
+        build = BuildLog(path, {
+            'id': build_id,
+            'project': project,
+            'start': time(),
+            'steps': [],
+            'result': None,
+            'code': None,
+        })
+        build.save()
+        return build
+
+    def list_builds(self):
+        """Returns BuildLogs ordered from the oldest."""
+        builds = []
+        for build_id in self._list_ids():
+            try:
+                builds.append(BuildLog.load(join(self.path, build_id)))
+            except (OSError, ValueError):
+                # just created or partially removed
+                pass
+        return builds
+
+    def get_build(self, ref=None, cwd=None):
+        """
+        Returns the BuildLog with the id or the unique id prefix `ref`, or
+        the latest build of the project containing `cwd`. Returns None, if
+        no build matches.
+        """
+        builds = self.list_builds()
+        if ref is not None:
+            builds = [build for build in builds if build.id.startswith(ref)]
+            exact = [build for build in builds if build.id == ref]
+            return (exact or builds)[0] if len(exact or builds) == 1 else None
+        if cwd is not None:
+            project_builds = [build for build in builds
+                if cwd == build.info['project']
+                or cwd.startswith(build.info['project'].rstrip(sep) + sep)]
+            builds = project_builds or builds
+        return builds[-1] if builds else None
+
+    def prune(self, keep=None):
+        """Removes all but the latest `keep` builds."""
+        keep = self.keep if keep is None else keep
+        ids = self._list_ids()
+        for build_id in ids[:max(0, len(ids) - keep)]:
+            rmtree(join(self.path, build_id), ignore_errors=True)
+
+
+class LogRecorder(BuildObserver):
+    """
+    Writes the output of each build to a BuildLog in `store` and passes
+    messages to `observer`. A build starts when the prepare phase is entered,
+    so the observer can be reused for many builds, e.g. when watching.
+    """
+
+    def __init__(self, observer, store, project):
+        super().__init__()
+        self._observer = observer
+        self._lock = observer._lock
+        self.store = store
+        self.project = project
+        self.build = None
+        self._writers = {}
+
+    def _message(self, phase, type_, step=None, state=None, data=None):
+        if type_ == Message.PHASE_UPDATE:
+            self._observer._phase_update(phase)
+            if phase == Phase.PREPARE:
+                self._start()
+            return
+        if self.build is not None and step is not None and phase == Phase.BUILD:
+            try:
+                self._record(type_, step, state, data)
+            except OSError as err:
+                # the build continues without the stored output
+                logger.warning("Failed to store the output of the build: %s", err)
+                self._stop()
+        self._observer._message(phase, type_, step, state, data)
+
+    def _start(self):
+        self._stop()
+        try:
+            self.build = self.store.create_build(self.project)
+        except OSError as err:
+            logger.warning("Failed to store the output of the build: %s", err)
+
+    def _stop(self):
+        for _, writer in self._writers.values():
+            try:
+                writer.close()
+            except OSError:
+                pass
+        self._writers.clear()
+        self.build = None
+
+    def _record(self, type_, step, state, data):
+        if step not in self._writers:
+            self._writers[step] = self.build.add_step(step)
+            self.build.save()
+        info, writer = self._writers[step]
+        if type_ == Message.CONTAINER_MSG:
+            writer.write(data)
+        elif type_ == Message.STATE_UPDATE and state.completed:
+            writer.close()
+            info['state'] = state.name.lower()
+            self.build.save()
+
+    def done(self, data=None):
+        super().done(data)
+        with self._lock:
+            build = self.build
+            if build is not None and data is not None:
+                try:
+                    for _, writer in self._writers.values():
+                        writer.close()
+                    build.info['result'] = str(data)
+                    build.info['code'] = data.code
+                    build.save()
+                except OSError as err:
+                    logger.warning("Failed to store the output of the build: %s", err)
+            self._stop()
+        self._observer.done(data)
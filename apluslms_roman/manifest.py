@@ -0,0 +1,152 @@
+import json
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from os import makedirs, replace, stat, walk
+from os.path import abspath, dirname, join, relpath
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+
+from . import CACHE_DIR
+
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 2**20
+
+
+def hash_file(path):
+    digest = sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_tree(root, exclude=()):
+    """
+    Returns a dict {relative path: os.stat_result} of all files under root.
+    Top level names in `exclude` are skipped.
+    """
+    files = {}
+    for dirpath, dirnames, filenames in walk(root):
+        if dirpath == root:
+            dirnames[:] = [d for d in dirnames if d not in exclude]
+            filenames = [f for f in filenames if f not in exclude]
+        for filename in filenames:
+            path = join(dirpath, filename)
+            try:
+                files[relpath(path, root)] = stat(path)
+            except FileNotFoundError:
+                pass
+    return files
+
+
+_IndexDiff = namedtuple('IndexDiff', ['added', 'modified', 'removed'])
+class IndexDiff(_IndexDiff):
+    __slots__ = ()
+
+    def __bool__(self):
+        return any(self)
+
+    @property
+    def paths(self):
+        return self.added | self.modified | self.removed
+
+
+class FileIndex:
+    """
+    A persistent manifest of files under `root`, which is stored in CACHE_DIR.
+
+    Every file has stat data (size, mtime_ns, ctime_ns, inode) and a sha256.
+    On update() only files with changed stat data are hashed again, in a pool
+    of threads. A file modified within RACY_NS of a scan could be changed
+    again without a visible change in the timestamps, so such entries are
+    always hashed again on the next update.
+    """
+    VERSION = 1
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, root, exclude=(), path=None, jobs=None):
+        self.root = abspath(root)
+        self.exclude = tuple(exclude)
+        if path is None:
+            key = sha256('\0'.join((self.root,) + self.exclude).encode('utf-8',
+                'surrogateescape')).hexdigest()
+            path = join(CACHE_DIR, 'manifests', key[:32] + '.json')
+        self.path = path
+        self.jobs = jobs
+        self._lock = Lock()
+        self._files = None
+
+    @property
+    def files(self):
+        """A dict {relative path: (size, mtime_ns, ctime_ns, inode, sha256, racy)}"""
+        if self._files is None:
+            self._files = self._load()
+        return self._files
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data['version'] == self.VERSION:
+                return {path: tuple(entry) for path, entry in data['files'].items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning("Ignoring an invalid file index %s: %s", self.path, err)
+        return {}
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({'version': self.VERSION, 'files': self.files})
+        makedirs(dirname(self.path), exist_ok=True)
+        with NamedTemporaryFile('w', dir=dirname(self.path), delete=False,
+                encoding='utf-8') as f:
+            f.write(data)
+        replace(f.name, self.path)
+
+    def update(self):
+        """Scans the tree and returns an IndexDiff to the previous update."""
+        with self._lock:
+            old = self.files
+            scanned_ns = int(time() * 10**9)
+            files, to_hash = {}, []
+            for path, st in scan_tree(self.root, self.exclude).items():
+                stat_data = (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+                entry = old.get(path)
+                if entry and entry[:4] == stat_data and not entry[5]:
+                    files[path] = entry
+                else:
+                    to_hash.append((path, stat_data))
+
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                hashes = executor.map(self._hash, (path for path, _ in to_hash))
+                for (path, stat_data), digest in zip(to_hash, hashes):
+                    if digest is not None:
+                        racy = stat_data[1] >= scanned_ns - self.RACY_NS
+                        files[path] = stat_data + (digest, racy)
+
+            self._files = files
+            return IndexDiff(
+                {p for p in files if p not in old},
+                {p for p in files if p in old and old[p][4] != files[p][4]},
+                {p for p in old if p not in files},
+            )
+
+    def _hash(self, path):
+        try:
+            return hash_file(join(self.root, path))
+        except FileNotFoundError:
+            return None
+
+    def digest(self):
+        """Returns a sha256 of the paths and contents from the latest update."""
+        digest = sha256()
+        for path, entry in sorted(self.files.items()):
+            digest.update(path.encode('utf-8', 'surrogateescape') + b'\0')
+            digest.update(entry[4].encode('ascii'))
+        return digest.hexdigest()
@@ -0,0 +1,293 @@
+"""
+Metrics of builds and backend operations in the Prometheus text format.
+
+The metrics are collected to REGISTRY during the process. A CLI build adds
+them to a textfile for the node_exporter textfile collector, and the daemon
+can serve them at /metrics.
+"""
+import json
+import logging
+from collections import OrderedDict
+from copy import copy
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import makedirs, replace
+from os.path import dirname
+from socketserver import ThreadingMixIn
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, escape_label(v)) for k, v in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        self._values = OrderedDict()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("{} requires labels {}, got {}".format(
+                self.name, self.labels, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def empty_copy(self):
+        metric = copy(self)
+        metric._lock = Lock()
+        metric._values = OrderedDict()
+        return metric
+
+    def get_state(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.extend(self._render_value(key, value))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def merge_state(self, state):
+        with self._lock:
+            for key, value in state:
+                key = tuple(key)
+                self._values[key] = self._values.get(key, 0) + value
+
+    def _render_value(self, key, value):
+        yield '{}{} {}'.format(self.name, format_labels(self.labels, key), format_value(value))
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = {'buckets': [0] * len(self.buckets),
+                    'sum': 0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data['buckets'][i] += 1
+            data['sum'] += value
+            data['count'] += 1
+
+    def get(self, **labels):
+        """Returns a tuple (count, sum) of the observations."""
+        with self._lock:
+            data = self._values.get(self._key(labels))
+            return (data['count'], data['sum']) if data else (0, 0)
+
+    def merge_state(self, state):
+        with self._lock:
+            for key, other in state:
+                key = tuple(key)
+                data = self._values.get(key)
+                if data is None or len(other['buckets']) != len(data['buckets']):
+                    if data is not None:
+                        logger.warning("Ignoring old buckets of %s", self.name)
+                    self._values[key] = json.loads(json.dumps(other))
+                    continue
+                data['buckets'] = [a + b for a, b in zip(data['buckets'], other['buckets'])]
+                data['sum'] += other['sum']
+                data['count'] += other['count']
+
+    def _render_value(self, key, data):
+        for bound, count in zip(self.buckets, data['buckets']):
+            labels = format_labels(self.labels, key, [('le', format_value(bound))])
+            yield '{}_bucket{} {}'.format(self.name, labels, count)
+        labels = format_labels(self.labels, key)
+        yield '{}_sum{} {}'.format(self.name, labels, format_value(data['sum']))
+        yield '{}_count{} {}'.format(self.name, labels, data['count'])
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def empty_copy(self):
+        registry = Registry()
+        for metric in self._metrics.values():
+            registry._add(metric.empty_copy())
+        return registry
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def get_state(self):
+        return {name: metric.get_state() for name, metric in self._metrics.items()}
+
+    def merge_state(self, state):
+        for name, values in state.items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric.merge_state(values)
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+
+REGISTRY = Registry()
+
+STEP_DURATION = REGISTRY.histogram('roman_step_duration_seconds',
+    "Duration of build steps.", ['step'])
+STEP_RESULTS = REGISTRY.counter('roman_step_results_total',
+    "Results of build steps by step name and outcome.", ['step', 'outcome'])
+BUILD_RESULTS = REGISTRY.counter('roman_builds_total',
+    "Results of builds by outcome.", ['outcome'])
+IMAGE_PULL_DURATION = REGISTRY.histogram('roman_image_pull_duration_seconds',
+    "Duration of image pulls.", ['image'])
+IMAGE_PULL_BYTES = REGISTRY.counter('roman_image_pull_bytes_total',
+    "Bytes of downloaded image layers.", ['image'])
+CONTAINER_START_LATENCY = REGISTRY.histogram('roman_container_start_seconds',
+    "Time to create and start a container.", buckets=LATENCY_BUCKETS)
+STEP_CACHE_REQUESTS = REGISTRY.counter('roman_step_cache_requests_total',
+    "Step cache lookups by result (hit or miss).", ['result'])
+LOG_BYTES = REGISTRY.counter('roman_log_bytes_total',
+    "Bytes of container output by step name.", ['step'])
+LOG_DROPPED_LINES = REGISTRY.counter('roman_log_dropped_lines_total',
+    "Lines of container output dropped by the log policy 'drop'.", ['step'])
+
+
+def get_outcome(result):
+    return 'ok' if result.ok else 'cancelled' if result.cancelled else 'failed'
+
+
+def observe_step(step, result, duration):
+    STEP_DURATION.observe(duration, step=step)
+    STEP_RESULTS.inc(step=step, outcome=get_outcome(result))
+
+
+def observe_build(result):
+    BUILD_RESULTS.inc(outcome=get_outcome(result))
+
+
+def export_textfile(path, registry=REGISTRY):
+    """
+    Adds the metrics of the registry to the textfile `path` and resets the
+    registry. The totals are kept in `path`.state, which is locked while
+    updated, so concurrent roman processes can share the textfile.
+    """
+    makedirs(dirname(path) or '.', exist_ok=True)
+    with open(path + '.state', 'a+', encoding='utf-8') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError as err:
+                logger.warning("Ignoring invalid metrics state of %s: %s", path, err)
+                state = {}
+            totals = registry.empty_copy()
+            totals.merge_state(state)
+            totals.merge_state(registry.get_state())
+            registry.reset()
+            f.seek(0)
+            f.truncate()
+            json.dump(totals.get_state(), f)
+            f.flush()
+            # node_exporter may read the file at any time
+            tmp = path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as out:
+                out.write(totals.render())
+            replace(tmp, path)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """Serves the metrics of `registry` at /metrics."""
+    daemon_threads = True
+
+    def __init__(self, address, registry=REGISTRY):
+        self.registry = registry
+        super().__init__(address, MetricsRequestHandler)
@@ -1,6 +1,9 @@
+import json
 import sys
+from json.encoder import encode_basestring
 from enum import Enum
-from time import time
+from threading import RLock, Timer
+from time import monotonic, time
 
 from colorama import init as init_color, Fore, Style
 
@@ -69,15 +72,27 @@ class Message(Enum):
 #
 # done:
 #   - build has entered done phase
+#
+# In a pipelined build, steps are prepared while the observer is in the build
+# phase. Those updates use PhaseObserver, which keeps the prepare states apart.
 
 
 class BuildObserver:
     def __init__(self):
         self._phase = Phase.NONE
         self._states = {}
+        # states of the earlier phases, which are updated by a PhaseObserver
+        self._phase_states = {}
+        # steps can be built in parallel, thus messages are serialized
+        self._lock = RLock()
+
+    def get_step_state(self, step, phase=None):
+        return self._get_states(phase).get(step, StepState.UNKNOWN)
 
-    def get_step_state(self, step):
-        return self._states.get(step, StepState.UNKNOWN)
+    def _get_states(self, phase):
+        if phase is None or phase == self._phase:
+            return self._states
+        return self._phase_states.setdefault(phase, {})
 
     def _message(self, phase, type_, step=None, state=None, data=None):
         raise NotImplementedError
@@ -85,10 +100,12 @@ class BuildObserver:
     # Phase transitions, synchronous
 
     def _phase_update(self, phase):
-        if self._phase != phase:
-            self._phase = phase
-            self._states = {step: StepState.NOTSTARTED for step in self._states}
-            self._message(self._phase, Message.PHASE_UPDATE)
+        with self._lock:
+            if self._phase != phase:
+                self._phase_states[self._phase] = self._states
+                self._phase = phase
+                self._states = {step: StepState.NOTSTARTED for step in self._states}
+                self._message(self._phase, Message.PHASE_UPDATE)
 
     def enter_prepare(self):
         self._phase_update(Phase.PREPARE)
@@ -101,15 +118,17 @@ class BuildObserver:
 
     # Step transitions, can be async
 
-    def _state_update(self, step, state):
+    def _state_update(self, step, state, phase=None):
         if self._phase == Phase.NONE:
             raise RuntimeError(
                 "%s has not entered any phase when requested to update state to %s for step %r"
                 % (self.__class__.__name__, state, step))
-        cur_state = self.get_step_state(step)
-        if cur_state != state and not cur_state.completed:
-            self._states[step] = state
-            self._message(self._phase, Message.STATE_UPDATE, step, state)
+        with self._lock:
+            states = self._get_states(phase)
+            cur_state = states.get(step, StepState.UNKNOWN)
+            if cur_state != state and not cur_state.completed:
+                states[step] = state
+                self._message(phase or self._phase, Message.STATE_UPDATE, step, state)
 
     def step_preflight(self, step):
         self._state_update(step, StepState.PREFLIGHT)
@@ -137,13 +156,14 @@ class BuildObserver:
 
     # In step state messages
 
-    def _send_message(self, type_, step, msg):
+    def _send_message(self, type_, step, msg, phase=None):
         if self._phase == Phase.NONE:
             raise RuntimeError(
                 "%s has not entered any phase when requested to send message %s in step %r with content %r"
                 % (self.__class__.__name__, type_, step, msg))
-        state = self.get_step_state(step)
-        self._message(self._phase, type_, step, state, msg)
+        with self._lock:
+            state = self.get_step_state(step, phase)
+            self._message(phase or self._phase, type_, step, state, msg)
 
     def manager_msg(self, step, msg):
         msg = msg.rstrip().splitlines()
@@ -160,35 +180,148 @@ class BuildObserver:
         # NOTE: if for some reason some step isn't marked as succeeded,
         # this will result in the 'ok: [time]' message, without any
         # indication what step is in question and with an incorrect time
-        if state == StepState.SUCCEEDED:
-            for step in self._states:
-                self.step_succeeded(step)
-        else:
-            self._state_update(result.step, state)
-        self._send_message(Message.RESULT_MSG, result.step, (result.code, result.error))
+        with self._lock:
+            if state == StepState.SUCCEEDED:
+                for step in list(self._states):
+                    self.step_succeeded(step)
+            else:
+                self._state_update(result.step, state)
+            self._send_message(Message.RESULT_MSG, result.step, (result.code, result.error))
+
+
+class PhaseObserver(BuildObserver):
+    """
+    Sends the step updates to `observer` in a fixed `phase`, which can be
+    different from the phase the observer is in. For example, later steps are
+    prepared while earlier steps are already being built.
+    """
+    def __init__(self, observer, phase):
+        super().__init__()
+        self._observer = observer
+        self._phase = phase
+        self._lock = observer._lock
+
+    def get_step_state(self, step, phase=None):
+        return self._observer.get_step_state(step, phase or self._phase)
+
+    def _phase_update(self, phase):
+        raise RuntimeError("%s can't change the phase" % (self.__class__.__name__,))
+
+    def _state_update(self, step, state, phase=None):
+        self._observer._state_update(step, state, phase or self._phase)
+
+    def _send_message(self, type_, step, msg, phase=None):
+        self._observer._send_message(type_, step, msg, phase or self._phase)
+
+
+def is_tty(stream):
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+class BatchedWriter:
+    """
+    Coalesces writes to `stream`, which is written and flushed once per
+    `flush_interval` seconds or when `buffer_size` characters are buffered.
+    """
+    FLUSH_INTERVAL = 0.1
+    BUFFER_SIZE = 65536
+
+    def __init__(self, stream, lock=None, flush_interval=None, buffer_size=None):
+        self._stream = stream
+        self._lock = lock or RLock()
+        self.flush_interval = self.FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.buffer_size = self.BUFFER_SIZE if buffer_size is None else buffer_size
+        self._buffer = []
+        self._size = 0
+        self._timer = None
+
+    def write(self, text):
+        with self._lock:
+            self._buffer.append(text)
+            self._size += len(text)
+            if self._size >= self.buffer_size or not self.flush_interval:
+                self._flush()
+            elif self._timer is None:
+                self._timer = Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._buffer:
+            data = ''.join(self._buffer)
+            self._buffer.clear()
+            self._size = 0
+            self._stream.write(data)
+            if hasattr(self._stream, 'flush'):
+                self._stream.flush()
 
 
 class StreamObserver(BuildObserver):
-    def __init__(self, stream=None, colors=True):
+    """
+    Writes the build progress as text to the stream. Observers of builds
+    running in parallel can share the stream by using a common `lock`
+    (an RLock) and a `prefix`, which is added to the start of every line.
+
+    Colors are used, when `colors` is true, or when it's None and the stream
+    is a TTY. Output of containers is written in batches by a BatchedWriter
+    and other messages are flushed immediately.
+    """
+    def __init__(self, stream=None, colors=None, prefix=None, lock=None,
+            flush_interval=None, buffer_size=None):
         super().__init__()
         self._stream = stream or sys.stdout
-        self._colors = colors
-        self._start_time = -1
+        self._colors = is_tty(self._stream) if colors is None else colors
+        self._prefix = prefix
+        self._at_line_start = True
+        if lock is not None:
+            self._lock = lock
+        self._writer = BatchedWriter(self._stream, self._lock, flush_interval, buffer_size)
+        self._start_times = {}
         init_color()
 
     def _write(self, to_write, colors=None):
         if not isinstance(to_write, str):
             to_write = str(to_write)
+        if self._prefix and to_write:
+            lines = to_write.splitlines(True)
+            if self._at_line_start:
+                lines[0] = self._prefix + lines[0]
+            to_write = ''.join(lines[:1] + [self._prefix + line for line in lines[1:]])
+            self._at_line_start = to_write.endswith('\n')
         if self._colors:
-            if colors:
-                self._stream.write(colors)
-            self._stream.write(to_write + Style.RESET_ALL)
-        else:
-            self._stream.write(to_write)
+            to_write = (colors or '') + to_write + Style.RESET_ALL
+        self._writer.write(to_write)
+
+    def flush(self):
+        self._writer.flush()
 
     def _message(self, phase, type_, step=None, state=None, data=None):
-        def format_time(duration):
-            duration = int(duration)
+        with self._lock:
+            if type_ == Message.CONTAINER_MSG:
+                if isinstance(data, str):
+                    data = (data,)
+                if data:
+                    self._write(''.join(["  >> %s\n" % (line,) for line in data]))
+                return
+            self._write_message(phase, type_, step, state, data)
+            # phase and state transitions are shown immediately
+            self._writer.flush()
+
+    def _write_message(self, phase, type_, step=None, state=None, data=None):
+        def format_time(start):
+            if start is None:
+                return '-'
+            duration = int(time() - start)
             hours, seconds = divmod(duration, 3600)
             minutes, seconds = divmod(seconds, 60)
             hours = '{}h '.format(hours) if hours else ''
@@ -202,10 +335,16 @@ class StreamObserver(BuildObserver):
             elif phase == Phase.BUILD:
                 self._write("BUILDING STEPS\n\n", Style.BRIGHT)
         elif type_ == Message.STATE_UPDATE:
-            if state == StepState.SUCCEEDED:
-                self._write('  ok: ', Fore.GREEN + Style.BRIGHT)
-                self._write('{}\n\n'.format(format_time(time() - self._start_time)))
+            # a step prepared while in the build phase is named in its result
+            label = ' (preparing step %s)' % (step,) if phase != self._phase else ''
+            if phase != self._phase and state == StepState.CANCELLED:
+                pass
+            elif state == StepState.SUCCEEDED:
+                self._write('  ok%s: ' % (label,), Fore.GREEN + Style.BRIGHT)
+                self._write('{}\n\n'.format(format_time(self._start_times.get((phase, step)))))
             elif state in (StepState.PENDING, StepState.PREFLIGHT):
+                if phase != self._phase:
+                    self._write('preparing ', Fore.CYAN + Style.BRIGHT)
                 self._write('step ', Fore.CYAN + Style.BRIGHT)
                 self._write('%s\n' % (step,), Style.BRIGHT)
             elif state == StepState.CANCELLED:
@@ -213,11 +352,11 @@ class StreamObserver(BuildObserver):
                     .format(" on step %s" % (step,) if step else ""))
                 self._write(msg, Fore.RED + Style.BRIGHT)
             elif state == StepState.FAILED:
-                self._write('  failed: ', Fore.RED + Style.BRIGHT)
-                self._write('{}\n\n'.format(format_time(time() - self._start_time)))
+                self._write('  failed%s: ' % (label,), Fore.RED + Style.BRIGHT)
+                self._write('{}\n\n'.format(format_time(self._start_times.get((phase, step)))))
             elif phase == Phase.BUILD and state == StepState.RUNNING:
                 self._write("  Running container\n", Fore.BLUE + Style.BRIGHT)
-            self._start_time = time()
+            self._start_times[(phase, step)] = time()
         elif type_ == Message.RESULT_MSG:
             if phase == Phase.PREPARE or state == StepState.CANCELLED:
                 return
@@ -227,16 +366,79 @@ class StreamObserver(BuildObserver):
                 self._write("Build failed on step %s: exit code %d\n"
                     % (step, data[0]), Fore.RED + Style.BRIGHT)
         else:
-            color = None
-            if type_ == Message.CONTAINER_MSG:
-                fmt = "  >> %s\n"
-            elif type_ == Message.MANAGER_MSG:
-                fmt = "  %s\n"
-                color = Fore.BLUE + Style.BRIGHT
-            else:
+            if type_ != Message.MANAGER_MSG:
                 return
-
             if isinstance(data, str):
                 data = (data,)
             for line in data:
-                self._write(fmt % (line,), color)
+                self._write("  %s\n" % (line,), Fore.BLUE + Style.BRIGHT)
+
+
+def get_event(phase, type_, step=None, state=None, data=None):
+    """Returns an observer message as a JSON compatible dict."""
+    return {
+        'phase': phase.name,
+        'type': type_.name,
+        'step': None if step is None else str(step),
+        'ref': getattr(step, 'ref', None),
+        'state': None if state is None else state.name,
+        'data': data,
+    }
+
+
+class JsonLinesObserver(BuildObserver):
+    """
+    Writes every message as a compact JSON object on its own line, for
+    programs following the build. `t` is the monotonic time in seconds since
+    the observer was created and phase updates have also the wall clock
+    `time`. The output of a container is an event per batch of lines, which
+    is written by a BatchedWriter like in StreamObserver.
+
+    The fields other than `t` and `data` are encoded once per step and state,
+    so an event of container output costs little more than encoding its lines.
+    """
+    def __init__(self, stream=None, lock=None, flush_interval=None, buffer_size=None):
+        super().__init__()
+        self._stream = stream or sys.stdout
+        if lock is not None:
+            self._lock = lock
+        self._writer = BatchedWriter(self._stream, self._lock, flush_interval, buffer_size)
+        self._encode = json.JSONEncoder(ensure_ascii=False, check_circular=False,
+            separators=(',', ':')).encode
+        self._fields = {}
+        # step, state, phase and fields of the latest container output
+        self._last_output = (None, None, None, None)
+        self._start = monotonic()
+
+    def flush(self):
+        self._writer.flush()
+
+    def _get_fields(self, phase, type_, step, state):
+        key = (phase, type_, step, state)
+        fields = self._fields.get(key)
+        if fields is None:
+            event = get_event(phase, type_, step, state)
+            del event['data']
+            fields = self._fields[key] = self._encode(event)[1:-1]
+        return fields
+
+    def _message(self, phase, type_, step=None, state=None, data=None):
+        t = monotonic() - self._start
+        with self._lock:
+            if type_ == Message.CONTAINER_MSG:
+                if isinstance(data, str):
+                    data = (data,)
+                last = self._last_output
+                if last[0] is step and last[1] is state and last[2] is phase:
+                    fields = last[3]
+                else:
+                    fields = self._get_fields(phase, type_, step, state)
+                    self._last_output = (step, state, phase, fields)
+                self._writer.write('{"t":%.6f,%s,"data":[%s]}\n'
+                    % (t, fields, ','.join(map(encode_basestring, data))))
+                return
+            fields = self._get_fields(phase, type_, step, state)
+            extra = ',"time":%r' % (time(),) if type_ == Message.PHASE_UPDATE else ''
+            self._writer.write('{"t":%.6f,%s,"data":%s%s}\n'
+                % (t, fields, self._encode(data), extra))
+            self._writer.flush()
@@ -0,0 +1,187 @@
+"""
+CPU and memory profiles of roman itself, split to phases of an action:
+settings (loading the settings), config (validating the project config),
+prepare (preparing the steps), build (building the steps) and action (the
+rest of the action).
+
+Code is instrumented with `profile_phase(name)`, which does nothing unless a
+profiler has been activated with `start_profiling()`.
+"""
+import cProfile
+import logging
+import pstats
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import makedirs
+from os.path import join
+from threading import Lock, local
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ('cpu', 'mem')
+
+
+class CpuProfiler:
+    """
+    Profiles each phase with cProfile. A phase can be entered in many
+    threads, e.g. the build phase in each step worker, and the profiles of
+    the threads are combined. Writes PHASE.pstats and PHASE.txt per phase.
+    """
+    TOP = 40
+
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+        self._lock = Lock()
+        self._stats = OrderedDict()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    @staticmethod
+    def _enable(profile):
+        try:
+            profile.enable()
+        except ValueError as err:
+            # python 3.12+ allows one active profiler per process
+            logger.debug("Unable to profile the thread: %s", err)
+            return None
+        return profile
+
+    @contextmanager
+    def phase(self, name):
+        stack = self._local.__dict__.setdefault('stack', [])
+        if stack and stack[-1][0] == name:
+            yield
+            return
+        if stack and stack[-1][1] is not None:
+            stack[-1][1].disable()
+        stack.append((name, self._enable(cProfile.Profile())))
+        try:
+            yield
+        finally:
+            _, profile = stack.pop()
+            if profile is not None:
+                profile.disable()
+                with self._lock:
+                    if name in self._stats:
+                        self._stats[name].add(profile)
+                    else:
+                        self._stats[name] = pstats.Stats(profile)
+            if stack and stack[-1][1] is not None:
+                stack[-1] = (stack[-1][0], self._enable(stack[-1][1]))
+
+    def save(self):
+        makedirs(self.path, exist_ok=True)
+        with self._lock:
+            for name, stats in self._stats.items():
+                stats.dump_stats(join(self.path, name + '.pstats'))
+                with open(join(self.path, name + '.txt'), 'w', encoding='utf-8') as f:
+                    stats.stream = f
+                    stats.sort_stats('cumulative').print_stats(self.TOP)
+
+
+class MemoryProfiler:
+    """
+    Traces allocations with tracemalloc and reports the top allocations,
+    which remained at the end of each phase, by source line. The phases
+    nested in a phase are included in it. Writes PHASE.txt per phase.
+    """
+    TOP = 40
+    FRAMES = 10
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        # name -> [number of threads in the phase, snapshot at the start]
+        self._active = {}
+        self._reports = OrderedDict()
+
+    def start(self):
+        tracemalloc.start(self.FRAMES)
+
+    def stop(self):
+        tracemalloc.stop()
+
+    @staticmethod
+    def _take_snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+
+    @contextmanager
+    def phase(self, name):
+        with self._lock:
+            active = self._active.get(name)
+            if active is None:
+                active = self._active[name] = [0, self._take_snapshot()]
+            active[0] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                active[0] -= 1
+                if not active[0]:
+                    del self._active[name]
+                    self._add_report(name, active[1], self._take_snapshot())
+
+    def _add_report(self, name, before, after):
+        stats = after.compare_to(before, 'lineno')
+        reports = self._reports.setdefault(name, [])
+        lines = ["# {} #{}: {:.1f} KiB allocated and not freed".format(
+            name, len(reports) + 1, sum(stat.size_diff for stat in stats) / 1024)]
+        lines.extend(str(stat) for stat in stats[:self.TOP])
+        reports.append('\n'.join(lines))
+
+    def save(self):
+        makedirs(self.path, exist_ok=True)
+        with self._lock:
+            for name, reports in self._reports.items():
+                with open(join(self.path, name + '.txt'), 'w', encoding='utf-8') as f:
+                    f.write('\n\n'.join(reports) + '\n')
+
+
+PROFILERS = {
+    'cpu': CpuProfiler,
+    'mem': MemoryProfiler,
+}
+
+_profiler = None
+
+
+def start_profiling(mode, path):
+    """Activates and returns a new profiler of `mode`, which saves to directory `path`."""
+    global _profiler
+    _profiler = PROFILERS[mode](path)
+    _profiler.start()
+    return _profiler
+
+
+def stop_profiling():
+    """Deactivates and returns the active profiler."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+@contextmanager
+def profile_phase(name):
+    """Attributes the with block to the phase `name` of the active profiler."""
+    profiler = _profiler
+    if profiler is None:
+        yield
+    else:
+        with profiler.phase(name):
+            yield
@@ -0,0 +1,139 @@
+import json
+import logging
+import re
+from collections import namedtuple
+from os import getpid, kill, makedirs
+from os.path import dirname, join
+from threading import Condition
+from time import time
+from uuid import uuid4
+
+try:
+    import fcntl
+except ImportError:
+    # leases are shared only within the process
+    fcntl = None
+
+from . import CACHE_DIR
+
+
+logger = logging.getLogger(__name__)
+
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40}
+SIZE_RE = re.compile(r'^\s*([0-9]+(?:\.[0-9]+)?)\s*([bkmgt]?)i?b?\s*$', re.IGNORECASE)
+
+
+def parse_size(value):
+    """
+    Returns the number of bytes in `value`, e.g. 512m or 2G. Integers are
+    bytes, like in docker.
+    """
+    if value is None or isinstance(value, int):
+        return value
+    match = SIZE_RE.match(str(value))
+    if not match:
+        raise ValueError("Invalid size: {}".format(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+Resources = namedtuple('Resources', ['cpus', 'memory'])
+
+
+def is_alive(pid):
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ResourceBudget:
+    """
+    A budget of CPUs and memory for build steps, which is shared by all roman
+    processes of the user on the host.
+
+    The leases of running steps are stored in a JSON file, which is locked
+    with fcntl while it's updated. Leases of processes, which are no longer
+    running, are removed. A step is admitted, when its resources fit in the
+    budget or when no other step is running, so every step is built
+    eventually. A limit of None is not enforced.
+    """
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, cpus=None, memory=None, path=None):
+        self.cpus = cpus
+        self.memory = memory
+        self.path = path or join(CACHE_DIR, 'resources.json')
+        self._condition = Condition()
+
+    def _update(self, update):
+        """Calls update(leases) with the leases in the locked file and stores the result."""
+        makedirs(dirname(self.path), exist_ok=True)
+        with open(self.path, 'a+', encoding='utf-8') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    leases = json.loads(f.read() or '{}')
+                except ValueError as err:
+                    logger.warning("Ignoring invalid resource leases in %s: %s", self.path, err)
+                    leases = {}
+                leases = {k: v for k, v in leases.items() if is_alive(v['pid'])}
+                result = update(leases)
+                # the file is rewritten in place, as other processes wait for its lock
+                f.seek(0)
+                f.truncate()
+                json.dump(leases, f)
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+    def usage(self):
+        """Returns the Resources used by all running steps."""
+        def get_usage(leases):
+            return Resources(
+                sum(lease['cpus'] for lease in leases.values()),
+                sum(lease['memory'] for lease in leases.values()),
+            )
+        return self._update(get_usage)
+
+    def try_acquire(self, cpus=0, memory=0):
+        """Returns a lease id, if the resources fit in the budget, otherwise None."""
+        cpus, memory = cpus or 0, memory or 0
+        def acquire(leases):
+            if leases:
+                if self.cpus is not None and \
+                        sum(l['cpus'] for l in leases.values()) + cpus > self.cpus:
+                    return None
+                if self.memory is not None and \
+                        sum(l['memory'] for l in leases.values()) + memory > self.memory:
+                    return None
+            lease = uuid4().hex
+            leases[lease] = {'pid': getpid(), 'cpus': cpus, 'memory': memory, 'time': time()}
+            return lease
+        return self._update(acquire)
+
+    def acquire(self, cpus=0, memory=0, cancelled=None):
+        """
+        Waits until the resources fit in the budget and returns a lease id.
+        Returns None, if `cancelled()` returns True while waiting.
+        """
+        while True:
+            lease = self.try_acquire(cpus, memory)
+            if lease is not None:
+                return lease
+            if cancelled and cancelled():
+                return None
+            # releases in this process wake up waiters, other processes are polled
+            with self._condition:
+                self._condition.wait(self.POLL_INTERVAL)
+
+    def release(self, lease):
+        self._update(lambda leases: leases.pop(lease, None))
+        with self._condition:
+            self._condition.notify_all()
@@ -102,6 +102,11 @@ class ArgumentSettings(Settings, metaclass=ArgumentSettingsMeta):
                 else:
                     group.add_argument('--'+name, metavar=meta, default=Undefined, help=_(desc))
 
+    @classmethod
+    def namespace_has_values(cls, namespace):
+        return any(getattr(namespace, name.replace('-', '_'), Undefined) is not Undefined
+            for arguments in cls._ARGUMENTS.values() for _, name, _ in arguments)
+
     def update_from_namespace(self, namespace, store=False):
         set_ = self.mlset if store else self.mlsetwork
         for arguments in self._ARGUMENTS.values():
@@ -120,6 +125,9 @@ class GlobalSettings(ArgumentSettings):
     ARGUMENT_GROUPS = (
         # name, title, description
         ('backend', _("Backend"), _("Backend driver configuration")),
+        ('cache', _("Cache"), _("Build step cache configuration")),
+        ('resources', _("Resources"), _("CPUs and memory shared by the build steps "
+            "of all roman processes")),
     )
 
     ARGUMENTS = (
@@ -127,4 +135,7 @@ class GlobalSettings(ArgumentSettings):
         ('backend', 'backend', _('MODULE')),
         ('docker.host', 'backend', _('URL')),
         ('docker.timeout', 'backend'),
+        ('cache.size', 'cache', _('MIB')),
+        ('resources.cpus', 'resources', _('N')),
+        ('resources.memory', 'resources', _('SIZE')),
     )
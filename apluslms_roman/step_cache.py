@@ -0,0 +1,254 @@
+import json
+import logging
+from collections import namedtuple
+from hashlib import sha256
+from os import chmod, listdir, makedirs, remove, replace, stat, utime
+from os.path import basename, dirname, exists, isdir, join
+from shutil import copyfile, copyfileobj
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+from . import CACHE_DIR
+from .backends import BuildResult
+from .build_path import BUILD_DIRS
+from .manifest import BUFFER_SIZE, FileIndex, hash_file, scan_tree
+from .metrics import STEP_CACHE_REQUESTS
+
+
+logger = logging.getLogger(__name__)
+
+def remove_file(path):
+    try:
+        remove(path)
+    except FileNotFoundError:
+        # removed by a concurrent prune
+        pass
+
+
+def copy_to(path, out):
+    with open(path, 'rb') as f:
+        copyfileobj(f, out, BUFFER_SIZE)
+
+
+CacheStats = namedtuple('CacheStats', ['entries', 'objects', 'size', 'max_size'])
+
+
+class StepCache:
+    """
+    A content addressed store for the output of build steps.
+
+    Files written by a step to the build directory are stored under
+    `objects/` by their sha256 and an entry under `entries/` maps the
+    relative paths to those objects. Entries are evicted in the least
+    recently used order, when the objects exceed `max_size` bytes.
+    """
+    DEFAULT_MAX_SIZE = 2**30
+
+    def __init__(self, path=None, max_size=None):
+        self.path = path or join(CACHE_DIR, 'steps')
+        self.max_size = max_size or self.DEFAULT_MAX_SIZE
+        self._objects = join(self.path, 'objects')
+        self._entries = join(self.path, 'entries')
+
+    def _object_path(self, digest):
+        return join(self._objects, digest[:2], digest)
+
+    def _entry_path(self, key):
+        return join(self._entries, key + '.json')
+
+    def _write_atomic(self, path, write):
+        makedirs(dirname(path), exist_ok=True)
+        with NamedTemporaryFile(dir=dirname(path), delete=False) as f:
+            write(f)
+        replace(f.name, path)
+
+    def get_key(self, *parts):
+        data = json.dumps(parts, sort_keys=True, default=str)
+        return sha256(data.encode('utf-8')).hexdigest()
+
+    def restore(self, key, build_path):
+        """Restores the output of an entry to build_path. Returns False on a miss."""
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, encoding='utf-8') as f:
+                entry = json.load(f)
+            for path in entry['deleted']:
+                target = join(build_path, path)
+                if exists(target):
+                    remove(target)
+            for path, (digest, mode) in entry['files'].items():
+                target = join(build_path, path)
+                makedirs(dirname(target), exist_ok=True)
+                # replace the file instead of writing to it, as it may be a
+                # hardlink to the served output
+                remove_file(target)
+                copyfile(self._object_path(digest), target)
+                chmod(target, mode)
+            utime(entry_path)
+        except (OSError, ValueError, KeyError) as err:
+            if not isinstance(err, FileNotFoundError) or exists(entry_path):
+                logger.warning("Failed to restore the step cache entry %s: %s", key, err)
+            return False
+        return True
+
+    def store(self, key, build_path, before):
+        """Stores changes in build_path since the `before` scan_tree() result."""
+        after = scan_tree(build_path)
+        files = {}
+        for path, st in after.items():
+            old = before.get(path)
+            if old and (old.st_size, old.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                continue
+            source = join(build_path, path)
+            digest = hash_file(source)
+            target = self._object_path(digest)
+            if not exists(target):
+                self._write_atomic(target, lambda f: copy_to(source, f))
+            files[path] = (digest, st.st_mode & 0o777)
+        entry = {
+            'files': files,
+            'deleted': [path for path in before if path not in after],
+        }
+        self._write_atomic(self._entry_path(key),
+            lambda f: f.write(json.dumps(entry).encode('utf-8')))
+
+    def _list_entries(self):
+        if not isdir(self._entries):
+            return []
+        return [join(self._entries, name) for name in listdir(self._entries)
+            if name.endswith('.json')]
+
+    def _list_objects(self):
+        return scan_tree(self._objects) if isdir(self._objects) else {}
+
+    def stats(self):
+        objects = self._list_objects()
+        return CacheStats(
+            len(self._list_entries()),
+            len(objects),
+            sum(st.st_size for st in objects.values()),
+            self.max_size,
+        )
+
+    def prune(self, max_size=None):
+        """
+        Removes least recently used entries until the objects fit in max_size
+        and then the objects no longer referenced. Returns the freed bytes.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        objects = {basename(p): st.st_size for p, st in self._list_objects().items()}
+        total = sum(objects.values())
+        if total <= max_size:
+            return 0
+
+        entries = []
+        for path in self._list_entries():
+            try:
+                with open(path, encoding='utf-8') as f:
+                    digests = {d for d, _ in json.load(f)['files'].values()}
+                entries.append((stat(path).st_mtime, path, digests))
+            except (OSError, ValueError, KeyError):
+                remove_file(path)
+        entries.sort()
+
+        refcount = {}
+        for _, _, digests in entries:
+            for digest in digests:
+                refcount[digest] = refcount.get(digest, 0) + 1
+        size = sum(objects[d] for d in refcount if d in objects)
+        while entries and size > max_size:
+            _, path, digests = entries.pop(0)
+            remove_file(path)
+            for digest in digests:
+                refcount[digest] -= 1
+                if not refcount[digest]:
+                    size -= objects.get(digest, 0)
+
+        for digest, object_size in objects.items():
+            if not refcount.get(digest):
+                remove_file(self._object_path(digest))
+                total -= object_size
+        return sum(objects.values()) - total
+
+
+class CachingStepRunner:
+    """
+    Wraps backend.build_step with a StepCache lookup. A hit restores the step
+    output to the build directory instead of running the step.
+
+    Steps with `mnt` write to the source directory and are never cached. The
+    output of a step is stored only when no other step was running at the
+    same time, so outputs of parallel steps are not mixed.
+    """
+
+    def __init__(self, backend, cache, source_index=None):
+        self.backend = backend
+        self.cache = cache
+        self._lock = Lock()
+        self._active = set()
+        self._overlapped = set()
+        self._source_index = source_index
+        self._source_hash = None
+        self._build_index = None
+
+    def _get_key(self, task, step):
+        image_id = self.backend.image_id(step)
+        if step.mnt or not image_id:
+            return None
+        with self._lock:
+            if self._source_hash is None:
+                if self._source_index is None:
+                    self._source_index = FileIndex(task.path, exclude=BUILD_DIRS)
+                self._source_index.update()
+                self._source_hash = self._source_index.digest()
+            if self._build_index is None:
+                self._build_index = FileIndex(task.build_path)
+            source_hash = self._source_hash
+        self._build_index.update()
+        return self.cache.get_key(source_hash, self._build_index.digest(),
+            image_id, step.cmd, step.mnt, step.env)
+
+    def save(self):
+        """Persists the file indexes, so next builds hash only changed files."""
+        for index in (self._source_index, self._build_index):
+            if index is not None:
+                index.save()
+
+    def build_step(self, task, step, observer):
+        build_path = task.build_path
+        key = self._get_key(task, step)
+        if key is not None:
+            observer.step_pending(step)
+            if self.cache.restore(key, build_path):
+                STEP_CACHE_REQUESTS.inc(result='hit')
+                observer.manager_msg(step, "Restored the step output from the cache")
+                observer.step_succeeded(step)
+                return BuildResult()
+            STEP_CACHE_REQUESTS.inc(result='miss')
+            before = scan_tree(build_path)
+
+        with self._lock:
+            self._active.add(step)
+            if len(self._active) > 1:
+                self._overlapped.update(self._active)
+        try:
+            result = self.backend.build_step(task, step, observer)
+        finally:
+            with self._lock:
+                self._active.discard(step)
+                overlapped = step in self._overlapped
+                self._overlapped.discard(step)
+        if step.mnt:
+            # the source might have been changed by the step
+            self._source_hash = None
+
+        if key is not None and result.ok and not overlapped:
+            try:
+                self.cache.store(key, build_path, before)
+            except OSError as err:
+                logger.warning("Failed to store step %s in the cache: %s", step, err)
+        return result
+
+    def cancel_step(self, step):
+        self.backend.cancel_step(step)
@@ -0,0 +1,112 @@
+"""
+Records spans of the build as Chrome trace events, which can be opened in
+chrome://tracing or ui.perfetto.dev.
+
+Code is instrumented with `span(name)`, which does nothing unless a Tracer
+has been activated with `start_tracing()`. Only a single build of the
+process is traced at a time.
+"""
+import json
+from contextlib import contextmanager
+from os import getpid, replace
+from threading import Lock, current_thread, get_ident
+from time import perf_counter
+
+
+class Tracer:
+    """Collects complete ('X') trace events of spans from any thread."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._events = []
+        self._threads = {}
+        self._origin = perf_counter()
+        self._pid = getpid()
+
+    def _now(self):
+        return (perf_counter() - self._origin) * 1e6
+
+    def add(self, name, start, end, category=None, args=None):
+        """Adds a span, which started and ended at the perf_counter() times."""
+        tid = get_ident()
+        event = {
+            'name': name,
+            'cat': category or name.partition('.')[0],
+            'ph': 'X',
+            'ts': round((start - self._origin) * 1e6, 1),
+            'dur': round((end - start) * 1e6, 1),
+            'pid': self._pid,
+            'tid': tid,
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+            if tid not in self._threads:
+                self._threads[tid] = current_thread().name
+
+    @contextmanager
+    def span(self, name, category=None, **args):
+        start = perf_counter()
+        try:
+            yield args
+        except BaseException as err:
+            args['error'] = err.__class__.__name__
+            raise
+        finally:
+            self.add(name, start, perf_counter(), category, args)
+
+    def get_events(self):
+        with self._lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid,
+                'args': {'name': name}} for tid, name in self._threads.items()]
+            return metadata + sorted(self._events, key=lambda event: event['ts'])
+
+    def save(self, path):
+        data = {'traceEvents': self.get_events(), 'displayTimeUnit': 'ms'}
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, default=str)
+        replace(tmp, path)
+
+
+_tracer = None
+
+
+def start_tracing():
+    """Activates and returns a new Tracer."""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop_tracing():
+    """Deactivates and returns the active Tracer."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+@contextmanager
+def trace_to(path):
+    """Traces the with block and saves the trace events to `path`."""
+    tracer = start_tracing()
+    try:
+        yield tracer
+    finally:
+        stop_tracing()
+        tracer.save(path)
+
+
+@contextmanager
+def span(name, category=None, **args):
+    """
+    Records the with block as a span of the active Tracer. Yields a dict of
+    the span arguments, which can be extended in the block.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield args
+    else:
+        with tracer.span(name, category, **args) as args:
+            yield args
@@ -0,0 +1,204 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import struct
+from fnmatch import fnmatch
+from glob import has_magic
+from os import O_CLOEXEC, O_NONBLOCK, close, fsencode, fsdecode, read, walk
+from os.path import join, relpath
+from select import select
+from time import sleep, time
+
+from .build_path import BUILD_DIRS
+from .manifest import FileIndex
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IGNORE = BUILD_DIRS + ('.git',)
+
+
+def is_ignored(path, patterns):
+    """
+    Returns True, if a pattern matches the relative path, any of its parent
+    directories or any of the path components.
+    """
+    parts = path.split('/')
+    for i, part in enumerate(parts, 1):
+        prefix = '/'.join(parts[:i])
+        if any(fnmatch(prefix, p) or fnmatch(part, p) for p in patterns):
+            return True
+    return False
+
+
+def matches_inputs(path, patterns):
+    return any(fnmatch(path, p) or path.startswith(p.rstrip('/') + '/') for p in patterns)
+
+
+class InotifyWatcher:
+    """
+    Watches a directory tree with inotify, which is used via ctypes.
+    Raises OSError, if inotify is not available.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+    EVENT = struct.Struct('iIII')
+    BUFFER_SIZE = 2**16
+
+    def __init__(self, root, ignore=()):
+        self.root = root
+        self.ignore = tuple(ignore)
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except (AttributeError, OSError, TypeError) as err:
+            raise OSError(errno.ENOSYS, "inotify is not available: {}".format(err))
+        self._fd = init(O_NONBLOCK | O_CLOEXEC)
+        if self._fd < 0:
+            raise self._error()
+        self._watches = {}
+        try:
+            self._add_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def _error(self):
+        code = ctypes.get_errno()
+        return OSError(code, errno.errorcode.get(code, str(code)))
+
+    def _add_tree(self, top):
+        """Watches the directory `top` and its subdirectories. Returns the files in them."""
+        files = set()
+        for dirpath, dirnames, filenames in walk(join(self.root, top)):
+            reldir = relpath(dirpath, self.root)
+            reldir = '' if reldir == '.' else reldir
+            dirnames[:] = [d for d in dirnames
+                if not is_ignored(join(reldir, d), self.ignore)]
+            wd = self._add_watch(self._fd, fsencode(dirpath), self.MASK)
+            if wd < 0:
+                error = self._error()
+                if error.errno == errno.ENOENT:
+                    # removed while walking
+                    continue
+                raise error
+            self._watches[wd] = reldir
+            files.update(join(reldir, f) for f in filenames)
+        return files
+
+    def _read_events(self):
+        data = b''
+        while True:
+            try:
+                chunk = read(self._fd, self.BUFFER_SIZE)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield wd, mask, name
+
+    def wait(self, timeout=None):
+        """
+        Waits for changes for up to `timeout` seconds. Returns a set of changed
+        paths relative to root, or None when the changes are unknown.
+        """
+        ready, _, _ = select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        changes = set()
+        for wd, mask, name in self._read_events():
+            if mask & self.IN_Q_OVERFLOW:
+                logger.info("The inotify queue overflowed")
+                return None
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            reldir = self._watches.get(wd)
+            if reldir is None or not name:
+                continue
+            path = join(reldir, name)
+            if is_ignored(path, self.ignore):
+                continue
+            changes.add(path)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                changes.update(self._add_tree(path))
+        return changes
+
+    def close(self):
+        if self._fd >= 0:
+            close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """Watches a directory tree by scanning it with a FileIndex every `interval` seconds."""
+
+    def __init__(self, root, ignore=(), interval=1.0):
+        self.root = root
+        self.ignore = tuple(ignore)
+        self.interval = interval
+        exclude = [p for p in self.ignore if '/' not in p and not has_magic(p)]
+        # the index is never saved, so the stored index of the project isn't changed
+        self._index = FileIndex(root, exclude=exclude)
+        self._index.update()
+
+    def wait(self, timeout=None):
+        end = None if timeout is None else time() + timeout
+        while True:
+            changes = {p for p in self._index.update().paths if not is_ignored(p, self.ignore)}
+            if changes:
+                return changes
+            if end is not None and time() >= end:
+                return set()
+            delay = self.interval if end is None else min(self.interval, end - time())
+            sleep(max(0, delay))
+
+    def close(self):
+        pass
+
+
+def create_watcher(root, ignore=()):
+    ignore = DEFAULT_IGNORE + tuple(ignore)
+    try:
+        return InotifyWatcher(root, ignore)
+    except OSError as err:
+        logger.info("Using polling to watch for changes: %s", err)
+        return PollingWatcher(root, ignore)
+
+
+def wait_for_changes(watcher, debounce=0.5, timeout=None):
+    """
+    Waits until files change and then until there are no more changes for
+    `debounce` seconds. Returns the changes like watcher.wait().
+    """
+    changes = watcher.wait(timeout)
+    if changes is not None and not changes:
+        return changes
+    while True:
+        more = watcher.wait(debounce)
+        if more is None:
+            changes = None
+        elif not more:
+            return changes
+        elif changes is not None:
+            changes |= more
@@ -0,0 +1,152 @@
+from threading import Barrier, Event
+from unittest import TestCase
+from unittest.mock import MagicMock, call, patch
+
+import docker
+
+from apluslms_roman.backends import BackendContext, BuildStep, BuildTask
+from apluslms_roman.backends.docker import DockerBackend
+
+
+class TestDockerPrepare(TestCase):
+
+    def setUp(self):
+        self.backend = DockerBackend(BackendContext(1000, 1000, {}))
+        self.client = self.backend.__dict__['_client'] = MagicMock()
+        self.cache = self.backend.__dict__['_cache'] = MagicMock(images={})
+        self.observer = MagicMock()
+
+    def test_missingImages_shouldBePulledConcurrently(self):
+        steps = [BuildStep(i, 'img%d' % i) for i in range(3)]
+        barrier = Barrier(3, timeout=5)
+        def pull(*args, **kwargs):
+            barrier.wait() # fails, if the pulls are not concurrent
+            return iter(())
+        self.client.images.get.side_effect = docker.errors.ImageNotFound('')
+        self.client.api.pull.side_effect = pull
+
+        result = self.backend.prepare(BuildTask('/a', steps), self.observer)
+
+        self.assertTrue(result.ok)
+        self.assertEqual(set(self.cache.images), {s.img for s in steps})
+        for step in steps:
+            self.observer.step_succeeded.assert_any_call(step)
+
+    def test_failedPullWithOldImage_shouldUseOldImage(self):
+        steps = [BuildStep(0, 'old'), BuildStep(1, 'missing')]
+        def get(img):
+            if img.startswith('missing'):
+                raise docker.errors.ImageNotFound('')
+        self.client.images.get.side_effect = get
+        self.client.api.pull.side_effect = lambda *a, **kw: iter([{'error': 'no network'}])
+
+        result = self.backend.prepare(BuildTask('/a', steps), self.observer)
+
+        self.assertTrue(result.failed)
+        self.assertIs(result.step, steps[1])
+        self.observer.step_succeeded.assert_called_once_with(steps[0])
+        self.observer.step_failed.assert_called_once_with(steps[1])
+
+    def test_failedPull_shouldCancelQueuedSteps(self):
+        backend = DockerBackend(BackendContext(1000, 1000, {'DOCKER_PULL_JOBS': '1'}))
+        backend.__dict__['_client'] = self.client
+        backend.__dict__['_cache'] = self.cache
+        steps = [BuildStep(0, 'missing'), BuildStep(1, 'slow'), BuildStep(2, 'queued')]
+        released = Event()
+        def get(img):
+            if img.startswith('missing'):
+                raise docker.errors.ImageNotFound('')
+            released.wait(5)
+        self.client.images.get.side_effect = get
+        self.client.api.pull.side_effect = lambda *a, **kw: iter([{'error': 'no network'}])
+        self.observer.step_cancelled.side_effect = lambda step: released.set()
+
+        result = backend.prepare(BuildTask('/a', steps), self.observer)
+
+        self.assertTrue(result.failed)
+        self.assertIs(result.step, steps[0])
+        self.assertIn(call(steps[2]), self.observer.step_cancelled.call_args_list)
+        completed = self.observer.step_cancelled.call_args_list + \
+            self.observer.step_succeeded.call_args_list
+        self.assertEqual(sorted(c[0][0].ref for c in completed), [1, 2])
+
+
+class TestDockerReuseContainers(TestCase):
+
+    def setUp(self):
+        self.backend = DockerBackend(BackendContext(1000, 1000, {
+            'DOCKER_REUSE_CONTAINERS': 'true'}))
+        self.client = self.backend.__dict__['_client'] = MagicMock()
+        self.backend.__dict__['_cache'] = MagicMock(images={})
+        self.client.images.get.return_value.attrs = {
+            'Config': {'Entrypoint': ['/entry'], 'Cmd': ['default']}}
+        self.client.api.exec_start.side_effect = lambda *a, **kw: iter([b'hello\n'])
+        self.client.api.exec_inspect.return_value = {'ExitCode': 0}
+        self.container = self.client.containers.create.return_value
+        self.container.exec_run.return_value = MagicMock(exit_code=0)
+
+    def tearDown(self):
+        self.backend.cleanup()
+
+    def test_stepsWithSameImage_shouldShareContainer(self):
+        steps = [
+            BuildStep(0, 'img'),
+            BuildStep(1, 'img', cmd='make html', step_env=[{'A': '1'}]),
+        ]
+        task = BuildTask('/a', steps)
+        observer = MagicMock()
+
+        result = self.backend.build(task, observer)
+
+        self.assertTrue(result.ok)
+        self.client.containers.create.assert_called_once()
+        calls = self.client.api.exec_create.call_args_list
+        commands = [call[0][1] for call in calls if call[0][1][0] == '/entry']
+        self.assertEqual(commands, [['/entry', 'default'], ['/entry', 'make', 'html']])
+        environments = [call[1]['environment'] for call in calls if call[0][1][0] == '/entry']
+        self.assertEqual([dict(env) for env in environments], [{}, {'A': '1'}])
+        observer.container_msg.assert_called_with(steps[1], 'hello\n')
+
+    def test_newWorker_shouldNotBeReset(self):
+        task = BuildTask('/a', [BuildStep(0, 'img')])
+        self.backend.build(task, MagicMock())
+        self.container.exec_run.assert_not_called()
+        self.backend.build(task, MagicMock())
+        self.container.exec_run.assert_called_once()
+
+    def test_failedReset_shouldDiscardWorker(self):
+        task = BuildTask('/a', [BuildStep(0, 'img')])
+        self.backend.build(task, MagicMock())
+        self.container.exec_run.return_value = MagicMock(exit_code=1)
+        def run_container(step, opts, observer):
+            self.backend._start_running(step, MagicMock())
+            return {'StatusCode': 0}
+        with patch.object(self.backend, '_run_container', side_effect=run_container) as run_mock:
+            self.assertTrue(self.backend.build(task, MagicMock()).ok)
+        run_mock.assert_called_once()
+        self.container.remove.assert_called_once_with(force=True)
+        self.assertEqual(self.backend._workers._all, set())
+
+    def test_cleanup_shouldRemoveWorkers(self):
+        self.backend.build(BuildTask('/a', [BuildStep(0, 'img')]), MagicMock())
+        container = self.client.containers.create.return_value
+        container.remove.assert_not_called()
+        self.backend.cleanup()
+        container.remove.assert_called_once_with(force=True)
+
+
+class TestDockerRunOpts(TestCase):
+
+    def test_stepResources_shouldBeLimits(self):
+        backend = DockerBackend(BackendContext(1000, 1000, {}))
+        step = BuildStep(0, 'img', cpus=1.5, memory='512m')
+        opts = backend._run_opts(BuildTask('/a', [step]), step)
+        self.assertEqual(opts['nano_cpus'], 1500000000)
+        self.assertEqual(opts['mem_limit'], 512 * 2**20)
+
+    def test_withoutResources_shouldNotLimit(self):
+        backend = DockerBackend(BackendContext(1000, 1000, {}))
+        step = BuildStep(0, 'img')
+        opts = backend._run_opts(BuildTask('/a', [step]), step)
+        self.assertNotIn('nano_cpus', opts)
+        self.assertNotIn('mem_limit', opts)
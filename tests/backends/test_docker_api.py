@@ -0,0 +1,196 @@
+import json
+import socket
+from http.client import HTTPConnection
+from io import StringIO
+from os import environ
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Timer
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import docker
+
+from apluslms_roman.builder import Engine
+from apluslms_roman.configuration import ProjectConfig
+from apluslms_roman.observer import StreamObserver
+from apluslms_roman.metrics import (
+    CONTAINER_START_LATENCY,
+    IMAGE_PULL_BYTES,
+    IMAGE_PULL_DURATION,
+    LOG_BYTES,
+    REGISTRY,
+)
+from apluslms_roman.tracing import start_tracing, stop_tracing
+
+from ..docker_api import DockerApiServer
+
+
+class UnixHTTPConnection(HTTPConnection):
+
+    def __init__(self, path, timeout=5):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def docker_api_error(server):
+    """Returns the reason, why docker-py can't use the server, or None."""
+    try:
+        docker.from_env(environment={'DOCKER_HOST': server.url}).ping()
+    except Exception as err:
+        # e.g. docker-py 3 doesn't support requests 2.32 or urllib3 2
+        return "docker-py can't connect to the stand-in: {}".format(err)
+    return None
+
+
+class DockerApiTestCase(TestCase):
+    """Runs the DockerBackend with docker-py against the Docker API stand-in."""
+    server_options = {}
+
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = tmp.name
+        self.server = self.start_server(**self.server_options)
+        error = docker_api_error(self.server)
+        if error:
+            self.skipTest(error)
+
+    def start_server(self, **options):
+        options.setdefault('images', ['hello-world'])
+        server = DockerApiServer(join(self.path, 'docker.sock'), **options).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def create_builder(self, steps, **options):
+        config = ProjectConfig(ProjectConfig.Container(join(self.path, 'roman.yml'),
+            allow_missing=True), None, {'version': '2.0', 'steps': steps},
+            ProjectConfig.version)
+        with patch.dict(environ, {'DOCKER_HOST': self.server.url}):
+            engine = Engine()
+        # don't touch the image cache of the user
+        engine.backend.__dict__['_cache'] = MagicMock(images={})
+        self.output = StringIO()
+        observer = StreamObserver(self.output, colors=False)
+        return engine.create_builder(config, observer=observer)
+
+
+class TestDockerApiServer(TestCase):
+    """Tests the stand-in over HTTP, so they run without a working docker-py."""
+
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.server = DockerApiServer(join(tmp.name, 'docker.sock'), images=['hello-world'],
+            log_lines=3).start()
+        self.addCleanup(self.server.stop)
+        self.connection = UnixHTTPConnection(self.server.path)
+        self.addCleanup(self.connection.close)
+
+    def request(self, method, path, body=None):
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+    def test_ping_shouldReturnOk(self):
+        self.assertEqual(self.request('GET', '/v1.35/_ping'), (200, b'OK'))
+
+    def test_emptyResponse_shouldKeepConnectionUsable(self):
+        status, data = self.request('POST', '/v1.35/containers/create',
+            {'Image': 'hello-world', 'Cmd': ['make', 'html']})
+        self.assertEqual(status, 201)
+        container = json.loads(data.decode('utf-8'))['Id']
+        self.assertEqual(self.request('POST', '/v1.35/containers/{}/start'.format(container)),
+            (204, b''))
+        status, data = self.request('POST', '/v1.35/containers/{}/wait'.format(container))
+        self.assertEqual((status, json.loads(data.decode('utf-8'))['StatusCode']), (200, 0))
+        status, data = self.request('GET', '/v1.35/containers/{}/logs?stdout=1'.format(container))
+        self.assertEqual(status, 200)
+        self.assertIn(b'make html\n', data)
+        self.assertEqual(self.request('DELETE', '/v1.35/containers/' + container), (204, b''))
+        self.assertEqual(self.server.count('remove'), 1)
+
+    def test_missingImage_shouldFail(self):
+        status, _ = self.request('POST', '/v1.35/containers/create', {'Image': 'missing'})
+        self.assertEqual(status, 404)
+
+
+class TestDockerApi(DockerApiTestCase):
+    server_options = {'log_lines': 3, 'exit_code': {'failing:latest': 3}}
+
+    def test_build_shouldRunContainersAndStreamLogs(self):
+        builder = self.create_builder([
+            {'img': 'hello-world', 'cmd': 'make html'},
+            {'img': 'new-image', 'cmd': 'make touchrst'},
+        ])
+        result = builder.build()
+        self.assertTrue(result.ok, str(result))
+        output = self.output.getvalue()
+        self.assertIn("  >> make html\n", output)
+        self.assertIn("  >> make touchrst\n", output)
+        self.assertEqual(self.server.count('pull'), 2)
+        self.assertEqual(len(self.server.created), 2)
+        self.assertEqual(self.server.containers, {})
+        mounts = self.server.created[0].config['HostConfig']['Mounts']
+        self.assertIn(join(self.path, '_build'), [m.get('Source') for m in mounts])
+
+    def test_tracing_shouldRecordDockerOperations(self):
+        builder = self.create_builder(['hello-world'])
+        tracer = start_tracing()
+        try:
+            builder.build()
+        finally:
+            stop_tracing()
+        names = {event['name'] for event in tracer.get_events()}
+        for name in ('image.check', 'image.pull', 'container.create', 'container.start',
+                'container.logs', 'container.wait', 'container.remove'):
+            self.assertIn(name, names)
+
+    def test_metrics_shouldRecordPullsContainersAndLogs(self):
+        REGISTRY.reset()
+        try:
+            self.assertTrue(self.create_builder(['hello-world']).build().ok)
+            self.assertEqual(IMAGE_PULL_DURATION.get(image='hello-world:latest')[0], 1)
+            self.assertEqual(IMAGE_PULL_BYTES.get(image='hello-world:latest'), 1024)
+            self.assertEqual(CONTAINER_START_LATENCY.get()[0], 1)
+            self.assertGreater(LOG_BYTES.get(step='0'), 0)
+        finally:
+            REGISTRY.reset()
+
+    def test_failingContainer_shouldFailBuild(self):
+        result = self.create_builder([{'img': 'failing', 'cmd': 'false'}]).build()
+        self.assertEqual(result.code, 3)
+        self.assertIn("Build failed on step 0: exit code 3", self.output.getvalue())
+
+    def test_apiFailure_shouldFailStep(self):
+        self.server.failures['create'] = 1
+        result = self.create_builder(['hello-world']).build()
+        self.assertTrue(result.failed)
+        self.assertIn("injected failure in create", result.error)
+
+    def test_imageWithoutPullAccess_shouldFailPreparation(self):
+        self.server.pullable = set()
+        result = self.create_builder(['private/image']).build()
+        self.assertTrue(result.failed)
+        self.assertEqual(len(self.server.created), 0)
+
+
+class TestDockerApiCancel(DockerApiTestCase):
+    server_options = {'log_lines': 100, 'log_rate': 10}
+
+    def test_cancel_shouldKillContainer(self):
+        builder = self.create_builder(['hello-world', 'hello-world'])
+        Timer(0.5, builder.cancel).start()
+        result = builder.build()
+        self.assertTrue(result.cancelled)
+        self.assertEqual(self.server.count('kill'), 1)
+        self.assertEqual(len(self.server.created), 1)
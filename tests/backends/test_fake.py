@@ -0,0 +1,103 @@
+import json
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Timer
+from time import time
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from apluslms_roman.backends import BackendContext, BuildStep, BuildTask
+from apluslms_roman.backends.fake import FakeBackend, ReplayRecorder
+from apluslms_roman.observer import BuildObserver
+
+
+def get_output(observer):
+    return ''.join(call[0][1] for call in observer.container_msg.call_args_list).splitlines()
+
+
+class ListObserver(BuildObserver):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def _message(self, phase, type_, step=None, state=None, data=None):
+        self.messages.append((phase, type_, step, state, data))
+
+
+class TestFakeBackend(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.observer = MagicMock()
+
+    def create_backend(self, replay, speed=0):
+        path = join(self.tmp.name, 'replay.json')
+        with open(path, 'w') as f:
+            json.dump(dict(replay, version=1), f)
+        return FakeBackend(BackendContext(1000, 1000, {
+            'FAKE_REPLAY': path, 'FAKE_SPEED': str(speed)}))
+
+    def test_replay_shouldSendOutputAndExitCode(self):
+        backend = self.create_backend({'steps': {
+            'html': {'output': [[0, 'first'], [0.1, 'second']], 'code': 2}}})
+        step = BuildStep(0, 'img', name='html')
+        result = backend.build(BuildTask('/a', [step]), self.observer)
+        self.assertEqual(result.code, 2)
+        self.assertEqual(get_output(self.observer), ['first', 'second'])
+
+    def test_default_shouldGenerateLines(self):
+        backend = self.create_backend({'default': {'lines': 5, 'line_length': 3}})
+        result = backend.build(BuildTask('/a', [BuildStep(0, 'img')]), self.observer)
+        self.assertTrue(result.ok)
+        self.assertEqual(get_output(self.observer), ['xxx'] * 5)
+
+    def test_prepareError_shouldFailPreparation(self):
+        backend = self.create_backend({'steps': {'0': {'prepare_error': 'no image'}}})
+        result = backend.prepare(BuildTask('/a', [BuildStep(0, 'img')]), self.observer)
+        self.assertEqual(result.error, 'no image')
+
+    def test_cancel_shouldStopWaiting(self):
+        backend = self.create_backend({'default': {'duration': 10}}, speed=1)
+        step = BuildStep(0, 'img')
+        Timer(0.1, backend.cancel_step, (step,)).start()
+        start = time()
+        result = backend.build(BuildTask('/a', [step]), self.observer)
+        self.assertTrue(result.cancelled)
+        self.assertLess(time() - start, 5)
+
+
+class TestReplayRecorder(TestCase):
+
+    def test_recording_shouldBeReplayed(self):
+        step = BuildStep(0, 'img', name='html')
+        observer = ListObserver()
+        recorder = ReplayRecorder(observer)
+        recorder.enter_prepare()
+        recorder.step_preflight(step)
+        recorder.step_succeeded(step)
+        recorder.enter_build()
+        recorder.step_running(step)
+        recorder.container_msg(step, "hello\nworld")
+        recorder.step_failed(step)
+        recorder.result_msg(MagicMock(ok=False, cancelled=False, code=4, error=None, step=step))
+        recorder.done()
+
+        replay = recorder.get_replay()
+        run = replay['steps']['html']
+        self.assertEqual(run['code'], 4)
+        self.assertEqual([line for _, line in run['output']], ['hello', 'world'])
+        self.assertIn('duration', run)
+        self.assertIn('prepare', run)
+        self.assertEqual(observer.messages[-1][0].name, 'DONE')
+
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, 'replay.json')
+            recorder.save(path)
+            backend = FakeBackend(BackendContext(1000, 1000, {
+                'FAKE_REPLAY': path, 'FAKE_SPEED': '0'}))
+            replayed = MagicMock()
+            result = backend.build(BuildTask('/a', [step]), replayed)
+        self.assertEqual(result.code, 4)
+        self.assertEqual(get_output(replayed), ['hello', 'world'])
@@ -0,0 +1,66 @@
+from os import makedirs
+from os.path import join, realpath
+from tempfile import TemporaryDirectory
+from threading import Timer
+from time import time
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from apluslms_roman.backends import BackendContext, BuildStep, BuildTask
+from apluslms_roman.backends.local import LocalBackend
+
+
+class TestLocalBackend(TestCase):
+
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = realpath(tmp.name)
+        makedirs(join(self.path, '_build'))
+        self.backend = LocalBackend(BackendContext(1000, 1000, {}))
+        self.observer = MagicMock()
+
+    def output(self):
+        return ''.join(call[0][1] for call in self.observer.container_msg.call_args_list)
+
+    def build(self, *steps):
+        return self.backend.build(BuildTask(self.path, list(steps)), self.observer)
+
+    def test_step_shouldSeeSourceAndBuildInWorkDir(self):
+        with open(join(self.path, 'index.rst'), 'w') as f:
+            f.write('hello')
+        result = self.build(BuildStep(0, 'img', cmd=['sh', '-c', 'cp src/index.rst build/']))
+        self.assertTrue(result.ok)
+        with open(join(self.path, '_build', 'index.rst')) as f:
+            self.assertEqual(f.read(), 'hello')
+
+    def test_step_shouldGetEnvironment(self):
+        step = BuildStep(0, 'img', cmd=['sh', '-c', 'echo $A $ROMAN_BUILD_PATH'],
+            step_env=[{'A': 'value'}])
+        self.assertTrue(self.build(step).ok)
+        self.assertEqual(self.output(), 'value {}\n'.format(join(self.path, '_build')))
+
+    def test_stepWithMnt_shouldRunInProject(self):
+        self.assertTrue(self.build(BuildStep(0, 'img', cmd='pwd', mnt='/content')).ok)
+        self.assertEqual(self.output(), self.path + '\n')
+
+    def test_failingStep_shouldReturnExitCode(self):
+        step = BuildStep(0, 'img', cmd=['sh', '-c', 'exit 3'])
+        result = self.build(step)
+        self.assertEqual(result.code, 3)
+        self.observer.step_failed.assert_called_once_with(step)
+
+    def test_prepare_shouldFailWithoutCommand(self):
+        steps = [BuildStep(0, 'img'), BuildStep(1, 'img', cmd='missing-roman-command')]
+        result = self.backend.prepare(BuildTask(self.path, steps), self.observer)
+        self.assertTrue(result.failed)
+        self.assertIs(result.step, steps[0])
+        self.assertEqual(self.observer.step_failed.call_count, 2)
+
+    def test_cancel_shouldKillProcess(self):
+        step = BuildStep(0, 'img', cmd='sleep 10')
+        Timer(0.1, self.backend.cancel_step, (step,)).start()
+        start = time()
+        result = self.build(step)
+        self.assertTrue(result.cancelled)
+        self.assertLess(time() - start, 5)
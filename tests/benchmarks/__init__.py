@@ -0,0 +1,69 @@
+"""
+Benchmarks, which are run only when ROMAN_BENCHMARK is set:
+
+    ROMAN_BENCHMARK=1 python -m unittest discover -t . -s tests/benchmarks
+
+Results are compared to baseline.json and a benchmark fails, when it's slower
+than the baseline times ROMAN_BENCHMARK_TOLERANCE (default 2). The baseline
+is updated with ROMAN_BENCHMARK=update. Commit the updated baseline with
+changes, which make roman faster or knowingly slower.
+"""
+import json
+import sys
+from os import environ
+from os.path import dirname, exists, join
+from time import perf_counter
+from unittest import skipUnless
+
+
+BASELINE_PATH = join(dirname(__file__), 'baseline.json')
+MODE = environ.get('ROMAN_BENCHMARK')
+TOLERANCE = float(environ.get('ROMAN_BENCHMARK_TOLERANCE', 2))
+# seconds, which are allowed on top of the tolerance, as short times are noisy
+SLACK = 0.002
+
+benchmark = skipUnless(MODE, "set ROMAN_BENCHMARK=1 to run benchmarks")
+
+
+def measure(func, repeat=3):
+    """Returns the shortest time in seconds of `repeat` calls of func()."""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def load_baseline():
+    if not exists(BASELINE_PATH):
+        return {}
+    with open(BASELINE_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(name, seconds):
+    baseline = load_baseline()
+    baseline[name] = round(seconds, 6)
+    with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def report(name, seconds, count=None, unit='ops'):
+    rate = ' ({:.0f} {}/s)'.format(count / seconds, unit) if count and seconds else ''
+    print("{}: {:.4f}s{}".format(name, seconds, rate), file=sys.__stderr__)
+
+
+class BenchmarkMixin:
+    """Adds check(), which reports a result and compares it to the baseline."""
+
+    def check(self, name, seconds, count=None, unit='ops'):
+        report(name, seconds, count, unit)
+        if MODE == 'update':
+            save_baseline(name, seconds)
+            return
+        baseline = load_baseline().get(name)
+        if baseline is not None and seconds > baseline * TOLERANCE + SLACK:
+            self.fail("{} took {:.4f}s, which is over {} times the baseline {:.4f}s"
+                .format(name, seconds, TOLERANCE, baseline))
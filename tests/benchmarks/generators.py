@@ -0,0 +1,50 @@
+"""Generators of synthetic courses for the benchmarks."""
+from os.path import join
+
+from apluslms_yamlidator.utils.yaml import rt_dump as yaml_dump
+
+
+def make_environment(size, chained=True):
+    """
+    Returns a list of `size` variables. With `chained`, each variable refers
+    to the previous one, so expanding the last one expands the whole chain.
+    """
+    env = [{'VAR_0': 'value'}]
+    for i in range(1, size):
+        value = '${{VAR_{}}}/{}'.format(i - 1, i) if chained else 'value {}'.format(i)
+        env.append({'VAR_{}'.format(i): value})
+    return env
+
+
+def make_steps(count, env_size=0, depends=False):
+    """Returns `count` step configurations with `env_size` variables each."""
+    steps = []
+    for i in range(count):
+        step = {
+            'img': 'apluslms/compile-rst:{}'.format(i % 10),
+            'name': 'step-{}'.format(i),
+            'cmd': 'make html STEP={}'.format(i),
+        }
+        if env_size:
+            step['env'] = [{'STEP_{}'.format(j): '${{VAR_0}}-{}'.format(j)}
+                for j in range(env_size)]
+        if depends:
+            step['depends_on'] = [i - 1] if i else []
+        steps.append(step)
+    return steps
+
+
+def make_config_data(steps, env_size=0):
+    return {'version': '2.0', 'steps': make_steps(steps, env_size, depends=True)}
+
+
+def write_course(path, steps, env_size=0):
+    """Writes roman.yml with `steps` steps to path and returns its path."""
+    filename = join(path, 'roman.yml')
+    with open(filename, 'w') as f:
+        f.write(yaml_dump(make_config_data(steps, env_size)))
+    return filename
+
+
+def make_log_lines(count, length=80):
+    return ['{:06d} {}'.format(i, 'x' * max(0, length - 7)) for i in range(count)]
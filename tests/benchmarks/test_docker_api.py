@@ -0,0 +1,32 @@
+from ..backends.test_docker_api import DockerApiTestCase
+from . import BenchmarkMixin, benchmark, measure
+
+
+@benchmark
+class BenchmarkDockerApi(BenchmarkMixin, DockerApiTestCase):
+    """Measures the overhead of DockerBackend and docker-py per step and log line."""
+    server_options = {'log_lines': 1}
+
+    def build(self, steps, **options):
+        def run():
+            result = self.create_builder(steps).build(**options)
+            self.assertTrue(result.ok, str(result))
+        return measure(run)
+
+    def test_manySteps(self):
+        steps = [{'img': 'hello-world', 'cmd': 'step %d' % i} for i in range(50)]
+        self.check('docker_api.50_steps', self.build(steps), 50, 'steps')
+
+    def test_manyStepsInParallel(self):
+        steps = [{'img': 'hello-world', 'cmd': 'step %d' % i, 'depends_on': []}
+            for i in range(50)]
+        self.check('docker_api.50_steps_4_jobs', self.build(steps, jobs=4), 50, 'steps')
+
+    def test_logThroughput(self):
+        self.server.log_lines = 20000
+        self.check('docker_api.20000_lines', self.build(['hello-world']), 20000, 'lines')
+
+    def test_latency(self):
+        self.server.latency = 0.01
+        steps = [{'img': 'hello-world', 'cmd': 'step %d' % i} for i in range(10)]
+        self.check('docker_api.10_steps_10ms_latency', self.build(steps), 10, 'steps')
@@ -0,0 +1,103 @@
+from io import StringIO
+from os import devnull
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from apluslms_roman.backends import BuildStep
+from apluslms_roman.builder import Builder
+from apluslms_roman.configuration import ProjectConfig
+from apluslms_roman.log_pipeline import LogPipeline
+from apluslms_roman.observer import JsonLinesObserver, StreamObserver
+from apluslms_roman.utils.env import EnvDict
+
+from . import BenchmarkMixin, benchmark, measure
+from .generators import make_environment, make_log_lines, write_course
+
+
+STEP_COUNTS = (10, 100, 1000, 10000)
+
+
+@benchmark
+class BenchmarkProjectConfig(BenchmarkMixin, TestCase):
+
+    def test_loadAndValidate(self):
+        for count in STEP_COUNTS:
+            with TemporaryDirectory() as tmp:
+                path = write_course(tmp, count, env_size=2)
+                def load():
+                    ProjectConfig.load(path).validate()
+                seconds = measure(load, repeat=1 if count > 1000 else 3)
+            self.check('config.load_validate.{}_steps'.format(count), seconds, count, 'steps')
+
+
+@benchmark
+class BenchmarkGetSteps(BenchmarkMixin, TestCase):
+
+    def test_getSteps(self):
+        environment = make_environment(20)
+        for count in STEP_COUNTS:
+            with TemporaryDirectory() as tmp:
+                config = ProjectConfig.load(write_course(tmp, count, env_size=5))
+                builder = Builder(MagicMock(), config, environment=environment)
+                seconds = measure(builder.get_steps, repeat=1 if count > 1000 else 3)
+            self.check('builder.get_steps.{}_steps'.format(count), seconds, count, 'steps')
+
+
+@benchmark
+class BenchmarkEnvDict(BenchmarkMixin, TestCase):
+
+    def test_chainedVariables(self):
+        for size in (10, 100, 1000):
+            env = EnvDict((make_environment(size), 'project'),
+                (make_environment(size, chained=False), 'step'))
+            seconds = measure(env.get_combined)
+            self.check('env.get_combined.{}_chained'.format(size), seconds, size, 'vars')
+
+
+@benchmark
+class BenchmarkStreamObserver(BenchmarkMixin, TestCase):
+
+    def run_observer(self, lines, observer):
+        step = BuildStep(0, 'img')
+        observer.enter_build()
+        observer.step_running(step)
+        for line in lines:
+            observer.container_msg(step, line)
+        observer.step_succeeded(step)
+        observer.done()
+
+    def test_containerMessages(self):
+        lines = make_log_lines(100000)
+        with open(devnull, 'w') as stream:
+            seconds = measure(lambda: self.run_observer(lines,
+                StreamObserver(stream, colors=False)))
+            self.check('observer.stream.100000_lines', seconds, len(lines), 'lines')
+            seconds = measure(lambda: self.run_observer(lines, JsonLinesObserver(stream)))
+            self.check('observer.jsonl.100000_lines', seconds, len(lines), 'lines')
+        seconds = measure(lambda: self.run_observer(lines,
+            StreamObserver(StringIO(), colors=True)))
+        self.check('observer.stream_colors.100000_lines', seconds, len(lines), 'lines')
+
+
+@benchmark
+class BenchmarkLogPipeline(BenchmarkMixin, TestCase):
+
+    def run_pipeline(self, stream, chunks):
+        step = BuildStep(0, 'img')
+        observer = StreamObserver(stream, colors=False)
+        observer.enter_build()
+        observer.step_running(step)
+        with LogPipeline(observer, step) as log:
+            for chunk in chunks:
+                log.feed(chunk)
+        observer.step_succeeded(step)
+        observer.done()
+
+    def test_chunkedOutput(self):
+        lines = make_log_lines(100000)
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+        with open(devnull, 'w') as stream:
+            seconds = measure(lambda: self.run_pipeline(stream, chunks))
+        self.check('log_pipeline.100000_lines', seconds, len(lines), 'lines')
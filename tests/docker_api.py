@@ -0,0 +1,352 @@
+"""
+A stand-in for the Docker Engine API, which serves the subset of the API used
+by DockerBackend over HTTP on a Unix domain socket. Point DOCKER_HOST to
+`server.url` to use it with docker-py.
+
+Knobs:
+    latency      - seconds added to every request
+    log_lines    - number of generated log lines per container
+    log_line_length - length of the generated log lines
+    log_rate     - log lines per second, None streams them as fast as possible
+    exit_code    - exit code of containers, or a dict from image to exit code
+    images       - images, which exist locally
+    pullable     - images, which can be pulled, None allows all images
+    failures     - a dict from an operation to a number of failures or True,
+                   e.g. {'create': 1}, which fail with HTTP 500
+
+Operations: ping, version, inspect_image, pull, create, inspect, start, logs,
+wait, kill, remove and list. Exec (reused containers) is not supported.
+"""
+import json
+import re
+import struct
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler
+from os import remove
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Event, Lock, Thread, Timer
+from time import sleep, time
+from urllib.parse import parse_qs, unquote, urlsplit
+from uuid import uuid4
+
+
+def image_id(name):
+    return 'sha256:' + sha256(name.encode('utf-8')).hexdigest()
+
+
+def full_image_name(name):
+    return name if ':' in name.rsplit('/', 1)[-1] else name + ':latest'
+
+
+class Container:
+
+    def __init__(self, config, output, exit_code):
+        self.id = uuid4().hex + uuid4().hex
+        self.config = config
+        self.output = output
+        self.exit_code = exit_code
+        self.started = None
+        self.killed = Event()
+        self.done = Event()
+
+    def inspect(self):
+        return {
+            'Id': self.id,
+            'Name': '/' + self.id[:12],
+            'Image': image_id(self.config['Image']),
+            'Config': {
+                'Image': self.config['Image'],
+                'Cmd': self.config.get('Cmd'),
+                'Env': self.config.get('Env'),
+                'Labels': self.config.get('Labels') or {},
+                'Tty': False,
+            },
+            'HostConfig': self.config.get('HostConfig') or {},
+            'State': {
+                'Running': self.started is not None and not self.done.is_set(),
+                'ExitCode': self.exit_code,
+            },
+        }
+
+
+class DockerApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        ('GET', r'/_ping', 'ping'),
+        ('GET', r'/version', 'version'),
+        ('GET', r'/images/(?P<name>.+)/json', 'inspect_image'),
+        ('POST', r'/images/create', 'pull'),
+        ('POST', r'/containers/create', 'create'),
+        ('GET', r'/containers/json', 'list'),
+        ('GET', r'/containers/(?P<id>[^/]+)/json', 'inspect'),
+        ('POST', r'/containers/(?P<id>[^/]+)/start', 'start'),
+        ('GET', r'/containers/(?P<id>[^/]+)/logs', 'logs'),
+        ('POST', r'/containers/(?P<id>[^/]+)/wait', 'wait'),
+        ('POST', r'/containers/(?P<id>[^/]+)/kill', 'kill'),
+        ('DELETE', r'/containers/(?P<id>[^/]+)', 'remove'),
+    ]
+    ROUTES = [(method, re.compile(r'^(/v[0-9.]+)?' + path + '$'), name)
+        for method, path, name in ROUTES]
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        return 'unix'
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.body = json.loads(body.decode('utf-8')) if body else None
+        for route_method, regex, name in self.ROUTES:
+            match = regex.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return self.send_json({'message': 'page not found'}, 404)
+        server = self.server
+        server.record(name, method, path)
+        if server.latency:
+            sleep(server.latency)
+        if server.should_fail(name):
+            return self.send_json({'message': 'injected failure in ' + name}, 500)
+        getattr(self, 'op_' + name)(**match.groupdict())
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def send_body(self, data, status=200, content_type='application/json'):
+        self.send_response(status)
+        # a 204 response has no body and no body headers
+        if status != 204:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode('utf-8'), status)
+
+    def start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def send_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def end_chunked(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def get_container(self, id):
+        container = self.server.find_container(id)
+        if container is None:
+            self.send_json({'message': 'No such container: ' + id}, 404)
+        return container
+
+    def op_ping(self):
+        self.send_body(b'OK', content_type='text/plain')
+
+    def op_version(self):
+        self.send_json({'Version': '18.09.0-standin', 'ApiVersion': '1.35',
+            'MinAPIVersion': '1.12', 'Os': 'linux', 'Arch': 'amd64'})
+
+    def op_inspect_image(self, name):
+        name = full_image_name(name)
+        if name not in self.server.images:
+            return self.send_json({'message': 'No such image: ' + name}, 404)
+        self.send_json({'Id': image_id(name), 'RepoTags': [name],
+            'Config': {'Entrypoint': None, 'Cmd': ['/bin/sh']}})
+
+    def op_pull(self):
+        name = full_image_name('{}:{}'.format(
+            self.query.get('fromImage'), self.query.get('tag') or 'latest'))
+        self.start_chunked('application/json')
+        pullable = self.server.pullable
+        if pullable is not None and name not in pullable:
+            self.send_chunk(json.dumps({'error': 'pull access denied for ' + name})
+                .encode('utf-8'))
+        else:
+            for current in (0, 512, 1024):
+                self.send_chunk(json.dumps({'status': 'Downloading', 'id': 'layer',
+                    'progressDetail': {'current': current, 'total': 1024}}).encode('utf-8'))
+            self.server.images.add(name)
+            self.send_chunk(json.dumps({'status': 'Downloaded newer image for ' + name})
+                .encode('utf-8'))
+        self.end_chunked()
+
+    def op_create(self):
+        image = full_image_name(self.body['Image'])
+        if image not in self.server.images:
+            return self.send_json({'message': 'No such image: ' + image}, 404)
+        container = self.server.add_container(self.body)
+        self.send_json({'Id': container.id, 'Warnings': []}, 201)
+
+    def op_list(self):
+        with self.server.lock:
+            containers = list(self.server.containers.values())
+        self.send_json([{'Id': c.id, 'Image': c.config['Image'],
+            'Labels': c.config.get('Labels') or {}} for c in containers])
+
+    def op_inspect(self, id):
+        container = self.get_container(id)
+        if container is not None:
+            self.send_json(container.inspect())
+
+    def op_start(self, id):
+        container = self.get_container(id)
+        if container is not None:
+            self.server.start_container(container)
+            self.send_body(b'', 204)
+
+    def op_logs(self, id):
+        container = self.get_container(id)
+        if container is None:
+            return
+        self.start_chunked('application/vnd.docker.raw-stream')
+        rate = self.server.log_rate
+        for i, line in enumerate(container.output):
+            if rate:
+                delay = container.started + i / rate - time()
+                if delay > 0 and container.killed.wait(delay):
+                    break
+            elif container.killed.is_set():
+                break
+            data = line.encode('utf-8') + b'\n'
+            # stdout frame of a multiplexed stream
+            self.send_chunk(struct.pack('>BxxxL', 1, len(data)) + data)
+        self.end_chunked()
+
+    def op_wait(self, id):
+        container = self.get_container(id)
+        if container is None:
+            return
+        if not container.done.wait(60):
+            return self.send_json({'message': 'timeout'}, 500)
+        code = 137 if container.killed.is_set() else container.exit_code
+        self.send_json({'StatusCode': code, 'Error': None})
+
+    def op_kill(self, id):
+        container = self.get_container(id)
+        if container is not None:
+            container.killed.set()
+            container.done.set()
+            self.send_body(b'', 204)
+
+    def op_remove(self, id):
+        container = self.get_container(id)
+        if container is not None:
+            container.killed.set()
+            container.done.set()
+            self.server.remove_container(container)
+            self.send_body(b'', 204)
+
+
+class DockerApiServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, latency=0, log_lines=1, log_line_length=40, log_rate=None,
+            exit_code=0, images=(), pullable=None, failures=None):
+        self.path = path
+        self.latency = latency
+        self.log_lines = log_lines
+        self.log_line_length = log_line_length
+        self.log_rate = log_rate
+        self.exit_code = exit_code
+        self.images = {full_image_name(image) for image in images}
+        self.pullable = None if pullable is None else \
+            {full_image_name(image) for image in pullable}
+        self.failures = dict(failures or {})
+        self.lock = Lock()
+        self.containers = {}
+        self.created = []
+        self.requests = []
+        self._thread = None
+        super().__init__(path, DockerApiHandler)
+
+    @property
+    def url(self):
+        return 'unix://' + self.path
+
+    def record(self, name, method, path):
+        with self.lock:
+            self.requests.append((name, method, path))
+
+    def count(self, name):
+        with self.lock:
+            return sum(1 for request in self.requests if request[0] == name)
+
+    def should_fail(self, name):
+        with self.lock:
+            failures = self.failures.get(name)
+            if failures is True:
+                return True
+            if failures:
+                self.failures[name] = failures - 1
+                return True
+        return False
+
+    def get_output(self, config):
+        cmd = config.get('Cmd') or []
+        filler = 'x' * self.log_line_length
+        return [' '.join(cmd)] + ['{} {}'.format(i, filler) for i in range(1, self.log_lines)]
+
+    def get_exit_code(self, config):
+        if isinstance(self.exit_code, dict):
+            return self.exit_code.get(full_image_name(config['Image']), 0)
+        return self.exit_code
+
+    def add_container(self, config):
+        container = Container(config, self.get_output(config), self.get_exit_code(config))
+        with self.lock:
+            self.containers[container.id] = container
+            self.created.append(container)
+        return container
+
+    def find_container(self, id):
+        with self.lock:
+            if id in self.containers:
+                return self.containers[id]
+            for container in self.containers.values():
+                if container.id.startswith(id):
+                    return container
+        return None
+
+    def start_container(self, container):
+        container.started = time()
+        run_time = len(container.output) / self.log_rate if self.log_rate else 0
+        timer = Timer(run_time, container.done.set)
+        timer.daemon = True
+        timer.start()
+
+    def remove_container(self, container):
+        with self.lock:
+            self.containers.pop(container.id, None)
+
+    def start(self):
+        self._thread = Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+        try:
+            remove(self.path)
+        except FileNotFoundError:
+            pass
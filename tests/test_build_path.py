@@ -0,0 +1,123 @@
+from os import listdir, makedirs
+from os.path import dirname, exists, isdir, join, samefile
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from apluslms_roman.build_path import (
+    BUILD_DIR,
+    NEXT_DIR,
+    SEED_COPY,
+    TRASH_DIR,
+    empty_trash,
+    move_to_trash,
+    prepare_build_dir,
+    prepare_next_build_dir,
+    swap_build_dir,
+)
+
+
+class BuildDirTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = self.tmp.name
+        self.build = join(self.path, BUILD_DIR)
+        self.trash = join(self.path, TRASH_DIR)
+
+    def add_file(self, *parts):
+        path = join(self.path, *parts)
+        makedirs(dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('data')
+        return path
+
+
+class TestPrepareBuildDir(BuildDirTestCase):
+
+    def test_missingDirectory_shouldBeCreated(self):
+        self.assertEqual(prepare_build_dir(self.path), self.build)
+        self.assertTrue(isdir(self.build))
+
+    def test_withoutClean_shouldKeepFiles(self):
+        old = self.add_file(BUILD_DIR, 'index.html')
+        prepare_build_dir(self.path)
+        self.assertTrue(exists(old))
+
+    def test_clean_shouldMoveOldDirectoryToTrash(self):
+        self.add_file(BUILD_DIR, 'html', 'index.html')
+        move_to_trash(self.path, self.build)
+        self.assertFalse(exists(self.build))
+        trashed = listdir(self.trash)
+        self.assertEqual(len(trashed), 1)
+        self.assertTrue(exists(join(self.trash, trashed[0], 'html', 'index.html')))
+
+    def test_clean_shouldCreateEmptyDirectory(self):
+        self.add_file(BUILD_DIR, 'html', 'index.html')
+        prepare_build_dir(self.path, clean=True)
+        self.assertEqual(listdir(self.build), [])
+
+    def test_emptyTrash_shouldRemoveTrashInBackground(self):
+        self.add_file(TRASH_DIR, 'old', 'index.html')
+        thread = empty_trash(self.path)
+        thread.join()
+        self.assertFalse(exists(self.trash))
+
+    def test_emptyTrash_withoutTrash_shouldDoNothing(self):
+        self.assertIsNone(empty_trash(self.path))
+
+    def test_leftovers_shouldBeRemovedOnNextRun(self):
+        self.add_file(TRASH_DIR, 'interrupted', 'index.html')
+        prepare_build_dir(self.path)
+        empty_trash(self.path, background=False)
+        self.assertFalse(exists(self.trash))
+
+
+class TestAtomicBuildDir(BuildDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.next = join(self.path, NEXT_DIR)
+
+    def test_next_shouldBeSeededWithHardlinks(self):
+        old = self.add_file(BUILD_DIR, 'html', 'index.html')
+        prepare_next_build_dir(self.path)
+        new = join(self.next, 'html', 'index.html')
+        self.assertTrue(samefile(old, new))
+
+    def test_nextWithCopySeed_shouldBeSeededWithCopies(self):
+        old = self.add_file(BUILD_DIR, 'html', 'index.html')
+        prepare_next_build_dir(self.path, seed=SEED_COPY)
+        new = join(self.next, 'html', 'index.html')
+        self.assertFalse(samefile(old, new))
+        # tools may write to the files in place
+        with open(new, 'w') as f:
+            f.write('new')
+        with open(old) as f:
+            self.assertEqual(f.read(), 'data')
+
+    def test_nextWithClean_shouldBeEmpty(self):
+        self.add_file(BUILD_DIR, 'index.html')
+        prepare_next_build_dir(self.path, clean=True)
+        self.assertEqual(listdir(self.next), [])
+
+    def test_oldNext_shouldBeReplaced(self):
+        self.add_file(NEXT_DIR, 'failed.html')
+        prepare_next_build_dir(self.path)
+        self.assertEqual(listdir(self.next), [])
+
+    def test_swap_shouldReplaceBuildDir(self):
+        self.add_file(BUILD_DIR, 'old.html')
+        self.add_file(NEXT_DIR, 'new.html')
+        swap_build_dir(self.path)
+        self.assertEqual(listdir(self.build), ['new.html'])
+        self.assertFalse(exists(self.next))
+
+    def test_swapWithoutRenameat2_shouldReplaceBuildDir(self):
+        self.add_file(BUILD_DIR, 'old.html')
+        self.add_file(NEXT_DIR, 'new.html')
+        with patch('apluslms_roman.build_path.exchange', side_effect=OSError(38, 'ENOSYS')):
+            swap_build_dir(self.path)
+        self.assertEqual(listdir(self.build), ['new.html'])
+        self.assertFalse(exists(self.next))
@@ -1,7 +1,31 @@
+import asyncio
+from concurrent.futures import Future
+from os import replace
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from threading import Event, Thread, Timer, active_count
+from time import time
 from unittest import TestCase
+from unittest.mock import MagicMock, patch
 
-from apluslms_roman.builder import Builder
-from apluslms_roman.configuration import ProjectConfig
+from apluslms_roman.backends import (
+    AsyncBackend,
+    Backend,
+    BuildResult,
+    BuildStep,
+    BuildTask,
+    SyncBackendAdapter,
+)
+from apluslms_roman.build_path import SEED_COPY
+from apluslms_roman.builder import (
+    AtomicBuildError,
+    Builder,
+    StepScheduler,
+    get_changed_steps,
+    get_step_dependencies,
+    run_coroutine,
+)
+from apluslms_roman.configuration import ProjectConfig, ProjectConfigError
 
 
 class TestBuilderGetSteps(TestCase):
@@ -35,3 +59,392 @@ class TestBuilderGetSteps(TestCase):
         self.assertEqual(steps[0].ref, 2)
 
 
+
+class TestStepDependencies(TestCase):
+
+    def test_withoutDependsOn_shouldDependOnPreviousStep(self):
+        steps = [BuildStep(0, 'a'), BuildStep(1, 'b'), BuildStep(2, 'c')]
+        deps = get_step_dependencies(steps)
+        self.assertEqual(deps[steps[0]], set())
+        self.assertEqual(deps[steps[1]], {steps[0]})
+        self.assertEqual(deps[steps[2]], {steps[1]})
+
+    def test_withDependsOn_shouldResolveNamesAndIndexes(self):
+        steps = [
+            BuildStep(0, 'a', name='first'),
+            BuildStep(1, 'b', depends_on=[]),
+            BuildStep(2, 'c', depends_on=['First', 1]),
+        ]
+        deps = get_step_dependencies(steps)
+        self.assertEqual(deps[steps[1]], set())
+        self.assertEqual(deps[steps[2]], {steps[0], steps[1]})
+
+    def test_withUnselectedDependency_shouldIgnoreIt(self):
+        steps = [BuildStep(2, 'c', depends_on=['0'])]
+        self.assertEqual(get_step_dependencies(steps)[steps[0]], set())
+
+
+class TestProjectConfigDependencies(TestCase):
+
+    def get_config(self, steps):
+        config = {'version': '2.0', 'steps': steps}
+        return ProjectConfig(ProjectConfig.Container(
+            '/a', allow_missing=True), None, config, ProjectConfig.version)
+
+    def test_withUnknownDependency_shouldFail(self):
+        config = self.get_config([{'img': 'a', 'depends_on': ['missing']}])
+        with self.assertRaises(ProjectConfigError):
+            config.validate()
+
+    def test_withCircularDependency_shouldFail(self):
+        config = self.get_config([
+            {'img': 'a', 'depends_on': [1]},
+            {'img': 'b'},
+        ])
+        with self.assertRaises(ProjectConfigError):
+            config.validate()
+
+    def test_withValidDependencies_shouldValidate(self):
+        config = self.get_config([
+            {'img': 'a', 'name': 'first'},
+            {'img': 'b', 'depends_on': []},
+            {'img': 'c', 'depends_on': ['first', 1]},
+        ])
+        config.validate()
+
+
+class SleepBackend(Backend):
+    """Backend, which sleeps for `step.cmd` seconds and fails if it is negative."""
+
+    def __init__(self):
+        super().__init__(None)
+        self.started = []
+        self.cancelled = []
+        self._events = {}
+
+    def build_step(self, task, step, observer):
+        self.started.append(step)
+        event = self._events.setdefault(step, Event())
+        if event.wait(abs(float(step.cmd))):
+            self.cancelled.append(step)
+            return BuildResult(False, step=step)
+        if float(step.cmd) < 0:
+            return BuildResult(code=1, step=step)
+        return BuildResult()
+
+    def cancel_step(self, step):
+        self._events.setdefault(step, Event()).set()
+
+
+class TestStepScheduler(TestCase):
+
+    def run_steps(self, steps, jobs):
+        backend = SleepBackend()
+        task = BuildTask('/a', steps)
+        result = StepScheduler(backend, task, MagicMock(), jobs).run()
+        return backend, result
+
+    def test_independentSteps_shouldRunInParallel(self):
+        steps = [BuildStep(i, 'a', cmd='0.2', depends_on=[]) for i in range(4)]
+        start = time()
+        backend, result = self.run_steps(steps, 4)
+        self.assertTrue(result.ok)
+        self.assertEqual(set(backend.started), set(steps))
+        self.assertLess(time() - start, 0.6)
+
+    def test_dependentSteps_shouldRunInOrder(self):
+        steps = [
+            BuildStep(0, 'a', cmd='0.1', depends_on=[1]),
+            BuildStep(1, 'b', cmd='0', depends_on=[]),
+            BuildStep(2, 'c', cmd='0', depends_on=[0]),
+        ]
+        backend, result = self.run_steps(steps, 4)
+        self.assertTrue(result.ok)
+        self.assertEqual(backend.started, [steps[1], steps[0], steps[2]])
+
+    def test_failingStep_shouldCancelSiblingsAndSkipPending(self):
+        steps = [
+            BuildStep(0, 'a', cmd='-0.05', depends_on=[]),
+            BuildStep(1, 'b', cmd='10', depends_on=[]),
+            BuildStep(2, 'c', cmd='0', depends_on=[0]),
+        ]
+        start = time()
+        backend, result = self.run_steps(steps, 2)
+        self.assertTrue(result.failed)
+        self.assertIs(result.step, steps[0])
+        self.assertEqual(backend.cancelled, [steps[1]])
+        self.assertNotIn(steps[2], backend.started)
+        self.assertLess(time() - start, 5)
+
+
+class TestPipelinedScheduler(TestCase):
+
+    def run_steps(self, steps, prepared):
+        backend = SleepBackend()
+        task = BuildTask('/a', steps)
+        result = StepScheduler(backend, task, MagicMock(), 2, prepared).run()
+        return backend, result
+
+    def test_preparedStep_shouldStartBeforeLaterStepsArePrepared(self):
+        steps = [BuildStep(0, 'a', cmd='0'), BuildStep(1, 'b', cmd='0')]
+        prepared = {step: Future() for step in steps}
+        prepared[steps[0]].set_result(BuildResult())
+        started = Event()
+        def prepare_later():
+            started.wait(5)
+            prepared[steps[1]].set_result(BuildResult())
+        original = SleepBackend.build_step
+        def build_step(backend, task, step, observer):
+            result = original(backend, task, step, observer)
+            started.set()
+            return result
+        start = time()
+        with patch.object(SleepBackend, 'build_step', build_step):
+            Thread(target=prepare_later).start()
+            backend, result = self.run_steps(steps, prepared)
+        self.assertTrue(result.ok)
+        self.assertLess(time() - start, 4)
+        self.assertEqual(backend.started, steps)
+
+    def test_failedPreparation_shouldFailBuild(self):
+        steps = [BuildStep(0, 'a', cmd='10'), BuildStep(1, 'b', cmd='0', depends_on=[])]
+        prepared = {step: Future() for step in steps}
+        prepared[steps[0]].set_result(BuildResult())
+        Timer(0.05, prepared[steps[1]].set_result,
+            (BuildResult(error='pull failed', step=steps[1]),)).start()
+        start = time()
+        backend, result = self.run_steps(steps, prepared)
+        self.assertTrue(result.failed)
+        self.assertIs(result.step, steps[1])
+        self.assertEqual(backend.cancelled, [steps[0]])
+        self.assertNotIn(steps[1], backend.started)
+        self.assertLess(time() - start, 5)
+
+
+class AsyncSleepBackend(AsyncBackend):
+    """AsyncBackend version of SleepBackend."""
+
+    def __init__(self):
+        super().__init__(None)
+        self.started = []
+        self.cancelled = []
+        self._sleeps = {}
+
+    async def prepare(self, task, observer):
+        return BuildResult()
+
+    async def build_step(self, task, step, observer):
+        self.started.append(step)
+        sleep = self._sleeps[step] = asyncio.ensure_future(asyncio.sleep(abs(float(step.cmd))))
+        try:
+            await sleep
+        except asyncio.CancelledError:
+            self.cancelled.append(step)
+            return BuildResult(False, step=step)
+        if float(step.cmd) < 0:
+            return BuildResult(code=1, step=step)
+        return BuildResult()
+
+    async def cancel_step(self, step):
+        self._sleeps[step].cancel()
+
+
+class TestBuildAsync(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def get_builder(self, backend, steps):
+        engine = MagicMock()
+        engine.backend = backend
+        engine.async_backend = backend if isinstance(backend, AsyncBackend) \
+            else SyncBackendAdapter(backend)
+        config = ProjectConfig(ProjectConfig.Container(
+            join(self.tmp.name, 'roman.yml'), allow_missing=True),
+            None, {'version': '2.0', 'steps': steps}, ProjectConfig.version)
+        return Builder(engine, config, observer=MagicMock())
+
+    def test_manyBuilds_shouldRunInOneThread(self):
+        backend = AsyncSleepBackend()
+        builders = [self.get_builder(backend, [{'img': 'a', 'cmd': '0.2'}])
+            for _ in range(100)]
+        threads = active_count()
+        start = time()
+        async def build_all():
+            return await asyncio.gather(*(builder.build_async() for builder in builders))
+        results = run_coroutine(build_all())
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(len(backend.started), 100)
+        self.assertEqual(active_count(), threads)
+        self.assertLess(time() - start, 2)
+
+    def test_syncBackend_shouldBeAdapted(self):
+        backend = SleepBackend()
+        backend.prepare = MagicMock(return_value=BuildResult())
+        builder = self.get_builder(backend, [
+            {'img': 'a', 'cmd': '0'}, {'img': 'b', 'cmd': '-0.01'}])
+        result = run_coroutine(builder.build_async())
+        self.assertTrue(result.failed)
+        self.assertEqual(result.step.ref, 1)
+        self.assertEqual([step.ref for step in backend.started], [0, 1])
+
+    def test_failingStep_shouldCancelOtherSteps(self):
+        backend = AsyncSleepBackend()
+        builder = self.get_builder(backend, [
+            {'img': 'a', 'cmd': '10', 'depends_on': []},
+            {'img': 'b', 'cmd': '-0.05', 'depends_on': []},
+        ])
+        start = time()
+        result = builder.build(jobs=2)
+        self.assertTrue(result.failed)
+        self.assertEqual([step.ref for step in backend.cancelled], [0])
+        self.assertLess(time() - start, 5)
+
+    def test_unsupportedOptions_shouldBeWarnedAbout(self):
+        builder = self.get_builder(AsyncSleepBackend(), [{'img': 'a', 'cmd': '0'}])
+        with self.assertLogs('apluslms_roman.builder', 'WARNING') as logs:
+            self.assertTrue(builder.build(step_cache=MagicMock(), pipeline=True).ok)
+        self.assertEqual(len(logs.output), 2)
+
+
+class TestGetChangedSteps(TestCase):
+
+    def setUp(self):
+        self.steps = [
+            BuildStep(0, 'a', inputs=['docs/*.rst']),
+            BuildStep(1, 'b', inputs=['static/'], depends_on=[]),
+            BuildStep(2, 'c', inputs=['*.yml'], depends_on=[1]),
+            BuildStep(3, 'd', depends_on=[]),
+        ]
+
+    def test_changedInputs_shouldSelectStepAndDependents(self):
+        steps = get_changed_steps(self.steps[:3], {'static/style.css'})
+        self.assertEqual(steps, self.steps[1:3])
+
+    def test_stepWithoutInputs_shouldAlwaysBeSelected(self):
+        steps = get_changed_steps(self.steps, {'README'})
+        self.assertEqual(steps, [self.steps[3]])
+
+    def test_unknownChanges_shouldSelectAll(self):
+        self.assertEqual(get_changed_steps(self.steps, None), self.steps)
+
+
+class TestBuilderCancel(TestCase):
+
+    def test_cancel_shouldStopRunningAndPendingSteps(self):
+        steps = [BuildStep(0, 'a', cmd='10'), BuildStep(1, 'b', cmd='0')]
+        backend = SleepBackend()
+        backend.prepare = MagicMock(return_value=BuildResult())
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        engine = MagicMock()
+        engine.backend = backend
+        config = ProjectConfig(ProjectConfig.Container(join(tmp.name, 'roman.yml'),
+            allow_missing=True), None, {'version': '2.0'}, ProjectConfig.version)
+        builder = Builder(engine, config, observer=MagicMock())
+        builder.get_steps = MagicMock(return_value=steps)
+        Timer(0.1, builder.cancel).start()
+        start = time()
+        result = builder.build()
+        self.assertTrue(result.cancelled)
+        self.assertEqual(backend.cancelled, [steps[0]])
+        self.assertEqual(backend.started, [steps[0]])
+        self.assertLess(time() - start, 5)
+
+
+class WritingBackend(Backend):
+    """
+    Writes the cmd of each step to a file in the build path. The file is
+    replaced or, with `in_place`, written to. Fails after writing on cmd 'fail'.
+    """
+    in_place = False
+
+    def prepare(self, task, observer):
+        return BuildResult()
+
+    def build_step(self, task, step, observer):
+        path = join(task.build_path, 'out.txt')
+        with open(path if self.in_place else path + '.tmp', 'w') as f:
+            f.write(step.cmd)
+        if not self.in_place:
+            replace(path + '.tmp', path)
+        if step.cmd == 'fail':
+            return BuildResult(code=1, step=step)
+        return BuildResult()
+
+
+class BuildOnlyBackend(Backend):
+    """Backend implementing only build(), like the backends before build_step()."""
+
+    def __init__(self):
+        super().__init__(None)
+        self.built = []
+
+    def prepare(self, task, observer):
+        return BuildResult()
+
+    def build(self, task, observer):
+        self.built.append(list(task.steps))
+        return BuildResult()
+
+
+class TestBuildOnlyBackend(TestCase):
+
+    def test_build_shouldBuildEachStepWithBackendBuild(self):
+        with TemporaryDirectory() as tmp:
+            engine = MagicMock()
+            engine.backend = BuildOnlyBackend()
+            config = ProjectConfig(ProjectConfig.Container(join(tmp, 'roman.yml'),
+                allow_missing=True), None, {'version': '2.0'}, ProjectConfig.version)
+            builder = Builder(engine, config, observer=MagicMock())
+            steps = [BuildStep(0, 'a'), BuildStep(1, 'b')]
+            builder.get_steps = MagicMock(return_value=steps)
+            self.assertTrue(builder.build().ok)
+        self.assertEqual(engine.backend.built, [[steps[0]], [steps[1]]])
+
+
+class TestAtomicBuild(TestCase):
+
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = tmp.name
+        engine = self.engine = MagicMock()
+        engine.backend = WritingBackend(None)
+        config = ProjectConfig(ProjectConfig.Container(join(tmp.name, 'roman.yml'),
+            allow_missing=True), None, {'version': '2.0'}, ProjectConfig.version)
+        self.builder = Builder(engine, config, observer=MagicMock())
+
+    def build(self, cmd, atomic=True):
+        self.builder.get_steps = MagicMock(return_value=[BuildStep(0, 'a', cmd=cmd)])
+        return self.builder.build(atomic=atomic)
+
+    def read_output(self):
+        with open(join(self.path, '_build', 'out.txt')) as f:
+            return f.read()
+
+    def test_success_shouldReplaceOutput(self):
+        self.assertTrue(self.build('first').ok)
+        self.assertTrue(self.build('second').ok)
+        self.assertEqual(self.read_output(), 'second')
+
+    def test_failure_shouldKeepPreviousOutput(self):
+        self.build('first')
+        self.assertFalse(self.build('fail').ok)
+        self.assertEqual(self.read_output(), 'first')
+
+    def test_inPlaceWritesWithCopySeed_shouldKeepPreviousOutput(self):
+        self.engine.backend.in_place = True
+        self.build('first', SEED_COPY)
+        self.assertFalse(self.build('fail', SEED_COPY).ok)
+        self.assertEqual(self.read_output(), 'first')
+
+    def test_stepWithMnt_shouldNotBeBuilt(self):
+        self.build('first')
+        self.builder.get_steps = MagicMock(return_value=[
+            BuildStep(0, 'a', cmd='second', mnt='/content')])
+        with self.assertRaises(AtomicBuildError):
+            self.builder.build(atomic=True)
+        self.assertEqual(self.read_output(), 'first')
+        self.assertFalse(exists(join(self.path, '_build.next')))
@@ -1,16 +1,24 @@
 import sys
 from contextlib import contextmanager, ExitStack
 from collections import namedtuple
+from concurrent.futures import Future
 from copy import deepcopy
 from io import StringIO
+from os import mkdir
 from os.path import abspath, dirname, join
 from shlex import split as shlex_split
+from tempfile import TemporaryDirectory
+from threading import current_thread, main_thread
 from traceback import format_exc
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 
 from apluslms_roman import cli
+from apluslms_roman.log_buffer import QuietSuccessObserver
+from apluslms_roman.log_store import LogRecorder
+from apluslms_roman.observer import JsonLinesObserver, StreamObserver
 from apluslms_yamlidator.utils.yaml import rt_dump as yaml_dump
+from apluslms_yamlidator.validator import Validator
 from .mock_files import VFS
 
 
@@ -48,7 +56,10 @@ class CliTestCase(TestCase):
     def setUp(self):
         self.patch_stack = ExitStack().__enter__()
         # disable Engine, so cli actions don't accidentally start one
-        self.patch_stack.enter_context(patch('apluslms_roman.cli.Engine'))
+        self.engine_mock = self.patch_stack.enter_context(patch('apluslms_roman.cli.Engine'))
+        # never forward commands to a daemon running on the machine
+        self.patch_stack.enter_context(
+            patch('apluslms_roman.cli.forward_to_daemon', return_value=None))
 
     def tearDown(self):
         self.patch_stack.close()
@@ -173,7 +184,8 @@ class TestBuildAction(CliTestCase):
         self.assertEqual(builder_config.steps[0]['img'], 'hello-world')
 
         builder = engine.create_builder.return_value
-        builder.build.assert_called_once_with(step_refs=None, clean_build=False)
+        builder.build.assert_called_once_with(step_refs=None, clean_build=False, jobs=1, step_cache=None,
+            pipeline=False, budget=None, atomic=False)
 
     def test_withEmptySteps_shouldSayNothingToBuild(self, EngineMock):
         r = self.command_test('build', config={'version': '2'}, exit_code=1)
@@ -230,8 +242,162 @@ class TestBuildAction(CliTestCase):
         engine = EngineMock.return_value
         builder = engine.create_builder.return_value
         r = self.command_test("build --clean", config=HELLO_CONFIG, exit_code=0)
-        builder.build.assert_called_once_with(step_refs=None, clean_build=True)
+        builder.build.assert_called_once_with(step_refs=None, clean_build=True, jobs=1, step_cache=None,
+            pipeline=False, budget=None, atomic=False)
 
+    def test_withAtomicFlag_shouldPassAtomicToBuild(self, EngineMock):
+        engine = EngineMock.return_value
+        builder = engine.create_builder.return_value
+        self.command_test("build --atomic", config=HELLO_CONFIG)
+        builder.build.assert_called_once_with(step_refs=None, clean_build=False, jobs=1, step_cache=None,
+            pipeline=False, budget=None, atomic='link')
+        self.command_test("build --atomic --atomic-seed=copy", config=HELLO_CONFIG)
+        self.assertEqual(builder.build.call_args[1]['atomic'], 'copy')
+
+    def test_withRecord_shouldSaveRecording(self, EngineMock):
+        engine = EngineMock.return_value
+        with patch('apluslms_roman.cli.ReplayRecorder') as RecorderMock:
+            self.command_test("build --record replay.json", config=HELLO_CONFIG)
+        recorder = RecorderMock.return_value
+        self.assertIs(engine.create_builder.call_args[1]['observer'], recorder)
+        recorder.save.assert_called_once_with('replay.json')
+
+    def test_withTrace_shouldTraceBuild(self, EngineMock):
+        with patch('apluslms_roman.cli.trace_to') as trace_mock:
+            self.command_test("build --trace trace.json", config=HELLO_CONFIG)
+        trace_mock.assert_called_once_with('trace.json')
+        EngineMock.return_value.create_builder.return_value.build.assert_called_once()
+
+    def test_withMetricsTextfile_shouldExportMetrics(self, EngineMock):
+        settings = {'version': '1.0', 'metrics': {'textfile': '/tmp/roman.prom'}}
+        with patch('apluslms_roman.cli.export_textfile') as export_mock:
+            self.command_test("build", config=HELLO_CONFIG, settings=settings)
+        export_mock.assert_called_once_with('/tmp/roman.prom')
+
+    def test_withProfile_shouldStartProfiling(self, EngineMock):
+        with patch('apluslms_roman.cli.start_profiling') as profiling_mock:
+            self.command_test("--profile build", config=HELLO_CONFIG)
+            self.command_test("--profile=mem --profile-dir prof build", config=HELLO_CONFIG)
+        self.assertEqual(profiling_mock.call_args_list[0][0], ('cpu', abspath('roman-profile')))
+        self.assertEqual(profiling_mock.call_args_list[1][0], ('mem', abspath('prof')))
+
+    def test_withQuietSuccess_shouldHoldBackOutput(self, EngineMock):
+        engine = EngineMock.return_value
+        self.command_test("build --quiet-success --failure-tail 20", config=HELLO_CONFIG)
+        observer = engine.create_builder.call_args[1]['observer']
+        self.assertIsInstance(observer, LogRecorder)
+        self.assertIsInstance(observer._observer, QuietSuccessObserver)
+        self.assertEqual(observer._observer.tail, 20)
+
+    def test_withJsonlOutput_shouldUseJsonLinesObserver(self, EngineMock):
+        engine = EngineMock.return_value
+        settings = {'version': '1.0', 'logs': {'keep': 0}}
+        self.command_test("build --output=jsonl", config=HELLO_CONFIG, settings=settings)
+        self.assertIsInstance(engine.create_builder.call_args[1]['observer'], JsonLinesObserver)
+
+    def test_withJsonlOutput_shouldPrintMessagesToStderr(self, EngineMock):
+        r = self.command_test('build --output=jsonl', config={'version': '2'}, exit_code=1)
+        self.assertEqual(r.out, '')
+        self.assertEqual(r.err.strip(), "Nothing to build.")
+
+    def test_withLogsDisabled_shouldNotStoreOutput(self, EngineMock):
+        engine = EngineMock.return_value
+        settings = {'version': '1.0', 'logs': {'keep': 0}}
+        self.command_test("build", config=HELLO_CONFIG, settings=settings)
+        self.assertIsInstance(engine.create_builder.call_args[1]['observer'], StreamObserver)
+
+    def test_withJobs_shouldPassJobsToBuild(self, EngineMock):
+        engine = EngineMock.return_value
+        builder = engine.create_builder.return_value
+        self.command_test("build -j 4", config=HELLO_CONFIG)
+        builder.build.assert_called_once_with(step_refs=None, clean_build=False, jobs=4, step_cache=None,
+            pipeline=False, budget=None, atomic=False)
+
+
+
+class TestBuildManyAction(CliTestCase):
+
+    def test_normal_shouldBuildAllProjectsAndPrintTable(self):
+        with TemporaryDirectory() as tmp:
+            for name in ('course1', 'course2', 'empty'):
+                mkdir(join(tmp, name))
+            for name in ('course1', 'course2'):
+                with open(join(tmp, name, CONFIG_FN), 'w') as f:
+                    f.write(yaml_dump(HELLO_CONFIG))
+            engine = self.engine_mock.return_value
+            engine.verify.return_value = None
+            builder = engine.create_builder.return_value
+            builder.build.return_value = MagicMock(ok=True, code=0,
+                __str__=lambda self: "Build ok")
+
+            with capture_output() as (out, err), \
+                    patch('apluslms_roman.cli.exit') as exit_mock:
+                cli.main(args=['build-many', '-j', '2', join(tmp, 'c*'), join(tmp, 'empty')])
+
+            exit_mock.assert_called_once_with(1)
+            self.assertEqual(builder.build.call_count, 2)
+            lines = out.getvalue().strip().splitlines()[-4:]
+            self.assertIn('PROJECT', lines[0])
+            self.assertIn('course1', lines[1])
+            self.assertIn('Build ok', lines[1])
+            self.assertIn('empty', lines[3])
+            self.assertIn("Couldn't find project configuration", out.getvalue())
+
+    def build_many(self, tmp, *args):
+        for name in ('course1', 'course2'):
+            mkdir(join(tmp, name))
+            with open(join(tmp, name, CONFIG_FN), 'w') as f:
+                f.write(yaml_dump(HELLO_CONFIG))
+        with capture_output() as (out, err), \
+                patch('apluslms_roman.cli.exit') as exit_mock:
+            cli.main(args=['build-many'] + list(args) + [join(tmp, 'c*')])
+        return exit_mock, out.getvalue()
+
+    def test_coldSchemaCache_shouldLoadConfigsInMainThread(self):
+        # the schemas are loaded lazily and loading them isn't thread safe
+        validator = Validator.get_default()
+        validator.get_schema.cache_clear()
+        validator.get_validator.cache_clear()
+        threads = []
+        find_from = cli.ProjectConfig.find_from
+        def find_config(path):
+            threads.append(current_thread())
+            return find_from(path)
+        engine = self.engine_mock.return_value
+        engine.verify.return_value = None
+        engine.create_builder.return_value.build.return_value = MagicMock(ok=True, code=0)
+        with TemporaryDirectory() as tmp, \
+                patch.object(cli.ProjectConfig, 'find_from', side_effect=find_config):
+            exit_mock, out = self.build_many(tmp, '-j', '2')
+        exit_mock.assert_called_once_with(0)
+        self.assertEqual(threads, [main_thread()] * 2)
+        self.assertEqual(engine.create_builder.return_value.build.call_count, 2)
+
+    def test_buildError_shouldBeShownInTable(self):
+        engine = self.engine_mock.return_value
+        engine.verify.return_value = None
+        builder = engine.create_builder.return_value
+        builder.build.side_effect = [RuntimeError("backend broke"), MagicMock(ok=True, code=0,
+            __str__=lambda self: "Build ok")]
+        with TemporaryDirectory() as tmp:
+            exit_mock, out = self.build_many(tmp)
+        exit_mock.assert_called_once_with(1)
+        lines = out.strip().splitlines()[-3:]
+        self.assertIn('PROJECT', lines[0])
+        self.assertTrue(lines[1].endswith('error'), lines[1])
+        self.assertIn('Build ok', lines[2])
+        self.assertIn("course1 | backend broke", out)
+
+    def test_interrupt_shouldCancelBuilds(self):
+        engine = self.engine_mock.return_value
+        engine.verify.return_value = None
+        builder = engine.create_builder.return_value
+        builder.build.return_value = MagicMock(ok=False, code=1)
+        with TemporaryDirectory() as tmp, \
+                patch.object(Future, 'result', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.build_many(tmp, '-j', '2')
+        self.assertEqual(builder.cancel.call_count, 2)
 
 
 class TestInitAction(CliTestCase):
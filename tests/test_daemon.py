@@ -0,0 +1,179 @@
+from io import StringIO
+from os import getegid, getuid
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from apluslms_yamlidator.utils.yaml import rt_dump as yaml_dump
+
+from apluslms_roman import cli
+from apluslms_roman.backends import BuildResult, BuildStep
+from apluslms_roman.daemon import (
+    BuildDaemon,
+    BuildService,
+    DaemonError,
+    EventObserver,
+    forward_to_daemon,
+    is_running,
+)
+from apluslms_roman.settings import GlobalSettings
+
+
+class DaemonTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = join(self.tmp.name, 'daemon.sock')
+        self.requests = []
+
+    def start(self, handler):
+        def handle(request, send):
+            self.requests.append(request)
+            return handler(request, send)
+        server = BuildDaemon(handle, self.path)
+        thread = Thread(target=server.serve_forever, args=(0.05,))
+        thread.start()
+        def stop():
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.addCleanup(stop)
+        return server
+
+    def forward(self, argv):
+        out, err = StringIO(), StringIO()
+        code = forward_to_daemon(argv, cwd='/project', path=self.path,
+            stream=out, err_stream=err, env={'DOCKER_HOST': 'tcp://docker:2375'})
+        return code, out.getvalue(), err.getvalue()
+
+
+class TestDaemon(DaemonTestCase):
+
+    def test_withoutDaemon_shouldNotForward(self):
+        self.assertIsNone(self.forward(['build'])[0])
+        self.assertFalse(is_running(self.path))
+
+    def test_build_shouldReplayObserverEvents(self):
+        def handler(request, send):
+            step = BuildStep(0, 'hello-world', name='hello')
+            send({'event': 'start', 'colors': False})
+            observer = EventObserver(send)
+            observer.enter_build()
+            observer.step_pending(step)
+            observer.container_msg(step, "Hello from Docker!")
+            observer.result_msg(BuildResult(code=3, step=step))
+            observer.done()
+            return 3
+        self.start(handler)
+        code, out, err = self.forward(['build', '--clean'])
+        self.assertEqual(code, 3)
+        self.assertEqual(self.requests, [{'argv': ['build', '--clean'], 'cwd': '/project',
+            'env': {'DOCKER_HOST': 'tcp://docker:2375'}, 'uid': getuid(), 'gid': getegid()}])
+        self.assertIn("step hello\n", out)
+        self.assertIn("  >> Hello from Docker!\n", out)
+        self.assertIn("Build failed on step hello: exit code 3\n", out)
+
+    def test_unsupportedCommand_shouldNotForward(self):
+        self.start(lambda request, send: None)
+        self.assertIsNone(self.forward(['config'])[0])
+
+    def test_handlerError_shouldBeReported(self):
+        def handler(request, send):
+            raise ValueError("broken")
+        self.start(handler)
+        code, out, err = self.forward(['build'])
+        self.assertEqual(code, 1)
+        self.assertIn("broken", err)
+
+    def test_secondDaemon_shouldFail(self):
+        self.start(lambda request, send: 0)
+        with self.assertRaises(DaemonError):
+            BuildDaemon(lambda request, send: 0, self.path)
+
+    def test_staleSocket_shouldBeReplaced(self):
+        open(self.path, 'w').close()
+        server = BuildDaemon(lambda request, send: 0, self.path)
+        server.server_close()
+        self.assertFalse(exists(self.path))
+
+
+class TestHandleDaemonRequest(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        with open(join(self.tmp.name, 'roman.yml'), 'w') as f:
+            f.write(yaml_dump({'version': '2.0', 'steps': ['hello-world']}))
+        self.parser = cli.create_parser(parser_class=cli.DaemonArgumentParser)
+        cli.add_cli_actions(self.parser)
+        self.service = MagicMock()
+        self.service.get_settings.return_value = GlobalSettings.load(
+            join(self.tmp.name, 'settings.yml'), allow_missing=True)
+        self.builder = self.service.get_engine.return_value.create_builder.return_value
+        self.builder.build.return_value = BuildResult()
+        self.events = []
+
+    def handle(self, *argv, **request):
+        request = dict({'argv': list(argv), 'cwd': self.tmp.name,
+            'env': {'DOCKER_HOST': 'tcp://docker:2375'}, 'uid': getuid(), 'gid': getegid()},
+            **request)
+        return cli.handle_daemon_request(self.service, self.parser, request,
+            self.events.append)
+
+    def test_build_shouldBuildProjectInCwd(self):
+        self.assertEqual(self.handle('build', '-j', '2'), 0)
+        self.assertEqual(self.events, [{'event': 'start', 'colors': None}])
+        self.builder.build.assert_called_once_with(step_refs=None, clean_build=False,
+            jobs=2, step_cache=None, pipeline=False, budget=None, atomic=False)
+        self.service.project_lock.assert_called_once_with(self.tmp.name)
+        self.service.get_engine.assert_called_once_with(
+            self.service.get_settings.return_value, {'DOCKER_HOST': 'tcp://docker:2375'})
+
+    def test_withMetricsTextfile_shouldExportMetrics(self):
+        settings_path = join(self.tmp.name, 'settings.yml')
+        with open(settings_path, 'w') as f:
+            f.write(yaml_dump({'version': '1.0', 'metrics': {'textfile': 'roman.prom'}}))
+        self.service.get_settings.return_value = GlobalSettings.load(settings_path)
+        with patch('apluslms_roman.cli.export_textfile') as export_mock:
+            self.handle('build')
+            self.service.textfile_metrics = False
+            self.handle('build')
+        export_mock.assert_called_once_with(join(self.tmp.name, 'roman.prom'))
+
+    def test_otherClient_shouldNotBeHandled(self):
+        self.assertIsNone(self.handle('build', uid=getuid() + 1))
+        self.assertIsNone(self.handle('build', gid=getegid() + 1))
+        self.assertIsNone(cli.handle_daemon_request(self.service, self.parser,
+            {'argv': ['build'], 'cwd': self.tmp.name}, self.events.append))
+        self.builder.build.assert_not_called()
+
+    def test_otherCommands_shouldNotBeHandled(self):
+        self.assertIsNone(self.handle('config'))
+        self.assertIsNone(self.handle('build', '--no-daemon'))
+        self.assertIsNone(self.handle('build', '--invalid-flag'))
+        self.assertIsNone(self.handle('build', '--output=jsonl'))
+        self.builder.build.assert_not_called()
+
+    def test_missingConfig_shouldReportError(self):
+        self.assertEqual(self.handle('-C', 'missing', 'build'), 1)
+        self.assertEqual(len(self.events), 1)
+        self.assertTrue(self.events[0]['stderr'])
+        self.builder.build.assert_not_called()
+
+
+class TestBuildService(TestCase):
+
+    def test_getEngine_shouldUseEnvironmentOfClient(self):
+        service = BuildService()
+        settings = GlobalSettings.load('/missing/settings.yml', allow_missing=True)
+        settings['backend'] = 'fake'
+        with patch('apluslms_roman.builder.Engine.verify', return_value=None):
+            first = service.get_engine(settings, {'FAKE_SPEED': '0', 'HOME': '/a'})
+            same = service.get_engine(settings, {'FAKE_SPEED': '0', 'HOME': '/b'})
+            other = service.get_engine(settings, {'FAKE_SPEED': '1'})
+        self.assertIs(first, same)
+        self.assertIsNot(first, other)
+        self.assertEqual(other.backend.context.environ['FAKE_SPEED'], '1')
@@ -0,0 +1,80 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from apluslms_roman.log_buffer import QuietSuccessObserver, SpillBuffer
+from apluslms_roman.observer import Message
+
+
+LINES = ['line {}'.format(i) for i in range(100)]
+
+
+class TestSpillBuffer(TestCase):
+
+    def test_smallOutput_shouldStayInMemory(self):
+        buffer = SpillBuffer()
+        buffer.extend(LINES)
+        self.assertIsNone(buffer._file)
+        self.assertEqual(list(buffer.get_lines()), LINES)
+        buffer.close()
+
+    def test_largeOutput_shouldSpillToFile(self):
+        buffer = SpillBuffer(memory_limit=100)
+        for line in LINES:
+            buffer.extend([line])
+        self.assertGreater(buffer.spilled, 0)
+        self.assertLessEqual(buffer._size, 100)
+        self.assertEqual(len(buffer), 100)
+        self.assertEqual(list(buffer.get_lines()), LINES)
+        buffer.close()
+
+    def test_tail_shouldReturnLastLines(self):
+        for tail in (5, 50, 200):
+            with self.subTest(tail=tail):
+                buffer = SpillBuffer(memory_limit=100)
+                buffer.extend(LINES)
+                self.assertEqual(list(buffer.get_lines(tail)), LINES[-tail:])
+                buffer.close()
+
+
+def get_output(observer, step):
+    return [line
+        for call in observer._message.call_args_list
+        if call[0][1] == Message.CONTAINER_MSG and call[0][2] == step
+        for line in call[0][4]]
+
+
+class TestQuietSuccessObserver(TestCase):
+
+    def setUp(self):
+        self.inner = MagicMock()
+        self.observer = QuietSuccessObserver(self.inner, memory_limit=100)
+        self.observer.enter_build()
+
+    def run_step(self, step, ok):
+        self.observer.step_running(step)
+        for line in LINES:
+            self.observer.container_msg(step, line)
+        if ok:
+            self.observer.step_succeeded(step)
+        else:
+            self.observer.step_failed(step)
+
+    def test_succeededStep_shouldDiscardOutput(self):
+        self.run_step('html', True)
+        self.assertEqual(get_output(self.inner, 'html'), [])
+        self.assertEqual(self.observer._buffers, {})
+
+    def test_failedStep_shouldShowOutputBeforeFailure(self):
+        self.run_step('html', False)
+        self.assertEqual(get_output(self.inner, 'html'), LINES)
+        last = self.inner._message.call_args[0]
+        self.assertEqual(last[1], Message.STATE_UPDATE)
+        self.assertTrue(last[3].completed)
+
+    def test_failedStepWithTail_shouldShowLastLines(self):
+        self.observer.tail = 3
+        self.run_step('html', False)
+        self.assertEqual(get_output(self.inner, 'html'), LINES[-3:])
+        messages = [call[0][4] for call in self.inner._message.call_args_list
+            if call[0][1] == Message.MANAGER_MSG]
+        self.assertEqual(messages, [["Showing the last 3 of 100 lines of output"]])
@@ -0,0 +1,120 @@
+from threading import Event, Thread
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from apluslms_roman.backends import BackendContext, BuildStep
+from apluslms_roman.backends.fake import FakeBackend
+from apluslms_roman.log_pipeline import BLOCK, DROP, LineSplitter, LogPipeline
+from apluslms_roman.metrics import LOG_DROPPED_LINES
+
+
+def get_output(observer):
+    return ''.join(call[0][1] for call in observer.container_msg.call_args_list).splitlines()
+
+
+class TestLineSplitter(TestCase):
+
+    def test_multibyteCharacterSplitBetweenChunks_shouldBeDecoded(self):
+        splitter = LineSplitter()
+        data = 'näin\n'.encode('utf-8')
+        self.assertEqual(splitter.feed(data[:2]), [])
+        self.assertEqual(splitter.feed(data[2:]), ['näin'])
+
+    def test_partialLine_shouldWaitForNewline(self):
+        splitter = LineSplitter()
+        self.assertEqual(splitter.feed(b'a\r\nb'), ['a'])
+        self.assertEqual(splitter.feed(b'c\n\n'), ['bc', ''])
+        self.assertEqual(splitter.feed(b'd'), [])
+        self.assertEqual(splitter.flush(), ['d'])
+        self.assertEqual(splitter.flush(), [])
+
+    def test_longLine_shouldBeSplit(self):
+        splitter = LineSplitter(max_line_length=3)
+        self.assertEqual(splitter.feed(b'abcdefg'), ['abc', 'def'])
+        self.assertEqual(splitter.feed(b'hijklmn\n'), ['ghi', 'jkl', 'mn'])
+
+    def test_invalidUtf8_shouldBeReplaced(self):
+        self.assertEqual(LineSplitter().feed(b'a\xff\n'), ['a�'])
+
+
+def create_blocking_observer():
+    """Returns an observer, which waits for `observer.release` in container_msg."""
+    observer = MagicMock()
+    observer.release = Event()
+    observer.container_msg.side_effect = lambda step, msg: observer.release.wait(5)
+    return observer
+
+
+class TestLogPipeline(TestCase):
+
+    def test_output_shouldBeDeliveredInOrder(self):
+        observer = MagicMock()
+        with LogPipeline(observer, 'html') as log:
+            for i in range(1000):
+                log.feed('{}\n'.format(i).encode('utf-8'))
+            log.feed(b'last')
+        self.assertEqual(get_output(observer), [str(i) for i in range(1000)] + ['last'])
+        self.assertEqual(log.lines, 1001)
+
+    def test_blockPolicy_shouldWaitForObserver(self):
+        observer = create_blocking_observer()
+        log = LogPipeline(observer, 'html', BLOCK, max_lines=2)
+        log.feed(b'1\n')
+        thread = Thread(target=lambda: [log.feed(b'2\n3\n4\n') for _ in range(2)])
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        observer.release.set()
+        thread.join(5)
+        log.close()
+        self.assertEqual(get_output(observer), ['1', '2', '3', '4', '2', '3', '4'])
+
+    def test_dropPolicy_shouldCountAndReportDroppedLines(self):
+        observer = create_blocking_observer()
+        dropped = LOG_DROPPED_LINES.get(step='html')
+        log = LogPipeline(observer, 'html', DROP, max_lines=2)
+        log.feed(b'1\n')
+        for _ in range(10):
+            log.feed(b'2\n3\n')
+        observer.release.set()
+        log.close()
+        self.assertGreaterEqual(log.dropped_lines, 16)
+        self.assertEqual(log.dropped_lines + log.lines, 21)
+        self.assertEqual(log.dropped_bytes, log.dropped_lines * 2)
+        self.assertEqual(LOG_DROPPED_LINES.get(step='html') - dropped, log.dropped_lines)
+        self.assertIn("Dropped {} lines".format(log.dropped_lines),
+            observer.manager_msg.call_args[0][1])
+
+    def test_observerError_shouldBeRaisedOnClose(self):
+        observer = MagicMock()
+        observer.container_msg.side_effect = ValueError('broken')
+        log = LogPipeline(observer, 'html', max_lines=1)
+        with self.assertLogs('apluslms_roman.log_pipeline', 'ERROR'):
+            for _ in range(5):
+                log.feed(b'line\n')
+            with self.assertRaises(ValueError):
+                log.close()
+
+    def test_unknownPolicy_shouldRaise(self):
+        with self.assertRaises(ValueError):
+            LogPipeline(MagicMock(), 'html', 'ignore')
+
+
+class TestBackendLogOptions(TestCase):
+
+    def test_openLog_shouldUseBackendOptions(self):
+        backend = FakeBackend(BackendContext(1000, 1000, {
+            'FAKE_LOG_POLICY': 'drop',
+            'FAKE_LOG_BUFFER_LINES': '5',
+            'FAKE_LOG_MAX_LINE_LENGTH': '10',
+        }))
+        log = backend.open_log(BuildStep(0, 'img'), MagicMock())
+        self.assertEqual(log.policy, DROP)
+        self.assertEqual(log.max_lines, 5)
+        self.assertEqual(log._splitter.max_line_length, 10)
+
+    def test_openLogWithUnknownPolicy_shouldBlock(self):
+        backend = FakeBackend(BackendContext(1000, 1000, {'FAKE_LOG_POLICY': 'x'}))
+        with self.assertLogs('apluslms_roman.backends', 'WARNING'):
+            log = backend.open_log(BuildStep(0, 'img'), MagicMock())
+        self.assertEqual(log.policy, BLOCK)
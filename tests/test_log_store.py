@@ -0,0 +1,188 @@
+import json
+from contextlib import redirect_stdout
+from io import StringIO
+from os import listdir
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from apluslms_roman import cli
+from apluslms_roman.backends import BackendContext
+from apluslms_roman.backends.fake import FakeBackend, ReplayRecorder
+from apluslms_roman.builder import Builder
+from apluslms_roman.configuration import ProjectConfig
+from apluslms_roman.log_buffer import QuietSuccessObserver
+from apluslms_roman.log_store import (
+    INDEX_SUFFIX,
+    LogRecorder,
+    LogStore,
+    StepLog,
+    StepLogWriter,
+)
+
+
+LINES = ['line {}'.format(i) for i in range(1000)]
+
+
+class TestStepLog(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = join(self.tmp.name, '0')
+
+    def write(self, lines, block_size=100):
+        writer = StepLogWriter(self.path, block_size)
+        for i in range(0, len(lines), 7):
+            writer.write(lines[i:i + 7])
+        writer.close()
+        return writer
+
+    def test_lines_shouldBeReadInOrder(self):
+        self.assertEqual(self.write(LINES).lines, 1000)
+        with StepLog(self.path) as log:
+            self.assertEqual(len(log), 1000)
+            self.assertGreater(len(log._ends), 10)
+            self.assertEqual(list(log.get_lines()), list(enumerate(LINES)))
+            self.assertEqual(list(log.get_lines(495, 505)),
+                list(enumerate(LINES))[495:505])
+
+    def test_tail_shouldDecompressOnlyLastBlocks(self):
+        self.write(LINES)
+        with StepLog(self.path) as log:
+            with patch.object(log, '_read_block', wraps=log._read_block) as read_mock:
+                self.assertEqual([line for _, line in log.tail(3)], LINES[-3:])
+        self.assertLessEqual(read_mock.call_count, 2)
+
+    def test_grep_shouldReturnMatchingLines(self):
+        self.write(LINES)
+        with StepLog(self.path) as log:
+            self.assertEqual(list(log.grep(r'line 99\d$')),
+                [(i, 'line {}'.format(i)) for i in range(990, 1000)])
+
+    def test_incompleteIndexEntry_shouldBeIgnored(self):
+        self.write(LINES[:10], block_size=2**16)
+        with open(self.path + INDEX_SUFFIX, 'ab') as f:
+            f.write(b'\0\0\0')
+        with StepLog(self.path) as log:
+            self.assertEqual([line for _, line in log.get_lines()], LINES[:10])
+
+    def test_emptyLog_shouldHaveNoLines(self):
+        StepLogWriter(self.path).close()
+        with StepLog(self.path) as log:
+            self.assertEqual(len(log), 0)
+            self.assertEqual(list(log.tail(5)), [])
+
+
+class TestLogStore(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = LogStore(join(self.tmp.name, 'logs'), keep=2)
+
+    def test_createBuild_shouldKeepLatestBuilds(self):
+        ids = [self.store.create_build('/project{}'.format(i)).id for i in range(3)]
+        self.assertEqual(sorted(listdir(self.store.path)), ids[1:])
+
+    def test_getBuild_shouldFindByPrefixOrProject(self):
+        first = self.store.create_build('/course')
+        second = self.store.create_build('/other')
+        self.assertIsNone(self.store.get_build(first.id[:4]))
+        self.assertEqual(self.store.get_build(first.id).id, first.id)
+        self.assertEqual(self.store.get_build(cwd='/course/sub').id, first.id)
+        self.assertEqual(self.store.get_build(cwd='/unknown').id, second.id)
+
+
+def create_builder(tmp, observer):
+    config = ProjectConfig(ProjectConfig.Container(join(tmp, 'roman.yml'),
+        allow_missing=True), None, {'version': '2.0', 'steps': [
+            {'img': 'a', 'name': 'html'}, 'b']}, ProjectConfig.version)
+    replay = join(tmp, 'replay.json')
+    with open(replay, 'w') as f:
+        json.dump({'version': 1, 'steps': {
+            'html': {'output': [[0, line] for line in LINES]},
+            '1': {'output': [[0, 'error']], 'code': 2}}}, f)
+    engine = MagicMock()
+    engine.backend = FakeBackend(BackendContext(1000, 1000,
+        {'FAKE_REPLAY': replay, 'FAKE_SPEED': '0'}))
+    return Builder(engine, config, observer=observer)
+
+
+class TestLogRecorder(TestCase):
+
+    def test_build_shouldStoreOutputOfSteps(self):
+        with TemporaryDirectory() as tmp:
+            store = LogStore(join(tmp, 'logs'))
+            observer = MagicMock()
+            builder = create_builder(tmp, LogRecorder(observer, store, tmp))
+            self.assertFalse(builder.build().ok)
+            build = store.get_build()
+            self.assertEqual(build.info['project'], tmp)
+            self.assertEqual(build.info['code'], 2)
+            self.assertEqual([(s['name'], s['state']) for s in build.info['steps']],
+                [('html', 'succeeded'), ('1', 'failed')])
+            with build.open_step(build.get_step('html')) as log:
+                self.assertEqual([line for _, line in log.get_lines()], LINES)
+            with build.open_step(build.get_step('1')) as log:
+                self.assertEqual(list(log.get_lines()), [(0, 'error')])
+        self.assertTrue(observer._message.called)
+
+    def test_wrappedRecorder_shouldBeDone(self):
+        with TemporaryDirectory() as tmp:
+            store = LogStore(join(tmp, 'logs'))
+            inner = MagicMock()
+            observer = ReplayRecorder(LogRecorder(QuietSuccessObserver(inner), store, tmp))
+            builder = create_builder(tmp, observer)
+            result = builder.build()
+            self.assertEqual(store.get_build().info['code'], 2)
+        inner.done.assert_called_once_with(result)
+
+    def test_eachBuild_shouldBeStoredSeparately(self):
+        with TemporaryDirectory() as tmp:
+            store = LogStore(join(tmp, 'logs'))
+            builder = create_builder(tmp, LogRecorder(MagicMock(), store, tmp))
+            builder.build(['html'])
+            builder.build(['html'])
+            self.assertEqual(len(store.list_builds()), 2)
+
+
+class TestLogsAction(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = LogStore(join(self.tmp.name, 'logs'))
+        builder = create_builder(self.tmp.name,
+            LogRecorder(MagicMock(), self.store, self.tmp.name))
+        builder.build()
+        self.parser = cli.create_parser()
+        cli.add_cli_actions(self.parser)
+
+    def run_logs(self, *argv):
+        context = MagicMock(args=self.parser.parse_args(('logs',) + argv), parser=self.parser)
+        out = StringIO()
+        with patch('apluslms_roman.cli.get_log_store', return_value=self.store), \
+                patch('apluslms_roman.cli.getcwd', return_value=self.tmp.name), \
+                redirect_stdout(out):
+            code = cli.logs_action(context)
+        return code, out.getvalue()
+
+    def test_stepWithTail_shouldPrintLastLines(self):
+        build_id = self.store.get_build().id
+        for argv in (('html',), (build_id, 'html'), (build_id[:-2], '0')):
+            with self.subTest(argv=argv):
+                self.assertEqual(self.run_logs(*(argv + ('--tail', '2'))),
+                    (0, 'line 998\nline 999\n'))
+
+    def test_grep_shouldPrintMatchesWithLineNumbers(self):
+        self.assertEqual(self.run_logs('--grep', 'error|line 12$'),
+            (0, 'html:13: line 12\n1:1: error\n'))
+        self.assertEqual(self.run_logs('--grep', 'missing')[0], 1)
+
+    def test_unknownStep_shouldExit(self):
+        with patch('apluslms_roman.cli.exit', side_effect=SystemExit) as exit_mock:
+            with self.assertRaises(SystemExit):
+                self.run_logs(self.store.get_build().id, 'missing')
+        self.assertEqual(exit_mock.call_args[0][0], 1)
@@ -0,0 +1,63 @@
+from os import makedirs, utime
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from apluslms_roman.manifest import FileIndex, scan_tree
+
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class TestFileIndex(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = join(self.tmp.name, 'src')
+        self.index_path = join(self.tmp.name, 'index.json')
+        makedirs(join(self.root, '_build'))
+        for fn in ('a.txt', 'b.txt', join('_build', 'out.html')):
+            write(join(self.root, fn), fn[0])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def get_index(self):
+        return FileIndex(self.root, exclude=('_build',), path=self.index_path)
+
+    def test_update_shouldReportChangesSinceSavedIndex(self):
+        index = self.get_index()
+        diff = index.update()
+        self.assertEqual(diff.added, {'a.txt', 'b.txt'})
+        index.save()
+
+        write(join(self.root, 'a.txt'), 'changed')
+        write(join(self.root, 'c.txt'), 'c')
+        diff = self.get_index().update()
+        self.assertEqual(diff.added, {'c.txt'})
+        self.assertEqual(diff.modified, {'a.txt'})
+        self.assertEqual(diff.removed, set())
+
+    def test_unchangedStat_shouldNotRehash(self):
+        index = self.get_index()
+        index.update()
+        # make entries old enough to be trusted
+        for fn in ('a.txt', 'b.txt'):
+            utime(join(self.root, fn), ns=(10**9, 10**9))
+        index.update()
+        with patch('apluslms_roman.manifest.hash_file') as hash_file:
+            self.assertFalse(index.update())
+            hash_file.assert_not_called()
+
+    def test_editWithinSameTimestamp_shouldBeDetected(self):
+        index = self.get_index()
+        with patch.object(FileIndex, 'RACY_NS', 10**30):
+            index.update()
+        # the file is edited within the same tick, thus stat data doesn't change
+        stats = scan_tree(self.root, ('_build',))
+        write(join(self.root, 'a.txt'), 'x')
+        with patch('apluslms_roman.manifest.scan_tree', return_value=stats):
+            self.assertEqual(index.update().modified, {'a.txt'})
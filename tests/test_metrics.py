@@ -0,0 +1,137 @@
+import json
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import MagicMock
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from apluslms_roman.backends import BackendContext
+from apluslms_roman.backends.fake import FakeBackend
+from apluslms_roman.builder import Builder
+from apluslms_roman.configuration import ProjectConfig
+from apluslms_roman.metrics import (
+    BUILD_RESULTS,
+    LOG_BYTES,
+    REGISTRY,
+    STEP_DURATION,
+    STEP_RESULTS,
+    MetricsServer,
+    Registry,
+    export_textfile,
+)
+
+
+class TestRegistry(TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.counter = self.registry.counter('roman_test_total', "Test counter.", ['step'])
+        self.histogram = self.registry.histogram('roman_test_seconds', "Test histogram.",
+            buckets=(1, 5))
+
+    def test_counter_shouldRenderLabelledValues(self):
+        self.counter.inc(step='html')
+        self.counter.inc(2, step='say "hi"')
+        text = self.registry.render()
+        self.assertIn('# TYPE roman_test_total counter\n', text)
+        self.assertIn('roman_test_total{step="html"} 1\n', text)
+        self.assertIn('roman_test_total{step="say \\"hi\\""} 2\n', text)
+
+    def test_counterWithWrongLabels_shouldRaise(self):
+        with self.assertRaises(ValueError):
+            self.counter.inc(image='a')
+
+    def test_histogram_shouldRenderCumulativeBuckets(self):
+        for value in (0.5, 2, 10):
+            self.histogram.observe(value)
+        text = self.registry.render()
+        self.assertIn('roman_test_seconds_bucket{le="1"} 1\n', text)
+        self.assertIn('roman_test_seconds_bucket{le="5"} 2\n', text)
+        self.assertIn('roman_test_seconds_bucket{le="+Inf"} 3\n', text)
+        self.assertIn('roman_test_seconds_sum 12.5\n', text)
+        self.assertIn('roman_test_seconds_count 3\n', text)
+
+    def test_mergeState_shouldAddValues(self):
+        self.counter.inc(step='html')
+        self.histogram.observe(2)
+        other = self.registry.empty_copy()
+        other.merge_state(self.registry.get_state())
+        other.merge_state(self.registry.get_state())
+        self.assertEqual(other.get_state()['roman_test_total'], [[['html'], 2]])
+        self.assertEqual(other._metrics['roman_test_seconds'].get(), (2, 4))
+
+
+class TestExportTextfile(TestCase):
+
+    def test_export_shouldAccumulateAndResetRegistry(self):
+        registry = Registry()
+        counter = registry.counter('roman_test_total', "Test counter.")
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, 'metrics', 'roman.prom')
+            counter.inc()
+            export_textfile(path, registry)
+            self.assertEqual(counter.get(), 0)
+            counter.inc(2)
+            export_textfile(path, registry)
+            with open(path) as f:
+                text = f.read()
+            with open(path + '.state') as f:
+                state = json.load(f)
+            self.assertFalse(exists(path + '.tmp'))
+        self.assertIn('roman_test_total 3\n', text)
+        self.assertEqual(state, {'roman_test_total': [[[], 3]]})
+
+
+class TestMetricsServer(TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.counter('roman_test_total', "Test counter.").inc()
+        self.server = MetricsServer(('127.0.0.1', 0), self.registry)
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_getMetrics_shouldReturnText(self):
+        with urlopen(self.url + '/metrics') as response:
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+            self.assertIn('roman_test_total 1\n', response.read().decode('utf-8'))
+
+    def test_otherPath_shouldReturn404(self):
+        with self.assertRaises(HTTPError) as cm:
+            urlopen(self.url + '/')
+        cm.exception.close()
+        self.assertEqual(cm.exception.code, 404)
+
+
+class TestBuildMetrics(TestCase):
+
+    def test_build_shouldRecordStepsAndOutcome(self):
+        REGISTRY.reset()
+        with TemporaryDirectory() as tmp:
+            config = ProjectConfig(ProjectConfig.Container(join(tmp, 'roman.yml'),
+                allow_missing=True), None, {'version': '2.0', 'steps': [
+                    {'img': 'a', 'name': 'html'}, 'b']}, ProjectConfig.version)
+            replay = join(tmp, 'replay.json')
+            with open(replay, 'w') as f:
+                json.dump({'version': 1, 'steps': {
+                    'html': {'output': [[0, 'hello']]},
+                    '1': {'code': 2}}}, f)
+            engine = MagicMock()
+            engine.backend = FakeBackend(BackendContext(1000, 1000,
+                {'FAKE_REPLAY': replay, 'FAKE_SPEED': '0'}))
+            builder = Builder(engine, config, observer=MagicMock())
+            self.assertFalse(builder.build().ok)
+        self.assertEqual(STEP_DURATION.get(step='html')[0], 1)
+        self.assertEqual(STEP_RESULTS.get(step='html', outcome='ok'), 1)
+        self.assertEqual(STEP_RESULTS.get(step='1', outcome='failed'), 1)
+        self.assertEqual(BUILD_RESULTS.get(outcome='failed'), 1)
+        self.assertEqual(LOG_BYTES.get(step='html'), 6)
+        REGISTRY.reset()
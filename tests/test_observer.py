@@ -0,0 +1,152 @@
+import json
+from io import StringIO
+from threading import Event
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from colorama import Style
+
+from apluslms_roman.backends import BuildStep
+from apluslms_roman.observer import (
+    BatchedWriter,
+    JsonLinesObserver,
+    Phase,
+    PhaseObserver,
+    StepState,
+    StreamObserver,
+)
+
+
+class TestPhaseObserver(TestCase):
+
+    def setUp(self):
+        self.stream = StringIO()
+        self.observer = StreamObserver(self.stream, colors=False)
+        self.prepare = PhaseObserver(self.observer, Phase.PREPARE)
+        self.steps = [BuildStep(0, 'a'), BuildStep(1, 'b')]
+
+    def test_prepareUpdates_shouldNotChangeBuildStates(self):
+        observer, prepare, steps = self.observer, self.prepare, self.steps
+        observer.enter_prepare()
+        observer.enter_build()
+        prepare.step_succeeded(steps[0])
+        observer.step_running(steps[0])
+        prepare.step_running(steps[1])
+        self.assertEqual(observer.get_step_state(steps[0]), StepState.RUNNING)
+        self.assertEqual(observer.get_step_state(steps[1]), StepState.UNKNOWN)
+        self.assertEqual(observer.get_step_state(steps[0], Phase.PREPARE),
+            StepState.SUCCEEDED)
+        self.assertEqual(prepare.get_step_state(steps[1]), StepState.RUNNING)
+
+    def test_prepareMessages_shouldBeWrittenInBuildPhase(self):
+        observer, prepare, steps = self.observer, self.prepare, self.steps
+        observer.enter_prepare()
+        observer.enter_build()
+        prepare.step_preflight(steps[1])
+        prepare.manager_msg(steps[1], "Downloading image b")
+        output = self.stream.getvalue()
+        self.assertIn("preparing step 1\n", output)
+        self.assertIn("  Downloading image b\n", output)
+
+    def test_phaseObserver_shouldNotChangePhase(self):
+        with self.assertRaises(RuntimeError):
+            self.prepare.enter_build()
+
+    def test_preparedStep_shouldBeNamedInResult(self):
+        observer, prepare, steps = self.observer, self.prepare, self.steps
+        observer.enter_prepare()
+        observer.enter_build()
+        prepare.step_running(steps[1])
+        prepare.step_succeeded(steps[1])
+        prepare.step_cancelled(steps[0])
+        output = self.stream.getvalue()
+        self.assertIn("  ok (preparing step 1): 0s\n", output)
+        self.assertNotIn("cancelled", output)
+
+
+class TestBatchedWriter(TestCase):
+
+    def test_writes_shouldBeCoalesced(self):
+        stream = MagicMock()
+        writer = BatchedWriter(stream, flush_interval=60)
+        for i in range(100):
+            writer.write('line\n')
+        stream.write.assert_not_called()
+        writer.flush()
+        stream.write.assert_called_once_with('line\n' * 100)
+        stream.flush.assert_called_once_with()
+
+    def test_fullBuffer_shouldBeWritten(self):
+        stream = MagicMock()
+        writer = BatchedWriter(stream, flush_interval=60, buffer_size=10)
+        writer.write('12345')
+        writer.write('67890')
+        stream.write.assert_called_once_with('1234567890')
+
+    def test_interval_shouldFlushBufferedText(self):
+        stream = MagicMock()
+        written = Event()
+        stream.flush.side_effect = written.set
+        writer = BatchedWriter(stream, flush_interval=0.01)
+        writer.write('line\n')
+        self.assertTrue(written.wait(5))
+        stream.write.assert_called_once_with('line\n')
+
+
+class TestStreamObserver(TestCase):
+
+    def setUp(self):
+        self.stream = StringIO()
+        self.step = BuildStep(0, 'a')
+
+    def test_containerOutput_shouldBeFlushedOnTransitions(self):
+        observer = StreamObserver(self.stream, flush_interval=60)
+        observer.enter_build()
+        observer.step_running(self.step)
+        observer.container_msg(self.step, "hello\nworld")
+        self.assertNotIn(">> hello", self.stream.getvalue())
+        observer.step_succeeded(self.step)
+        self.assertIn("  >> hello\n  >> world\n  ok: ", self.stream.getvalue())
+
+    def test_streamWithoutTty_shouldNotBeColored(self):
+        observer = StreamObserver(self.stream)
+        observer.enter_build()
+        self.assertEqual(self.stream.getvalue(), "BUILDING STEPS\n\n")
+
+    def test_tty_shouldBeColored(self):
+        self.stream.isatty = lambda: True
+        observer = StreamObserver(self.stream)
+        observer.enter_build()
+        self.assertEqual(self.stream.getvalue(),
+            Style.BRIGHT + "BUILDING STEPS\n\n" + Style.RESET_ALL)
+
+
+class TestJsonLinesObserver(TestCase):
+
+    def setUp(self):
+        self.stream = StringIO()
+        self.step = BuildStep(0, 'a', name='html')
+
+    def get_events(self):
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_messages_shouldBeWrittenAsJsonLines(self):
+        observer = JsonLinesObserver(self.stream, flush_interval=60)
+        observer.enter_build()
+        observer.step_running(self.step)
+        observer.container_msg(self.step, "hello\nwörld")
+        self.assertEqual(len(self.get_events()), 2)
+        observer.step_failed(self.step)
+        events = self.get_events()
+        self.assertEqual([(e['type'], e['state']) for e in events], [
+            ('PHASE_UPDATE', None),
+            ('STATE_UPDATE', 'RUNNING'),
+            ('CONTAINER_MSG', 'RUNNING'),
+            ('STATE_UPDATE', 'FAILED'),
+        ])
+        self.assertEqual(events[2]['data'], ['hello', 'wörld'])
+        self.assertEqual((events[2]['step'], events[2]['ref']), ('html', 0))
+        self.assertIn('time', events[0])
+        times = [e['t'] for e in events]
+        self.assertEqual(times, sorted(times))
+        self.assertNotIn(' ', self.stream.getvalue().splitlines()[0])
@@ -0,0 +1,92 @@
+import pstats
+from os import listdir
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+
+from apluslms_roman.profiling import (
+    CpuProfiler,
+    MemoryProfiler,
+    get_profiler,
+    profile_phase,
+    start_profiling,
+    stop_profiling,
+)
+
+
+def allocate():
+    return [str(i) * 10 for i in range(1000)]
+
+
+def count_calls(stats, name):
+    return sum(data[1] for func, data in stats.stats.items() if func[2] == name)
+
+
+class TestCpuProfiler(TestCase):
+
+    def test_phases_shouldWriteStatsPerPhase(self):
+        with TemporaryDirectory() as tmp:
+            profiler = CpuProfiler(tmp)
+            with profiler.phase('action'):
+                with profiler.phase('config'):
+                    allocate()
+                allocate()
+                allocate()
+            profiler.save()
+            self.assertEqual(sorted(listdir(tmp)),
+                ['action.pstats', 'action.txt', 'config.pstats', 'config.txt'])
+            config = pstats.Stats(join(tmp, 'config.pstats'))
+            action = pstats.Stats(join(tmp, 'action.pstats'))
+        self.assertEqual(count_calls(config, 'allocate'), 1)
+        self.assertEqual(count_calls(action, 'allocate'), 2)
+
+    def test_threads_shouldBeCombined(self):
+        profiler = CpuProfiler(None)
+        def work():
+            with profiler.phase('build'):
+                allocate()
+        threads = [Thread(target=work) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+            # a single thread at a time, as python 3.12+ allows one profiler
+            thread.join()
+        self.assertEqual(count_calls(profiler._stats['build'], 'allocate'), 2)
+
+
+class TestMemoryProfiler(TestCase):
+
+    def test_phase_shouldReportAllocations(self):
+        with TemporaryDirectory() as tmp:
+            profiler = MemoryProfiler(tmp)
+            profiler.start()
+            try:
+                with profiler.phase('config'):
+                    data = allocate()
+            finally:
+                profiler.stop()
+            profiler.save()
+            with open(join(tmp, 'config.txt')) as f:
+                report = f.read()
+        self.assertTrue(report.startswith('# config #1: '))
+        self.assertIn('test_profiling.py', report)
+        self.assertEqual(len(data), 1000)
+
+
+class TestProfilePhase(TestCase):
+
+    def test_withoutProfiler_shouldDoNothing(self):
+        stop_profiling()
+        with profile_phase('build'):
+            pass
+
+    def test_startProfiling_shouldActivateProfiler(self):
+        profiler = start_profiling('cpu', 'unused')
+        try:
+            self.assertIs(get_profiler(), profiler)
+            with profile_phase('build'):
+                allocate()
+        finally:
+            self.assertIs(stop_profiling(), profiler)
+        self.assertIsNone(get_profiler())
+        self.assertIn('build', profiler._stats)
@@ -0,0 +1,105 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import time
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from apluslms_roman.backends import BuildStep, BuildTask
+from apluslms_roman.builder import AsyncStepScheduler, StepScheduler, run_coroutine
+from apluslms_roman.resources import ResourceBudget, Resources, parse_size
+
+from .test_builder import AsyncSleepBackend, SleepBackend
+
+
+class TestParseSize(TestCase):
+
+    def test_units(self):
+        self.assertEqual(parse_size('512m'), 512 * 2**20)
+        self.assertEqual(parse_size('1.5G'), 3 * 2**29)
+        self.assertEqual(parse_size('100'), 100)
+        self.assertEqual(parse_size(100), 100)
+        self.assertIsNone(parse_size(None))
+
+    def test_invalidSize_shouldRaise(self):
+        with self.assertRaises(ValueError):
+            parse_size('lots')
+
+
+class TestResourceBudget(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = join(self.tmp.name, 'resources.json')
+
+    def budget(self, cpus=4, memory=None):
+        return ResourceBudget(cpus, memory, path=self.path)
+
+    def test_leases_shouldBeSharedByBudgets(self):
+        first, second = self.budget(), self.budget()
+        lease = first.try_acquire(3)
+        self.assertIsNotNone(lease)
+        self.assertIsNone(second.try_acquire(2))
+        self.assertIsNotNone(second.try_acquire(1))
+        self.assertEqual(second.usage(), Resources(4, 0))
+        first.release(lease)
+        self.assertIsNotNone(second.try_acquire(2))
+
+    def test_memory_shouldBeLimited(self):
+        budget = self.budget(None, 2**30)
+        self.assertIsNotNone(budget.try_acquire(memory=2**29))
+        self.assertIsNone(budget.try_acquire(memory=2**30))
+
+    def test_largeStep_shouldBeAdmittedAlone(self):
+        budget = self.budget(2)
+        lease = budget.try_acquire(8)
+        self.assertIsNotNone(lease)
+        self.assertIsNone(budget.try_acquire(1))
+
+    def test_leasesOfStoppedProcesses_shouldBeRemoved(self):
+        budget = self.budget()
+        with patch('apluslms_roman.resources.getpid', return_value=2**22 + 1):
+            budget.try_acquire(4)
+        with patch('apluslms_roman.resources.is_alive', return_value=False):
+            self.assertIsNotNone(budget.try_acquire(4))
+
+    def test_acquire_shouldWaitForRelease(self):
+        budget = self.budget()
+        lease = budget.try_acquire(4)
+        Thread(target=budget.release, args=(lease,)).start()
+        self.assertIsNotNone(budget.acquire(2))
+
+    def test_acquire_shouldStopWhenCancelled(self):
+        budget = self.budget()
+        budget.try_acquire(4)
+        self.assertIsNone(budget.acquire(2, cancelled=lambda: True))
+
+
+class TestSchedulerBudget(TestCase):
+
+    def test_stepsOverBudget_shouldRunOneAtATime(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        budget = ResourceBudget(cpus=3, path=join(tmp.name, 'resources.json'))
+        steps = [BuildStep(i, 'a', cmd='0.2', depends_on=[], cpus=2) for i in range(2)]
+        backend = SleepBackend()
+        start = time()
+        result = StepScheduler(backend, BuildTask('/a', steps), MagicMock(), 2,
+            budget=budget).run()
+        self.assertTrue(result.ok)
+        self.assertGreaterEqual(time() - start, 0.4)
+        self.assertEqual(budget.usage(), Resources(0, 0))
+
+    def test_asyncStepsOverBudget_shouldRunOneAtATime(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        budget = ResourceBudget(cpus=3, path=join(tmp.name, 'resources.json'))
+        budget.POLL_INTERVAL = 0.05
+        steps = [BuildStep(i, 'a', cmd='0.2', depends_on=[], cpus=2) for i in range(2)]
+        start = time()
+        result = run_coroutine(AsyncStepScheduler(AsyncSleepBackend(),
+            BuildTask('/a', steps), MagicMock(), 2, budget=budget).run())
+        self.assertTrue(result.ok)
+        self.assertGreaterEqual(time() - start, 0.4)
+        self.assertEqual(budget.usage(), Resources(0, 0))
@@ -0,0 +1,92 @@
+from os import makedirs, utime
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from apluslms_roman.backends import Backend, BuildResult, BuildStep, BuildTask
+from apluslms_roman.step_cache import CachingStepRunner, StepCache, scan_tree
+
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class TestStepCache(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.cache = StepCache(join(self.tmp.name, 'cache'))
+        self.build = join(self.tmp.name, 'build')
+        makedirs(join(self.build, 'sub'))
+        write(join(self.build, 'old.txt'), 'old')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_storeAndRestore_shouldRecreateChanges(self):
+        before = scan_tree(self.build)
+        write(join(self.build, 'sub', 'new.txt'), 'new')
+        self.cache.store('key', self.build, before)
+
+        self.assertTrue(self.cache.restore('key', join(self.tmp.name, 'other')))
+        with open(join(self.tmp.name, 'other', 'sub', 'new.txt')) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertFalse(exists(join(self.tmp.name, 'other', 'old.txt')))
+
+    def test_missingKey_shouldNotRestore(self):
+        self.assertFalse(self.cache.restore('missing', self.build))
+
+    def test_prune_shouldRemoveLeastRecentlyUsed(self):
+        for key in ('a', 'b'):
+            before = scan_tree(self.build)
+            write(join(self.build, key), key * 10)
+            self.cache.store(key, self.build, before)
+        utime(self.cache._entry_path('a'), (0, 0))
+
+        freed = self.cache.prune(15)
+
+        self.assertEqual(freed, 10)
+        self.assertFalse(self.cache.restore('a', self.build))
+        self.assertTrue(self.cache.restore('b', self.build))
+        self.assertEqual(self.cache.stats().objects, 1)
+
+
+class WriteBackend(Backend):
+
+    def __init__(self):
+        super().__init__(None)
+        self.built = []
+
+    def image_id(self, step):
+        return 'sha256:' + step.img
+
+    def build_step(self, task, step, observer):
+        self.built.append(step)
+        write(join(task.path, '_build', 'out.txt'), step.cmd)
+        return BuildResult()
+
+
+class TestCachingStepRunner(TestCase):
+
+    def test_unchangedStep_shouldBeRestoredFromCache(self):
+        with TemporaryDirectory() as tmp:
+            makedirs(join(tmp, 'src', '_build'))
+            write(join(tmp, 'src', 'index.rst'), 'hello')
+            task = BuildTask(join(tmp, 'src'), [BuildStep(0, 'a', cmd='out')])
+            backend = WriteBackend()
+            cache = StepCache(join(tmp, 'cache'))
+
+            for _ in range(2):
+                runner = CachingStepRunner(backend, cache)
+                write(join(tmp, 'src', '_build', 'out.txt'), '')
+                result = runner.build_step(task, task.steps[0], MagicMock())
+                self.assertTrue(result.ok)
+            self.assertEqual(len(backend.built), 1)
+            with open(join(tmp, 'src', '_build', 'out.txt')) as f:
+                self.assertEqual(f.read(), 'out')
+
+            write(join(tmp, 'src', 'index.rst'), 'changed')
+            CachingStepRunner(backend, cache).build_step(task, task.steps[0], MagicMock())
+            self.assertEqual(len(backend.built), 2)
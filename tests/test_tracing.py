@@ -0,0 +1,81 @@
+import json
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from apluslms_roman.backends import BackendContext
+from apluslms_roman.backends.fake import FakeBackend
+from apluslms_roman.builder import Builder
+from apluslms_roman.configuration import ProjectConfig
+from apluslms_roman.tracing import Tracer, span, start_tracing, stop_tracing, trace_to
+
+
+class TestTracer(TestCase):
+
+    def test_span_shouldRecordCompleteEvent(self):
+        tracer = Tracer()
+        with tracer.span('image.pull', image='a') as args:
+            args['bytes'] = 10
+        event = tracer.get_events()[-1]
+        self.assertEqual(event['name'], 'image.pull')
+        self.assertEqual(event['cat'], 'image')
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(event['args'], {'image': 'a', 'bytes': 10})
+        self.assertGreaterEqual(event['dur'], 0)
+
+    def test_failingSpan_shouldRecordError(self):
+        tracer = Tracer()
+        with self.assertRaises(ValueError):
+            with tracer.span('config.load'):
+                raise ValueError()
+        self.assertEqual(tracer.get_events()[-1]['args'], {'error': 'ValueError'})
+
+    def test_threads_shouldBeNamed(self):
+        tracer = Tracer()
+        def work():
+            with tracer.span('step'):
+                pass
+        thread = Thread(target=work, name='worker')
+        thread.start()
+        thread.join()
+        names = [e['args']['name'] for e in tracer.get_events() if e['ph'] == 'M']
+        self.assertEqual(names, ['worker'])
+
+    def test_spanWithoutTracer_shouldDoNothing(self):
+        stop_tracing()
+        with span('config.load') as args:
+            args['ignored'] = True
+
+    def test_traceTo_shouldWriteTraceFile(self):
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, 'trace.json')
+            with trace_to(path):
+                with span('config.load'):
+                    pass
+            with open(path) as f:
+                data = json.load(f)
+        self.assertEqual([e['name'] for e in data['traceEvents']], ['thread_name', 'config.load'])
+        with span('ignored'):
+            pass
+
+
+class TestBuildTracing(TestCase):
+
+    def test_build_shouldRecordPhasesAndSteps(self):
+        with TemporaryDirectory() as tmp:
+            config = ProjectConfig(ProjectConfig.Container(join(tmp, 'roman.yml'),
+                allow_missing=True), None, {'version': '2.0', 'steps': [
+                    {'img': 'a', 'name': 'html'}, 'b']}, ProjectConfig.version)
+            engine = MagicMock()
+            engine.backend = FakeBackend(BackendContext(1000, 1000, {}))
+            builder = Builder(engine, config, observer=MagicMock())
+            tracer = start_tracing()
+            try:
+                self.assertTrue(builder.build().ok)
+            finally:
+                stop_tracing()
+        names = [e['name'] for e in tracer.get_events() if e['ph'] == 'X']
+        for name in ('steps.expand_env', 'build.prepare', 'build.steps', 'step html', 'step 1'):
+            self.assertIn(name, names)
@@ -0,0 +1,103 @@
+from os import mkdir
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from apluslms_roman.watcher import (
+    InotifyWatcher,
+    PollingWatcher,
+    is_ignored,
+    matches_inputs,
+    wait_for_changes,
+)
+
+
+def write(path, content='x'):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class TestPatterns(TestCase):
+
+    def test_isIgnored_shouldMatchParentsAndNames(self):
+        patterns = ('_build', '*.swp', 'docs/tmp')
+        self.assertTrue(is_ignored('_build/html/index.html', patterns))
+        self.assertTrue(is_ignored('a/.file.swp', patterns))
+        self.assertTrue(is_ignored('docs/tmp/a.rst', patterns))
+        self.assertFalse(is_ignored('docs/a.rst', patterns))
+        self.assertFalse(is_ignored('src/_build.rst', patterns))
+
+    def test_matchesInputs_shouldMatchGlobsAndDirectories(self):
+        self.assertTrue(matches_inputs('docs/a/b.rst', ['docs/*.rst']))
+        self.assertTrue(matches_inputs('docs/a/b.rst', ['docs/']))
+        self.assertFalse(matches_inputs('src/b.rst', ['docs']))
+
+
+class WatcherTests:
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = self.tmp.name
+        mkdir(join(self.root, '_build'))
+        mkdir(join(self.root, 'docs'))
+        write(join(self.root, 'docs', 'a.rst'))
+        self.watcher = self.create_watcher(('_build',))
+        self.addCleanup(self.watcher.close)
+
+    def test_withoutChanges_shouldTimeout(self):
+        self.assertEqual(self.watcher.wait(0.05), set())
+
+    def test_changes_shouldBeReported(self):
+        write(join(self.root, 'docs', 'a.rst'), 'changed')
+        write(join(self.root, 'b.rst'))
+        self.assertEqual(wait_for_changes(self.watcher, 0.2, 5), {'docs/a.rst', 'b.rst'})
+
+    def test_newDirectory_shouldBeWatched(self):
+        mkdir(join(self.root, 'new'))
+        write(join(self.root, 'new', 'c.rst'))
+        self.assertIn('new/c.rst', wait_for_changes(self.watcher, 0.2, 5))
+        write(join(self.root, 'new', 'c.rst'), 'changed')
+        self.assertEqual(wait_for_changes(self.watcher, 0.2, 5), {'new/c.rst'})
+
+    def test_ignoredPaths_shouldNotBeReported(self):
+        write(join(self.root, '_build', 'index.html'))
+        self.assertEqual(self.watcher.wait(0.3), set())
+
+
+class TestInotifyWatcher(WatcherTests, TestCase):
+
+    def create_watcher(self, ignore):
+        try:
+            return InotifyWatcher(self.root, ignore)
+        except OSError as err:
+            self.skipTest(str(err))
+
+
+class TestPollingWatcher(WatcherTests, TestCase):
+
+    def create_watcher(self, ignore):
+        return PollingWatcher(self.root, ignore, interval=0.02)
+
+
+class FakeWatcher:
+
+    def __init__(self, *changes):
+        self.changes = list(changes)
+
+    def wait(self, timeout=None):
+        return self.changes.pop(0) if self.changes else set()
+
+
+class TestWaitForChanges(TestCase):
+
+    def test_burst_shouldBeCombined(self):
+        watcher = FakeWatcher({'a'}, {'b'}, {'c'})
+        self.assertEqual(wait_for_changes(watcher, 0), {'a', 'b', 'c'})
+
+    def test_unknownChanges_shouldReturnNone(self):
+        watcher = FakeWatcher({'a'}, None, {'c'})
+        self.assertIsNone(wait_for_changes(watcher, 0))
+
+    def test_timeout_shouldReturnEmptySet(self):
+        self.assertEqual(wait_for_changes(FakeWatcher(), 0, 0), set())